@@ -1,27 +1,42 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import text, Column, String, Integer
+from fastapi.responses import StreamingResponse, PlainTextResponse, ORJSONResponse, Response
+from sqlalchemy import text
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm import Session
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from sqlalchemy.exc import IntegrityError, OperationalError, DataError
 from dotenv import load_dotenv
-from db_control.connect import AzureDBConnection # connect.pyのインポート
+from db_control.connect import AzureDBConnection, DB_MODE, REPLICA_CHECK_INTERVAL # connect.pyのインポート
+import asyncio
+import io
 import logging
-import uvicorn
+import multiprocessing
 import os
+import threading
+import time
+import zipfile
+import orjson
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, date, timedelta
+from decimal import Decimal
 from pydantic import BaseModel
-from db_control.schemas import Product, ProductCreate, Transaction, TransactionCreate, TransactionDetail, TransactionDetailCreate, TransactionWithDetails, AddTransactionRequest
-from datetime import datetime
-from db_control import mymodels, schemas, crud, connect
-import json
+from contextlib import asynccontextmanager
+from db_control import mymodels, schemas, crud, reports, export, idempotency, receipts, cache_sync
+from db_control.product_cache import ProductCache
+from db_control.product_search import ProductSearchIndex
+from db_control.metrics import Metrics, MetricsMiddleware
+from db_control.tax_cache import TaxCache, calc_ttl_amt_ex_tax, line_subtotals
+from db_control.pricing import PromotionCache, TAX_ROUNDING, price_basket
+from db_control.product_import import ProductImporter, upsert_products, DEFAULT_BATCH_SIZE
+from db_control.detail_queue import DetailWriteQueue, DetailQueueFullError, DetailQueueClosedError
 import pytz
-from typing import List, Union
+from typing import List, Optional, Union
 
 
 # エラーハンドリング用ログの設定
 logging.basicConfig(
-    level=logging.INFO,  # INFO以上のログを表示
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),  # 既定はINFO以上。LOG_LEVEL=DEBUG でデバッグログも出力
     format="%(asctime)s - %(levelname)s - %(message)s",  # ログのフォーマット
     handlers=[
         logging.StreamHandler()  # 標準出力に出力
@@ -31,8 +46,48 @@ logging.basicConfig(
 # 環境変数をロード
 load_dotenv()
 
+logger = logging.getLogger("pos_app")
+
+# key=value 形式のデバッグログ。DEBUG が無効なときは文字列を組み立てないので本番ではほぼコストがかからない
+def log_debug(event, **fields):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s %s", event, " ".join(f"{key}={value}" for key, value in fields.items()))
+
+# 取引日時（日本時間）。TIMESTAMP 列に入れるためタイムゾーンなしの datetime で返す
+def now_tokyo():
+    return datetime.now(pytz.timezone("Asia/Tokyo")).replace(tzinfo=None, microsecond=0)
+
+# 起動・終了処理。DBエンジンはここ（ワーカープロセス内）で作成するため、
+# gunicorn の preload で fork しても親プロセスのソケットを共有しない
+@asynccontextmanager
+async def lifespan(app):
+    started = time.perf_counter()
+    await startup_event()
+    logging.info("起動処理が完了しました（%.2f秒）。リクエストの受付を開始します。", time.perf_counter() - started)
+    yield
+    await shutdown_event()
+
+def _orjson_default(obj):  # orjson が直接扱えない型の変換
+    if isinstance(obj, BaseModel):
+        return obj.model_dump()
+    if isinstance(obj, Decimal):
+        return str(obj)  # Pydantic の JSON 出力と同じく文字列にする
+    raise TypeError
+
+
+class FastJSONResponse(ORJSONResponse):
+    """orjson で直列化するレスポンス。
+
+    Pydantic モデルを直接渡すと、FastAPI の response_model による再検証と jsonable_encoder を通さずに
+    そのまま JSON にする（サーバー側で組み立てた検証不要なデータを返すエンドポイント用）。
+    """
+
+    def render(self, content):
+        return orjson.dumps(content, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+
 # FastAPIアプリケーションの初期化
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
 
 origins = [
     "https://tech0-gen8-step4-pos-app-43.azurewebsites.net",  # フロントエンドのURL
@@ -48,214 +103,1230 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# connect.py を使用してデータベース接続を確立
-db_connection = AzureDBConnection()
-engine = db_connection.connect()  # DBエンジンの取得
+# リクエスト単位のレイテンシ・ステータス・DBクエリ数を計測（/metrics で出力）
+metrics = Metrics()
+app.add_middleware(MetricsMiddleware, metrics=metrics)
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
+# connect.py を使用してデータベース接続を準備（DB_MODE で同期/非同期を切り替え）
+# エンジンの作成は起動処理（startup_event）で行い、インポート時には接続しない
+db_connection = AzureDBConnection()
+engine = None
+async_engine = None
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+AsyncSessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False)
+metrics.pool_status = db_connection.pool_status
 
 # データベース接続依存関数
-def get_db():
+def get_sync_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
 
+# 非同期モード用の依存関数（イベントループをブロックしない）
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+get_db = get_async_db if DB_MODE == "async" else get_sync_db
+
+# 読み取り専用の依存関数。レプリカ（DATABASE_REPLICA_URLS）にラウンドロビンで振り分け、
+# 使えるレプリカがない場合や書き込み直後（pin_primary）はプライマリを使う。書き込みを伴う処理では使わないこと
+def get_sync_read_db():
+    replica = db_connection.replica_engine()
+    db = SessionLocal(bind=replica) if replica is not None else SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+async def get_async_read_db():
+    replica = db_connection.async_replica_engine()
+    async with (AsyncSessionLocal(bind=replica) if replica is not None else AsyncSessionLocal()) as db:
+        yield db
+
+get_read_db = get_async_read_db if DB_MODE == "async" else get_sync_read_db
+
+# 同期のDB処理を Session / AsyncSession のどちらでも実行する
+async def run_db(db, fn, *args):
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(fn, *args)
+    return fn(db, *args)
+
+async def rollback_db(db):
+    if isinstance(db, AsyncSession):
+        await db.rollback()
+    else:
+        db.rollback()
+
+# 依存関数を使わずにセッションを開く（起動処理・バックグラウンド処理用）
+# read_only=True の場合は get_read_db と同じくレプリカに振り分ける
+@asynccontextmanager
+async def open_db(read_only=False):
+    if DB_MODE == "async":
+        replica = db_connection.async_replica_engine() if read_only else None
+        async with (AsyncSessionLocal(bind=replica) if replica is not None else AsyncSessionLocal()) as db:
+            yield db
+    else:
+        replica = db_connection.replica_engine() if read_only else None
+        db = SessionLocal(bind=replica) if replica is not None else SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+# 商品マスタのインメモリキャッシュ（設定は環境変数 PRODUCT_CACHE_* で指定）
+product_cache = ProductCache.from_env()
+
+# 商品名・JANコード前方一致の検索インデックス（PRODUCT_SEARCH_ENABLED=false で無効）
+PRODUCT_SEARCH_ENABLED = os.getenv("PRODUCT_SEARCH_ENABLED", "true").lower() == "true"
+PRODUCT_SEARCH_REFRESH_SECONDS = float(os.getenv("PRODUCT_SEARCH_REFRESH_SECONDS", "60"))
+product_search = ProductSearchIndex.from_env()
+product_search_task = None
+product_search_rebuild_lock = threading.Lock()  # 作り直しを直列にする（古い状態で後から差し替えないように）
+
+# 税マスタのキャッシュ（TAX_CACHE_REFRESH_SECONDS ごとに読み直す）
+tax_cache = TaxCache.from_env()
+
+# 販促マスタのキャッシュ（PROMOTION_CACHE_REFRESH_SECONDS ごとに読み直す）
+promotion_cache = PromotionCache.from_env()
+
+# ワーカー間でキャッシュの無効化・再読み込みを伝える版数（CACHE_SYNC_SECONDS ごとに確認。0 で無効）
+cache_versions = cache_sync.CacheVersions.from_env()
+cache_sync_task = None
+
+# 価格計算の設定
+# PRICING_MODE=server: /checkout の金額をサーバーで計算し、レジの TOTAL_AMT と一致しなければ 409 を返す
+# PRICING_TAX_ROUNDING: 税率ごとの内税額の端数処理（down / half_up / up）
+PRICING_MODE = os.getenv("PRICING_MODE", "client").lower()
+PRICING_TAX_ROUNDING = TAX_ROUNDING[os.getenv("PRICING_TAX_ROUNDING", "down").lower()]
+
+# レシートのテンプレート（RECEIPT_TEMPLATE_DIR / RECEIPT_WIDTH / RECEIPT_SHOP_NAME。起動時にコンパイルする）
+# RECEIPT_WORKERS: 一括出力に使うプロセス数（0 ならスレッドで出力する）
+receipt_renderer = receipts.ReceiptRenderer.from_env()
+RECEIPT_WORKERS = int(os.getenv("RECEIPT_WORKERS", "2"))
+RECEIPT_BATCH_CHUNK = 50  # ワーカーに1回で渡すレシートの枚数
+receipt_executor = None
+
+# 取引明細 → 取引の外部キー制約の有無（起動時に確認。ない場合は明細の登録前に取引の存在を確認する）
+detail_foreign_key = False
+
+# 取引明細の write-behind（DETAIL_WRITE_BEHIND=true で有効。明細はキューに積んで即座に応答し、まとめてコミットする）
+DETAIL_WRITE_BEHIND = os.getenv("DETAIL_WRITE_BEHIND", "false").lower() == "true"
+detail_queue = None
+
+# キューに溜まった明細を executemany + コミット1回で書き込む
+def _write_detail_batch(db: Session, rows):
+    crud.insert_transaction_details(db, rows)
+    db.commit()
+
+async def write_detail_batch(rows):
+    if DB_MODE == "async":
+        async with AsyncSessionLocal() as db:
+            await db.run_sync(_write_detail_batch, rows)
+    else:
+        # 同期モードではコミット待ちでイベントループを止めないようにスレッドで実行する
+        def write():
+            with SessionLocal() as db:
+                _write_detail_batch(db, rows)
+        await asyncio.to_thread(write)
+
 @app.get("/")
 async def root():
     return {"message": "Hello World"}
 
-# アプリケーション終了時のイベント
-@app.on_event("shutdown")
-def shutdown_event():
-    db_connection.close()
+# アプリケーション起動時の処理（lifespan から呼ばれる）
+async def startup_event():
+    global engine, async_engine
+    if DB_MODE == "async":
+        async_engine = db_connection.connect_async()  # 非同期DBエンジンの取得
+        AsyncSessionLocal.configure(bind=async_engine)
+        metrics.instrument_engine(async_engine.sync_engine)
+        for replica in db_connection.connect_async_replicas():
+            metrics.instrument_engine(replica.sync_engine)
+    else:
+        engine = db_connection.connect()  # DBエンジンの取得
+        SessionLocal.configure(bind=engine)
+        metrics.instrument_engine(engine)
+        for replica in db_connection.connect_replicas():
+            metrics.instrument_engine(replica)
+
+    # テンプレートの誤りは起動時に検出する
+    receipt_renderer.warm()
+
+    # レプリカの状態を確認してから読み取りを振り分ける（以後は REPLICA_CHECK_INTERVAL ごとに確認）
+    if db_connection.replica_urls:
+        await check_replicas()
+        logging.info(f"レプリカの状態: {db_connection.replica_status()}")
+        global replica_check_task
+        replica_check_task = asyncio.create_task(check_replicas_periodically())
+
+    # 起動時点の版数を記録してから読み込む（読み込み中に他のワーカーで変更されても次の確認で読み直す）
+    if cache_versions.enabled:
+        try:
+            async with open_db() as db:
+                await run_db(db, cache_versions.changed)
+        except Exception as e:
+            cache_versions.disable()
+            logging.warning(f"キャッシュの版数を読み込めないため、ワーカー間で共有しません（alembic upgrade head を確認）: {str(e)}")
+
+    # キャッシュを温めてからリクエストを受け付ける
+    try:
+        async with open_db() as db:
+            global detail_foreign_key
+            detail_foreign_key = await run_db(db, crud.has_transaction_foreign_key)
+
+            # 税マスタを読み込む（失敗しても最初の取引登録時に再読み込みされる）
+            count = await run_db(db, tax_cache.reload)
+            logging.info(f"税マスタを読み込みました: {count}件")
+
+            # 販促マスタを読み込む
+            count = await run_db(db, promotion_cache.reload)
+            logging.info(f"販促マスタを読み込みました: {count}件")
+
+            # PRODUCT_CACHE_WARM=true の場合は商品マスタを事前に読み込む
+            if os.getenv("PRODUCT_CACHE_WARM", "false").lower() == "true":
+                count = await run_db(db, product_cache.warm)
+                logging.info(f"商品キャッシュを事前読み込みしました: {count}件")
+
+            # 商品検索インデックスを作成
+            if PRODUCT_SEARCH_ENABLED:
+                count = await run_db(db, product_search.rebuild)
+                logging.info(f"商品検索インデックスを作成しました: {count}件")
+    except Exception as e:
+        logging.error(f"起動時のキャッシュ読み込みに失敗しました: {str(e)}", exc_info=True)
+
+    # 明細の write-behind キューを開始（前回停止時にジャーナルに残った明細は先に書き込む）
+    if DETAIL_WRITE_BEHIND:
+        global detail_queue
+        detail_queue = DetailWriteQueue.from_env(write_detail_batch)
+        await detail_queue.start()
+
+    # 売上集計の定期更新を開始（REPORT_REFRESH_SECONDS=0 で無効。集計に対応していないDBでは開始しない）
+    dialect_name = (async_engine.sync_engine if DB_MODE == "async" else engine).dialect.name
+    if REPORT_REFRESH_SECONDS > 0 and not reports.supports(dialect_name):
+        logging.warning(f"売上集計は {dialect_name} に対応していないため、定期更新を行いません")
+    elif REPORT_REFRESH_SECONDS > 0:
+        global report_refresh_task
+        report_refresh_task = asyncio.create_task(refresh_reports_periodically())
+
+    # 追加された商品を検索インデックスへ定期的に反映（PRODUCT_SEARCH_REFRESH_SECONDS=0 で無効）
+    if PRODUCT_SEARCH_ENABLED and PRODUCT_SEARCH_REFRESH_SECONDS > 0:
+        global product_search_task
+        product_search_task = asyncio.create_task(refresh_product_search_periodically())
+
+    # 他のワーカーでのキャッシュの無効化・再読み込みを反映する
+    if cache_versions.enabled:
+        global cache_sync_task
+        cache_sync_task = asyncio.create_task(sync_caches_periodically())
+
+# レプリカの疎通・遅延を確認する（遅延が REPLICA_MAX_LAG_SECONDS を超えたレプリカには振り分けない）
+replica_check_task = None
+
+async def check_replicas():
+    if DB_MODE == "async":
+        await db_connection.check_replicas_async()
+    else:
+        await asyncio.to_thread(db_connection.check_replicas)
+
+async def check_replicas_periodically():
+    while True:
+        await asyncio.sleep(REPLICA_CHECK_INTERVAL)
+        try:
+            await check_replicas()
+        except Exception as e:
+            logging.error(f"レプリカの状態確認に失敗しました: {str(e)}", exc_info=True)
+
+# 売上集計テーブルを一定間隔で更新する
+REPORT_REFRESH_SECONDS = float(os.getenv("REPORT_REFRESH_SECONDS", "60"))
+report_refresh_task = None
+
+def pending_trd_id():  # write-behind キューに未書き込みの明細がある最小の取引ID（その取引から先は集計しない）
+    return detail_queue.oldest_pending_trd_id() if detail_queue else None
+
+# 集計（INSERT ... SELECT）は数万件の取引を読むため、イベントループを止めないよう専用のセッションでスレッドから実行する
+async def refresh_reports_in_thread():
+    def refresh(pending):
+        with thread_session() as db:
+            return reports.refresh_sales_summary(db, pending)
+    return await asyncio.to_thread(refresh, pending_trd_id())
+
+async def refresh_reports_periodically():
+    while True:
+        try:
+            await refresh_reports_in_thread()
+        except Exception as e:
+            logging.error(f"売上集計の更新に失敗しました: {str(e)}", exc_info=True)
+        await asyncio.sleep(REPORT_REFRESH_SECONDS)
+
+# 追加分の読み込みとインデックスの更新もイベントループを止めないよう、作り直しと同じくスレッドから行う
+async def refresh_product_search_periodically():
+    def refresh():
+        with product_search_rebuild_lock, thread_session() as db:
+            return product_search.refresh_new(db)
+    while True:
+        await asyncio.sleep(PRODUCT_SEARCH_REFRESH_SECONDS)
+        try:
+            count = await asyncio.to_thread(refresh)
+            if count:
+                logging.info(f"商品検索インデックスに追加しました: {count}件")
+        except Exception as e:
+            logging.error(f"商品検索インデックスの更新に失敗しました: {str(e)}", exc_info=True)
+
+# 他のワーカーが上げた版数を確認し、上がっていればこのワーカーのキャッシュを読み直す
+# 確認と税・販促マスタの読み直しはイベントループを止めないよう専用のセッションでスレッドから行う
+def _reload_changed_caches():
+    with thread_session() as db:
+        names = cache_versions.changed(db)
+        if cache_sync.TAX in names:
+            tax_cache.reload(db)
+        if cache_sync.PROMOTION in names:
+            promotion_cache.reload(db)
+    return names
+
+async def sync_caches_periodically():
+    while True:
+        await asyncio.sleep(cache_versions.interval)
+        try:
+            names = await asyncio.to_thread(_reload_changed_caches)
+        except Exception as e:
+            logging.error(f"キャッシュの版数の確認に失敗しました: {str(e)}", exc_info=True)
+            continue
+        if cache_sync.PRODUCT in names:
+            # 変更された商品コードは伝わらないため全件を無効化する
+            db_connection.pin_primary()
+            product_cache.invalidate()
+            if PRODUCT_SEARCH_ENABLED:
+                schedule_product_search_rebuild()
+        for name in names:
+            logging.info(f"他のワーカーでの変更を反映しました: {name}")
+
+# 他のワーカーにキャッシュの読み直しを伝える（失敗しても自分のキャッシュは更新済みのため、エラーにはしない）
+async def publish_cache_change(name):
+    if not cache_versions.enabled:
+        return
+    def bump():
+        with thread_session() as db:
+            return cache_versions.bump(db, name)
+    try:
+        await asyncio.to_thread(bump)
+    except Exception as e:
+        logging.error(f"キャッシュの版数の更新に失敗しました: {name}: {str(e)}", exc_info=True)
+
+# スレッドで使う同期のセッション（非同期モードでも同期ドライバのエンジンで接続する）
+def thread_session():
+    if DB_MODE == "async":
+        return SessionLocal(bind=db_connection.connect())
+    return SessionLocal()
+
+# 商品マスタの一括変更後に検索インデックスを作り直す（作成中も古いインデックスで検索できる）
+# 数十万件では数秒かかるため、イベントループを止めないよう専用のセッションでスレッドから作り直し、ロックの中で差し替える
+async def rebuild_product_search():
+    def rebuild():
+        with product_search_rebuild_lock, thread_session() as db:
+            return product_search.rebuild(db)
+    try:
+        count = await asyncio.to_thread(rebuild)
+        logging.info(f"商品検索インデックスを作り直しました: {count}件")
+    except Exception as e:
+        logging.error(f"商品検索インデックスの作り直しに失敗しました: {str(e)}", exc_info=True)
+
+# アプリケーション終了時の処理（lifespan から呼ばれる）
+async def shutdown_event():
+    if report_refresh_task:
+        report_refresh_task.cancel()
+    if product_search_task:
+        product_search_task.cancel()
+    if cache_sync_task:
+        cache_sync_task.cancel()
+    if replica_check_task:
+        replica_check_task.cancel()
+    if receipt_executor:
+        receipt_executor.shutdown(cancel_futures=True)
+    # キューに残っている明細を書き込んでから接続を閉じる
+    if detail_queue:
+        await detail_queue.stop()
+    if DB_MODE == "async":
+        await db_connection.close_async()
+    else:
+        db_connection.close()
 
 # DBに接続しているかを確認するだけのエンドポイント
+# Prometheus 形式のメトリクス
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return metrics.render()
+
+# 起動時に作成したプールの接続を使い回し、プールの統計情報も返す
 @app.get("/db/status")
 async def check_db_status():
     try:
-        db_connection.connect()  # 接続確認用
-        return {"status": "Database connection is healthy."}
+        if DB_MODE == "async":
+            async with async_engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+        else:
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+        return {"status": "Database connection is healthy.", "pool": db_connection.pool_status(),
+                "replicas": db_connection.replica_status(),
+                "detail_queue": {"running": detail_queue.running, "queued": detail_queue.stats()["queued"]} if detail_queue else None}
     except Exception as e:
+        logging.error(f"DB接続確認に失敗しました: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail="Database connection failed.")
 
 
+# 1回の検索で返す商品の上限
+PRODUCT_SEARCH_MAX_LIMIT = int(os.getenv("PRODUCT_SEARCH_MAX_LIMIT", "100"))
+
+# JANコードの前方一致・商品名（カナ/ローマ字を正規化）で商品を検索する（/products/{code} より先に定義する）
+@app.get("/products/search", response_model=List[schemas.Product])
+async def search_products(q: str, limit: int = 20):
+    if not PRODUCT_SEARCH_ENABLED:
+        raise HTTPException(status_code=404, detail="商品検索は無効になっています")
+    if not 1 <= limit <= PRODUCT_SEARCH_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit は1〜{PRODUCT_SEARCH_MAX_LIMIT}で指定してください")
+    return FastJSONResponse(product_search.search(q, limit))
+
+
+# 商品検索インデックスの統計情報
+@app.get("/products/search/stats")
+async def get_product_search_stats():
+    return product_search.stats()
+
+
 # 商品コード(code)で商品マスタ(m_product_horie)を検索し、該当商品を返す。見つからなければ404エラー
 @app.get("/products/{code}", response_model=schemas.Product)
-async def get_product_by_code(code:str, db = Depends(get_db)):
+async def get_product_by_code(code:str, db = Depends(get_read_db)):
 
-    product = db.query(mymodels.Product).filter(mymodels.Product.CODE == code).first()
+    product = await run_db(db, product_cache.get_or_load, code)
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
-    return product
+    return FastJSONResponse(product)  # キャッシュ済みのモデルは再検証しない
+
+
+# 1回の一括検索で受け付ける商品コードの上限
+PRODUCT_LOOKUP_MAX_CODES = int(os.getenv("PRODUCT_LOOKUP_MAX_CODES", "200"))
+
+# 複数の商品コードをまとめて検索する（キャッシュにないコードは CODE の IN 句1回で取得）
+@app.post("/products/lookup", response_model=schemas.ProductLookupResponse)
+async def lookup_products(data: schemas.ProductLookupRequest, db=Depends(get_read_db)):
+    if len(data.codes) > PRODUCT_LOOKUP_MAX_CODES:
+        raise HTTPException(status_code=400, detail=f"一度に検索できる商品コードは{PRODUCT_LOOKUP_MAX_CODES}件までです")
+
+    try:
+        products = await run_db(db, product_cache.get_many_or_load, data.codes)
+    except OperationalError as e:
+        logging.error(f"OperationalError (データベース接続エラー): {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail="データベース接続エラーが発生しました。管理者に連絡してください。")
+
+    return FastJSONResponse(schemas.ProductLookupResponse(
+        products=products,
+        not_found=[code for code, product in products.items() if product is None],
+    ))
+
+
+# 商品キャッシュの統計情報（ヒット率などのサイズ調整用）
+@app.get("/products/cache/stats")
+async def get_product_cache_stats():
+    return product_cache.stats()
+
+
+# 商品キャッシュの無効化（価格変更時などに呼び出す）。検索インデックスも合わせて更新する
+@app.post("/products/cache/invalidate")
+async def invalidate_product_cache(data: schemas.ProductCacheInvalidateRequest, db=Depends(get_db)):
+    # 変更がレプリカに届く前に古い商品をキャッシュし直さないよう、しばらくはプライマリから読む
+    db_connection.pin_primary()
+    version = product_cache.invalidate(data.codes)
+    logging.info(f"商品キャッシュを無効化しました: version={version}")
+    if PRODUCT_SEARCH_ENABLED:
+        if data.codes is None:
+            schedule_product_search_rebuild()
+        else:
+            await run_db(db, product_search.refresh_codes, data.codes)
+    await publish_cache_change(cache_sync.PRODUCT)
+    return {"version": version}
+
+
+def schedule_product_search_rebuild():
+    global product_search_task
+    if product_search_task:
+        product_search_task.cancel()
+    # 作り直した後は定期更新を再開する
+    async def rebuild_then_refresh():
+        await rebuild_product_search()
+        if PRODUCT_SEARCH_REFRESH_SECONDS > 0:
+            await refresh_product_search_periodically()
+    product_search_task = asyncio.create_task(rebuild_then_refresh())
+
+
+# リクエストボディを1行ずつ改行付きで取り出す（ボディ全体をメモリに載せない）
+async def iter_body_lines(request: Request):
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8") + "\n"
+    if buffer:
+        yield buffer.decode("utf-8")
+
+
+# 非同期イテレータをワーカースレッドから読む（イベントループとの往復を減らすため count 件ずつ受け取る）
+def iter_from_thread(items, loop, count=1000):
+    async def take():
+        taken = []
+        try:
+            while len(taken) < count:
+                taken.append(await anext(items))
+        except StopAsyncIteration:
+            pass
+        return taken
+    while True:
+        taken = asyncio.run_coroutine_threadsafe(take(), loop).result()
+        yield from taken
+        if len(taken) < count:
+            return
+
+
+# 商品マスタの一括取込（CSV / JSONL をストリーミングで受け取り、バッチ単位で upsert）
+@app.post("/products/import")
+async def import_products(request: Request, format: str = "csv", batch_size: int = DEFAULT_BATCH_SIZE):
+    try:
+        importer = ProductImporter(format, batch_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # 解析と upsert はイベントループを止めないよう専用のセッションでスレッドから行い、ボディはループから受け取る
+    loop = asyncio.get_running_loop()
+    lines = iter_body_lines(request)
+    def run():
+        with thread_session() as db:
+            for batch in importer.batches(iter_from_thread(lines, loop)):
+                importer.upserted += upsert_products(db, batch, importer.reject)
+
+    try:
+        await asyncio.to_thread(run)
+
+    except UnicodeDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"UTF-8 で読み込めない行があります: {str(e)}")
+
+    except NotImplementedError as e:
+        raise HTTPException(status_code=501, detail=str(e))
+
+    except OperationalError as e:
+        logging.error(f"OperationalError (データベース接続エラー): {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail="データベース接続エラーが発生しました。管理者に連絡してください。")
+
+    finally:
+        # 途中で失敗してもコミット済みのバッチは反映されているため、キャッシュは必ず無効化する
+        if importer.upserted:
+            db_connection.pin_primary()
+            product_cache.invalidate()
+            if PRODUCT_SEARCH_ENABLED:
+                schedule_product_search_rebuild()
+            await publish_cache_change(cache_sync.PRODUCT)
+
+    result = importer.stats()
+    logging.info(f"商品マスタ取込完了: {result['upserted']}件 ({result['rows_per_sec']} rows/s)")
+    return result
+
+
+# 販促マスタの再読み込み（販促の登録・変更後に呼び出す）
+@app.post("/promotions/reload")
+async def reload_promotion_cache(db=Depends(get_db)):
+    try:
+        count = await run_db(db, promotion_cache.reload)
+    except OperationalError as e:
+        logging.error(f"OperationalError (データベース接続エラー): {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail="データベース接続エラーが発生しました。管理者に連絡してください。")
+    logging.info(f"販促マスタを再読み込みしました: {count}件")
+    await publish_cache_change(cache_sync.PROMOTION)
+    return {"count": count}
+
+
+# バスケット（商品コード・数量・税区分）を商品マスタの単価・販促・税マスタで価格計算する
+def _price_basket(db: Session, items):
+    tax = tax_cache.default(db)
+    if not tax:
+        logging.error("Tax rate with ID=1 not found")
+        raise HTTPException(status_code=404, detail="Tax rate not found")
+    taxes = {code: tax_cache.by_code(db, code) for code in {tax_cd for _, _, tax_cd in items if tax_cd}}
+    unknown_tax_codes = sorted(code for code, found in taxes.items() if not found)
+    if unknown_tax_codes:
+        logging.error(f"Tax codes not found: {unknown_tax_codes}")
+        raise HTTPException(status_code=404, detail=f"Tax rate not found: {unknown_tax_codes}")
+
+    products = product_cache.get_many_or_load(db, [code for code, _, _ in items])
+    missing = [code for code, product in products.items() if product is None]
+    if missing:
+        logging.warning(f"Products not found in m_product_horie table: {missing}")
+        raise HTTPException(status_code=404, detail=f"Products not found: {missing}")
+
+    lines = [(products[code], qty, taxes[tax_cd] if tax_cd else tax) for code, qty, tax_cd in items]
+    promotions = promotion_cache.for_codes(db, products.keys(), now_tokyo())
+    return price_basket(lines, promotions, PRICING_TAX_ROUNDING)
+
+
+# バスケットの価格計算（登録はしない。レジは表示用の合計をここで取得する）
+@app.post("/pricing/quote", response_model=schemas.PricedBasket)
+async def quote_basket(data: schemas.PricingRequest, db=Depends(get_read_db)):
+    if not data.items:
+        raise HTTPException(status_code=400, detail="items を1件以上指定してください")
+    try:
+        return FastJSONResponse(await run_db(db, _price_basket, [(item.PRD_CODE, item.QTY, item.TAX_CD) for item in data.items]))
+    except OperationalError as e:
+        logging.error(f"OperationalError (データベース接続エラー): {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail="データベース接続エラーが発生しました。管理者に連絡してください。")
+
+
+# 税マスタの再読み込み（税率変更時などに呼び出す）
+@app.post("/tax/reload")
+async def reload_tax_cache(db=Depends(get_db)):
+    try:
+        count = await run_db(db, tax_cache.reload)
+    except OperationalError as e:
+        logging.error(f"OperationalError (データベース接続エラー): {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail="データベース接続エラーが発生しました。管理者に連絡してください。")
+    logging.info(f"税マスタを再読み込みしました: {count}件")
+    await publish_cache_change(cache_sync.TAX)
+    return {"count": count}
+
+
+# 売上レポート: 日別売上（店舗別、by_pos=true ならPOS別）
+@app.get("/reports/sales/daily", response_model=List[schemas.SalesSummary])
+async def get_daily_sales(date_from: date, date_to: Optional[date] = None, store_cd: Optional[str] = None,
+                          pos_no: Optional[str] = None, by_pos: bool = False, db=Depends(get_read_db)):
+    return await run_db(db, reports.daily_sales, date_from, date_to or date_from, store_cd, pos_no, by_pos)
+
+
+# 売上レポート: 時間帯別売上
+@app.get("/reports/sales/hourly", response_model=List[schemas.SalesSummary])
+async def get_hourly_sales(date_from: date, date_to: Optional[date] = None, store_cd: Optional[str] = None,
+                           pos_no: Optional[str] = None, by_pos: bool = False, db=Depends(get_read_db)):
+    return await run_db(db, reports.hourly_sales, date_from, date_to or date_from, store_cd, pos_no, by_pos)
+
+
+# 売上レポート: 売上金額上位の商品
+@app.get("/reports/top-products", response_model=List[schemas.TopProduct])
+async def get_top_products(date_from: date, date_to: Optional[date] = None, store_cd: Optional[str] = None,
+                           limit: int = 10, db=Depends(get_read_db)):
+    return await run_db(db, reports.top_products, date_from, date_to or date_from, store_cd, min(limit, 100))
+
+
+# 売上集計テーブルを今すぐ更新する（定期更新を待たずに反映したい場合）
+@app.post("/reports/refresh")
+async def refresh_reports():
+    try:
+        return await refresh_reports_in_thread()
+    except NotImplementedError as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    except OperationalError as e:
+        logging.error(f"OperationalError (データベース接続エラー): {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail="データベース接続エラーが発生しました。管理者に連絡してください。")
+
+
+# 取引履歴のストリーミング出力（NDJSON / CSV）。TRD_ID のキーセットでページングし、メモリ使用量を一定に保つ
+@app.get("/transactions/export")
+async def export_transactions(format: str = "ndjson", date_from: Optional[date] = None, date_to: Optional[date] = None,
+                              store_cd: Optional[str] = None, pos_no: Optional[str] = None, page_size: int = 1000):
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format は ndjson または csv を指定してください")
+    page_size = max(1, min(page_size, 10000))
+
+    async def generate():
+        # レスポンス送信中もセッションを使うため、依存関数ではなく自前でセッションを開く
+        async with open_db(read_only=True) as db:
+            if format == "csv":
+                yield export.csv_header()
+            after_id = 0
+            while True:
+                transactions = await run_db(db, export.fetch_page, after_id, page_size, date_from, date_to, store_cd, pos_no)
+                if not transactions:
+                    break
+                yield export.to_csv(transactions) if format == "csv" else export.to_ndjson(transactions)
+                after_id = transactions[-1]["TRD_ID"]
+
+    media_type = "text/csv; charset=utf-8" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        generate(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="transactions.{format}"'},
+    )
+
+
+# レシート出力用の税率（税マスタのキャッシュから取得）
+def _receipt_taxes(db: Session):
+    tax = tax_cache.default(db)
+    if not tax:
+        logging.error("Tax rate with ID=1 not found")
+        raise HTTPException(status_code=404, detail="Tax rate not found")
+    return {t.CODE: t for t in tax_cache.all(db)}, tax
+
+# 取引と明細を1回のクエリ（JOIN）で読み込み、レシートの内容を組み立てる
+def _load_receipt(db: Session, trd_id):
+    transaction = (
+        db.query(mymodels.Transaction)
+        .options(joinedload(mymodels.Transaction.transaction_details))
+        .filter(mymodels.Transaction.TRD_ID == trd_id)
+        .first()
+    )
+    if not transaction:
+        raise HTTPException(status_code=404, detail="Transaction not found")
+    taxes, tax = _receipt_taxes(db)
+    return receipts.build_receipt(transaction, taxes, tax, PRICING_TAX_ROUNDING)
+
+# 店舗の1日分の取引を読み込む（明細は IN 句1回でまとめて読み込む）
+def _load_receipts(db: Session, store_cd, sales_date):
+    start = datetime.combine(sales_date, datetime.min.time())
+    transactions = (
+        db.query(mymodels.Transaction)
+        .options(selectinload(mymodels.Transaction.transaction_details))
+        .filter(
+            mymodels.Transaction.STORE_CD == store_cd,
+            mymodels.Transaction.DATETIME >= start,
+            mymodels.Transaction.DATETIME < start + timedelta(days=1),
+        )
+        .order_by(mymodels.Transaction.TRD_ID)
+        .all()
+    )
+    taxes, tax = _receipt_taxes(db)
+    return [receipts.build_receipt(transaction, taxes, tax, PRICING_TAX_ROUNDING) for transaction in transactions]
+
+def _receipt_response(receipt, format, content):
+    filename = f"receipt-{receipt.TRD_ID}.{receipts.EXTENSIONS[format]}"
+    headers = {"Content-Disposition": f'inline; filename="{filename}"'} if format != "text" else None
+    return Response(content, media_type=receipts.MEDIA_TYPES[format], headers=headers)
+
+# レシートの出力（text / escpos / pdf、json はレシートの内容そのもの）
+# チェックアウト直後に呼ばれるため、レプリカではなくプライマリから読む
+@app.get("/transactions/{trd_id}/receipt")
+async def get_receipt(trd_id: int, format: str = "text", db=Depends(get_db)):
+    if format not in receipts.FORMATS and format != "json":
+        raise HTTPException(status_code=400, detail="format は text / escpos / pdf / json のいずれかを指定してください")
+    try:
+        receipt = await run_db(db, _load_receipt, trd_id)
+    except OperationalError as e:
+        logging.error(f"OperationalError (データベース接続エラー): {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail="データベース接続エラーが発生しました。管理者に連絡してください。")
+    if format == "json":
+        return FastJSONResponse(receipt)
+    # 1枚分の出力は軽いので、コンパイル済みのテンプレートでそのまま出力する
+    return _receipt_response(receipt, format, receipt_renderer.render(receipt, format))
+
+def _get_receipt_executor():  # 最初の一括出力時にワーカープロセスを起動する
+    global receipt_executor
+    if receipt_executor is None:
+        receipt_executor = ProcessPoolExecutor(
+            max_workers=RECEIPT_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),  # DBエンジンやイベントループを複製しない
+            initializer=receipts.init_worker,
+            initargs=(receipt_renderer.config(),),
+        )
+    return receipt_executor
+
+# レシートを RECEIPT_BATCH_CHUNK 枚ずつワーカーで出力する（イベントループはブロックしない）
+async def render_receipts(items, format):
+    chunks = [items[i:i + RECEIPT_BATCH_CHUNK] for i in range(0, len(items), RECEIPT_BATCH_CHUNK)]
+    if RECEIPT_WORKERS > 0:
+        loop = asyncio.get_running_loop()
+        executor = _get_receipt_executor()
+        results = await asyncio.gather(*(loop.run_in_executor(executor, receipts.render_many, chunk, format) for chunk in chunks))
+    else:
+        results = await asyncio.gather(*(asyncio.to_thread(receipt_renderer.render_many, chunk, format) for chunk in chunks))
+    return [rendered for chunk in results for rendered in chunk]
+
+def _zip_receipts(rendered, format):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for trd_id, content in rendered:
+            archive.writestr(f"receipt-{trd_id}.{receipts.EXTENSIONS[format]}", content)
+    return buffer.getvalue()
+
+# 店舗の1日分の電子レシートを一括出力する（ZIP）
+@app.get("/receipts/batch")
+async def get_receipts_batch(store_cd: str, sales_date: date, format: str = "pdf", db=Depends(get_read_db)):
+    if format not in receipts.FORMATS:
+        raise HTTPException(status_code=400, detail="format は text / escpos / pdf のいずれかを指定してください")
+    try:
+        items = await run_db(db, _load_receipts, store_cd, sales_date)
+    except OperationalError as e:
+        logging.error(f"OperationalError (データベース接続エラー): {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail="データベース接続エラーが発生しました。管理者に連絡してください。")
+    rendered = await render_receipts(items, format)
+    content = await asyncio.to_thread(_zip_receipts, rendered, format)
+    logging.info(f"レシートを一括出力しました: 店舗 {store_cd} {sales_date} {len(rendered)}件")
+    return Response(
+        content,
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="receipts-{store_cd}-{sales_date:%Y%m%d}.zip"'},
+    )
+
+
+# 取引テーブルへの登録（DB処理本体。Session / AsyncSession.run_sync のどちらからも呼ばれる）
+def _add_transaction(db: Session, data: schemas.AddTransactionRequest):
+    log_debug("add_transaction.received", EMP_CD=data.EMP_CD, STORE_CD=data.STORE_CD, POS_NO=data.POS_NO, TOTAL_AMT=data.TOTAL_AMT)
+
+    # 再送（同じ冪等キー）の場合は登録済みの取引をそのまま返す
+    if data.IDEMPOTENCY_KEY:
+        replay = idempotency.replay_transaction(db, data.IDEMPOTENCY_KEY)
+        if replay:
+            log_debug("add_transaction.replayed", IDEMPOTENCY_KEY=data.IDEMPOTENCY_KEY, TRD_ID=replay.TRD_ID)
+            return replay
+
+    # 税率（TAX_ID=1）のPERCENTをキャッシュから取得
+    tax = tax_cache.default(db)
+    if not tax:
+        logging.error("Tax rate with ID=1 not found")
+        raise HTTPException(status_code=404, detail="Tax rate not found")
+
+    # 明細はまだ登録されていないため、合計金額を標準税率の税込金額として税抜き価格を計算する
+    ttl_amt_ex_tax = calc_ttl_amt_ex_tax(line_subtotals([(tax, data.TOTAL_AMT)]), PRICING_TAX_ROUNDING)
+    log_debug("add_transaction.tax", PERCENT=tax.PERCENT, TTL_AMT_EX_TAX=ttl_amt_ex_tax)
+
+    # 現在の日時を取得（バックエンド側で処理）
+    transaction_datetime = now_tokyo()
+
+    # 新規取引を挿入し、挿入された取引IDを INSERT の結果（lastrowid）から取得。フロントエンドに返すため。
+    last_id = crud.add_transaction(db, {
+        "DATETIME": transaction_datetime,
+        "EMP_CD": data.EMP_CD,
+        "STORE_CD": data.STORE_CD,
+        "POS_NO": data.POS_NO,
+        "TOTAL_AMT": data.TOTAL_AMT,
+        "TTL_AMT_EX_TAX": ttl_amt_ex_tax,
+    })
+    if not last_id:
+        logging.error("取引IDの取得に失敗しました")
+        raise HTTPException(status_code=500, detail="取引IDの取得に失敗しました")
+
+    if data.IDEMPOTENCY_KEY:
+        try:
+            idempotency.record(db, data.IDEMPOTENCY_KEY, last_id)
+        except IntegrityError:
+            # 同じキーの再送が同時に処理された場合は、先に登録された取引を返す
+            db.rollback()
+            replay = idempotency.replay_transaction(db, data.IDEMPOTENCY_KEY)
+            if replay:
+                return replay
+            raise
+
+    # データベースへの変更を確定
+    db.commit()
+
+    logging.info("取引登録成功: 取引ID %s", last_id)
+
+    # 組み立てたモデルは FastJSONResponse でそのまま返す（response_model で再検証しない）
+    return schemas.Transaction(
+        TRD_ID=last_id,
+        EMP_CD=data.EMP_CD,
+        STORE_CD=data.STORE_CD,
+        POS_NO=data.POS_NO,
+        TOTAL_AMT=data.TOTAL_AMT,
+        TTL_AMT_EX_TAX=ttl_amt_ex_tax,
+    )
 
 
-# 取引テーブルへの登録
 @app.post("/add_transaction", response_model=schemas.Transaction)
 async def add_transaction(data: schemas.AddTransactionRequest, db=Depends(get_db)):
 
     try:
-        logging.info(f"取引登録リクエスト受信: {data.dict()}")  # リクエストデータをログ出力
-        print(f"Received data: EMP_CD={data.EMP_CD}, STORE_CD={data.STORE_CD}, POS_NO={data.POS_NO}, TOTAL_AMT={data.TOTAL_AMT}")
-
-        # 税率（TAX_ID=1）のPERCENTを取得
-        tax = db.query(mymodels.Tax).filter(mymodels.Tax.ID == 1).first()
-        if not tax:
-            logging.error("Tax rate with ID=1 not found")
-            raise HTTPException(status_code=404, detail="Tax rate not found")
-        
-        tax_percent = tax.PERCENT  # 例: 0.1（10%）
-        print(f"Tax rate found: {tax_percent}")  # 🔽【デバッグ用】税率の確認
-        ttl_amt_ex_tax = data.TOTAL_AMT - (data.TOTAL_AMT * tax_percent)  # 税抜き価格を計算
-        print(f"Calculated tax-excluded amount: {ttl_amt_ex_tax}")
-
-        # 現在の日時を取得（バックエンド側で処理）
-        transaction_datetime = datetime.now(pytz.timezone("Asia/Tokyo")).strftime("%Y-%m-%d %H:%M:%S")
-
-        # 新規取引を挿入
-        transaction_query = text("""
-            INSERT INTO transaction_horie (DATETIME, EMP_CD, STORE_CD, POS_NO, TOTAL_AMT, TTL_AMT_EX_TAX)
-            VALUES (:DATETIME, :EMP_CD, :STORE_CD, :POS_NO, :TOTAL_AMT, :TTL_AMT_EX_TAX)
-        """)
-        db.execute(transaction_query, {
-            "DATETIME": transaction_datetime,
-            "EMP_CD": data.EMP_CD,
-            "STORE_CD": data.STORE_CD,
-            "POS_NO": data.POS_NO,
-            "TOTAL_AMT": data.TOTAL_AMT,
-            "TTL_AMT_EX_TAX": ttl_amt_ex_tax,
-        })
-
-        # 挿入された取引IDを取得。フロントエンドに返すため。
-        last_id_query = text("SELECT LAST_INSERT_ID()")
-        last_id_result = db.execute(last_id_query).fetchone()
-
-        if not last_id_result:
-            logging.error("取引IDの取得に失敗しました")
-            raise HTTPException(status_code=500, detail="取引IDの取得に失敗しました")
-
-        last_id = last_id_result[0]
-        print(f"Transaction ID: {last_id}")
-
-        # データベースへの変更を確定
-        db.commit()
-        print("Transaction successfully committed")
-
-        logging.info(f"取引登録成功: 取引ID {last_id}")
-
-        # FastAPI の自動変換を利用してレスポンスを返す
-        return schemas.Transaction(
-            TRD_ID=last_id,
-            DATETIME=transaction_datetime,
-            EMP_CD=data.EMP_CD,
-            STORE_CD=data.STORE_CD,
-            POS_NO=data.POS_NO,
-            TOTAL_AMT=data.TOTAL_AMT,
-            TTL_AMT_EX_TAX=ttl_amt_ex_tax,
-        )
-    
+        return FastJSONResponse(await run_db(db, _add_transaction, data))
+
+    except HTTPException:
+        await rollback_db(db)
+        raise
+
     except IntegrityError as e:
-        db.rollback()
+        await rollback_db(db)
         logging.error(f"IntegrityError (外部キー・ユニーク制約違反): {str(e)}", exc_info=True)
         raise HTTPException(status_code=400, detail=f"データ整合性エラー: {str(e)}")
 
     except OperationalError as e:
-        db.rollback()
+        await rollback_db(db)
         logging.error(f"OperationalError (データベース接続エラー): {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail="データベース接続エラーが発生しました。管理者に連絡してください。")
 
     except DataError as e:
-        db.rollback()
+        await rollback_db(db)
         logging.error(f"DataError (データ型エラー): {str(e)}", exc_info=True)
         raise HTTPException(status_code=400, detail=f"無効なデータが入力されました: {str(e)}")
 
     except ValueError as e:
-        db.rollback()
+        await rollback_db(db)
         logging.error(f"ValueError (バリデーションエラー): {str(e)}", exc_info=True)
         raise HTTPException(status_code=400, detail=f"入力データの形式が正しくありません: {str(e)}")
 
     except TypeError as e:
-        db.rollback()
+        await rollback_db(db)
         logging.error(f"TypeError (型エラー): {str(e)}", exc_info=True)
         raise HTTPException(status_code=400, detail=f"データ型が正しくありません: {str(e)}")
 
     except Exception as e:
-        db.rollback()
+        await rollback_db(db)
         logging.error(f"Unexpected Error: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail="予期しないエラーが発生しました。管理者に連絡してください。")
 
 
+# 商品・税区分をキャッシュから解決し、挿入する明細の値を組み立てる
+def _build_transaction_detail(db: Session, data: schemas.TransactionDetailData):
+    # m_product_horieにPRD_CODEがあるか確認（商品キャッシュ経由）
+    product = product_cache.get_or_load(db, data.PRD_CODE)
+    if not product:
+        logging.warning(f"Product with code {data.PRD_CODE} not found in m_product_horie table.")
+        raise HTTPException(status_code=404, detail=f"Product with code {data.PRD_CODE} not found.")
+
+    # 指定された税区分、未指定なら `ID=1` の `CODE` をキャッシュから取得
+    tax = tax_cache.by_code(db, data.TAX_CD) if data.TAX_CD else tax_cache.default(db)
+    if not tax:
+        logging.error(f"Tax rate not found: TAX_CD={data.TAX_CD}")
+        raise HTTPException(status_code=404, detail="Tax rate not found")
+
+    tax_code = tax.CODE  # 例: '10'（10%）
+
+    return {
+        "TRD_ID": data.TRD_ID,
+        "PRD_ID": product.PRD_ID,
+        "PRD_CODE": product.CODE,
+        "PRD_NAME": data.PRD_NAME,
+        "PRD_PRICE": data.PRD_PRICE,
+        "TAX_CD": tax_code,
+    }
+
 
-@app.post("/add_transaction_detail", response_model=schemas.TransactionDetail)
+# 取引が存在しなければ 404
+def _require_transaction(db: Session, trd_id):
+    if db.get(mymodels.Transaction, trd_id) is None:
+        logging.error(f"Transaction ID {trd_id} not found in transaction_horie table.")
+        raise HTTPException(status_code=404, detail=f"Transaction ID {trd_id} not found.")
+
+
+# 取引明細テーブルへの登録（DB処理本体）
+def _add_transaction_detail(db: Session, data: schemas.TransactionDetailData):
+    log_debug("add_transaction_detail.received", TRD_ID=data.TRD_ID, PRD_CODE=data.PRD_CODE, PRD_PRICE=data.PRD_PRICE, TAX_CD=data.TAX_CD)
+    values = _build_transaction_detail(db, data)
+
+    # 取引明細にデータを挿入（DTL_IDは auto_increment のため指定せず、INSERT の結果から受け取る）
+    # 取引の存在は外部キー制約で確認する。違反した場合だけ取引を検索して 404 を返す
+    # （外部キーのないパーティションテーブルでは挿入前に確認する）
+    if not detail_foreign_key:
+        _require_transaction(db, data.TRD_ID)
+    try:
+        dtl_id = crud.add_transaction_detail(db, values)
+    except IntegrityError:
+        db.rollback()
+        _require_transaction(db, data.TRD_ID)
+        raise
+
+    # データベースにコミット（登録内容はメモリ上で組み立てるので再取得しない）
+    db.commit()
+
+    log_debug("add_transaction_detail.committed", TRD_ID=data.TRD_ID, DTL_ID=dtl_id)
+    return schemas.TransactionDetail(DTL_ID=dtl_id, **values)
+
+
+# write-behind モードの検証（キューに積んだ後は外部キー違反を呼び出し元に返せないため、取引の存在を先に確認する）
+def _validate_transaction_detail(db: Session, data: schemas.TransactionDetailData):
+    log_debug("add_transaction_detail.received", TRD_ID=data.TRD_ID, PRD_CODE=data.PRD_CODE, PRD_PRICE=data.PRD_PRICE, TAX_CD=data.TAX_CD)
+    values = _build_transaction_detail(db, data)
+    _require_transaction(db, data.TRD_ID)
+    return values
+
+
+@app.post("/add_transaction_detail", response_model=Union[schemas.TransactionDetail, schemas.QueuedTransactionDetail])
 async def add_transaction_detail(
     data: schemas.TransactionDetailData,
     db: Session = Depends(get_db)
 ):
-    print("Received request data:", data)  # 受け取ったデータをログに出力
-
     try:
-        print(f"Processing item: TRD_ID={data.TRD_ID}, PRD_CODE={data.PRD_CODE}")  # デバッグ情報
-
-        # 取引が存在するか確認
-        transaction = db.query(mymodels.Transaction).filter_by(TRD_ID=data.TRD_ID).first()
-        if not transaction:
-            logging.error(f"Transaction ID {data.TRD_ID} not found in transaction_horie table.")
-            raise HTTPException(status_code=404, detail=f"Transaction ID {data.TRD_ID} not found.")
-
-        # m_product_horieにPRD_CODEがあるか確認
-        product = db.query(mymodels.Product).filter_by(CODE=data.PRD_CODE).first()
-        if not product:
-            logging.warning(f"Product with code {data.PRD_CODE} not found in m_product_horie table.")
-            raise HTTPException(status_code=404, detail=f"Product with code {data.PRD_CODE} not found.")
-        
-        # `tax_horie` から `ID=1` の `CODE` を取得
-        tax = db.query(mymodels.Tax).filter(mymodels.Tax.ID == 1).first()
-        if not tax:
-            logging.error("Tax rate with ID=1 not found")
-            raise HTTPException(status_code=404, detail="Tax rate not found")
-
-        tax_code = tax.CODE  # 例: '10'（10%）
-        print(f"Tax code retrieved: {tax_code}")
-
-        # 取引明細にデータを挿入（DTL_IDは auto_increment のため指定しない）
-        new_detail = mymodels.TransactionDetail(
-            TRD_ID=data.TRD_ID,
-            PRD_ID=product.PRD_ID,
-            PRD_CODE=product.CODE,
-            PRD_NAME=data.PRD_NAME,
-            PRD_PRICE=data.PRD_PRICE,
-            TAX_CD=tax_code
-        )
-        db.add(new_detail)
+        if detail_queue:
+            # 検証だけ行ってキューに積み、コミットを待たずに 202 を返す
+            values = await run_db(db, _validate_transaction_detail, data)
+            seq = await detail_queue.enqueue(values)
+            log_debug("add_transaction_detail.queued", TRD_ID=data.TRD_ID, QUEUE_SEQ=seq)
+            return FastJSONResponse(schemas.QueuedTransactionDetail(QUEUE_SEQ=seq, **values), status_code=202)
 
-        # データベースにコミット
-        db.commit()
+        return FastJSONResponse(await run_db(db, _add_transaction_detail, data))
 
-        # 挿入されたデータを最新の状態に更新するとデータベースで自動生成された値を取得できる
-        db.refresh(new_detail) 
+    except DetailQueueFullError:
+        await rollback_db(db)
+        logging.warning("Detail write-behind queue is full.")
+        raise HTTPException(status_code=503, detail="明細の書き込みが混み合っています。しばらくしてから再送してください。", headers={"Retry-After": "1"})
 
-        logging.info(f"取引詳細登録成功: {new_detail}")
-        return new_detail
+    except DetailQueueClosedError:
+        # 停止処理中、またはフラッシャーが止まっている（書き込まれない明細を受け付けない）
+        await rollback_db(db)
+        logging.error(f"Detail write-behind queue is not running: {detail_queue.stats()}")
+        raise HTTPException(status_code=503, detail="明細を受け付けられない状態です。しばらくしてから再送してください。", headers={"Retry-After": "1"})
 
-    except IntegrityError:
-        db.rollback()
+    except HTTPException:
+        await rollback_db(db)
+        raise
+
+    except IntegrityError as e:
+        await rollback_db(db)
         logging.error(f"IntegrityError: {str(e)}", exc_info=True)
         raise HTTPException(status_code=400, detail="Data integrity error occurred.")
 
-    except OperationalError:
-        db.rollback()
+    except OperationalError as e:
+        await rollback_db(db)
         logging.error(f"OperationalError: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail="Database operation error occurred.")
 
     except Exception as e:
-        db.rollback()
-        logging.error(f"Unexpected error: {str(e)}", exc_info=True) 
+        await rollback_db(db)
+        logging.error(f"Unexpected error: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
 
 
+# 明細の write-behind キューの状態（キュー長・書き込み件数・破棄件数など）
+@app.get("/transactions/detail-queue/stats")
+async def get_detail_queue_stats():
+    if not detail_queue:
+        return {"enabled": False}
+    return {"enabled": True, **detail_queue.stats()}
+
+
+# チェックアウトの明細（1行=1点）を商品・税区分ごとにまとめて価格計算し、
+# 税抜き合計と明細ごとの値引き後単価を返す。合計がレジの TOTAL_AMT と異なる場合は 409
+def _server_prices(db: Session, data: schemas.CheckoutRequest):
+    groups = {}
+    for i, item in enumerate(data.items):
+        groups.setdefault((item.PRD_CODE, item.TAX_CD), []).append(i)
+    basket = _price_basket(db, [(code, len(indexes), tax_cd) for (code, tax_cd), indexes in groups.items()])
+    if basket.TOTAL_AMT != data.TOTAL_AMT:
+        logging.warning(f"TOTAL_AMT mismatch: client={data.TOTAL_AMT} server={basket.TOTAL_AMT}")
+        raise HTTPException(status_code=409, detail={"message": "合計金額がサーバーの計算結果と一致しません", "TOTAL_AMT": basket.TOTAL_AMT})
+
+    # 行の値引き後金額を1点ずつに割り振る（割り切れない端数は先頭の点に寄せる）
+    prices = [0] * len(data.items)
+    for line, indexes in zip(basket.lines, groups.values()):
+        unit, extra = divmod(line.NET_AMOUNT, line.QTY)
+        for n, i in enumerate(indexes):
+            prices[i] = unit + (1 if n < extra else 0)
+    return basket.TTL_AMT_EX_TAX, prices
+
+
+# レジの時計のずれとして許容する秒数（これより先の会計日時は受け付けない）
+SALE_CLOCK_SKEW_SECONDS = int(os.getenv("SALE_CLOCK_SKEW_SECONDS", "300"))
+
+# レジで会計した日時を日本時間・タイムゾーンなしにそろえる（未指定なら登録時刻）
+def _sale_datetime(value):
+    now = now_tokyo()
+    if value is None:
+        return now
+    if value.tzinfo:
+        value = value.astimezone(pytz.timezone("Asia/Tokyo"))
+    value = value.replace(tzinfo=None, microsecond=0)
+    if value > now + timedelta(seconds=SALE_CLOCK_SKEW_SECONDS):
+        raise HTTPException(status_code=400, detail=f"会計日時が現在時刻より先です: {value.isoformat()}")
+    return value
+
+
+# 取引ヘッダーと全明細を挿入する（コミットは呼び出し側で行う）
+def _insert_checkout(db: Session, data: schemas.CheckoutRequest):
+
+    # 税率（TAX_ID=1）と明細で指定された税区分をキャッシュから取得
+    tax = tax_cache.default(db)
+    if not tax:
+        logging.error("Tax rate with ID=1 not found")
+        raise HTTPException(status_code=404, detail="Tax rate not found")
+    unknown_tax_codes = sorted({item.TAX_CD for item in data.items if item.TAX_CD and not tax_cache.by_code(db, item.TAX_CD)})
+    if unknown_tax_codes:
+        logging.error(f"Tax codes not found: {unknown_tax_codes}")
+        raise HTTPException(status_code=404, detail=f"Tax rate not found: {unknown_tax_codes}")
+
+    # 全商品コードを IN 句1回で解決（キャッシュ済みのコードはDBに問い合わせない）
+    products = product_cache.get_many_or_load(db, [item.PRD_CODE for item in data.items])
+    missing = [code for code, product in products.items() if product is None]
+    if missing:
+        logging.warning(f"Products not found in m_product_horie table: {missing}")
+        raise HTTPException(status_code=404, detail=f"Products not found: {missing}")
+
+    if PRICING_MODE == "server":
+        # 単価・値引き・税抜き金額はサーバーで計算した値を使う
+        ttl_amt_ex_tax, prices = _server_prices(db, data)
+    else:
+        # 税抜き価格は明細の税区分ごとの小計から計算する。レジの合計と明細の合計の差（レジ側の値引きなど）は標準税率に含める
+        prices = [item.PRD_PRICE for item in data.items]
+        lines = [(tax_cache.by_code(db, item.TAX_CD) if item.TAX_CD else tax, item.PRD_PRICE) for item in data.items]
+        lines.append((tax, data.TOTAL_AMT - sum(prices)))
+        ttl_amt_ex_tax = calc_ttl_amt_ex_tax(line_subtotals(lines), PRICING_TAX_ROUNDING)
+
+    # 取引ヘッダーを挿入（自動採番された TRD_ID は INSERT の結果から取得）
+    trd_id = crud.add_transaction(db, {
+        "DATETIME": _sale_datetime(data.DATETIME),
+        "EMP_CD": data.EMP_CD,
+        "STORE_CD": data.STORE_CD,
+        "POS_NO": data.POS_NO,
+        "TOTAL_AMT": data.TOTAL_AMT,
+        "TTL_AMT_EX_TAX": ttl_amt_ex_tax,
+    })
+
+    # 明細を executemany で一括挿入
+    rows = [
+        {
+            "TRD_ID": trd_id,
+            "PRD_ID": products[item.PRD_CODE].PRD_ID,
+            "PRD_CODE": item.PRD_CODE,
+            "PRD_NAME": item.PRD_NAME,
+            "PRD_PRICE": price,
+            "TAX_CD": item.TAX_CD or tax.CODE,
+        }
+        for item, price in zip(data.items, prices)
+    ]
+    dtl_ids = crud.add_transaction_details(db, rows)
+
+    if data.IDEMPOTENCY_KEY:
+        idempotency.record(db, data.IDEMPOTENCY_KEY, trd_id)
+
+    return schemas.TransactionWithDetails(
+        TRD_ID=trd_id,
+        EMP_CD=data.EMP_CD,
+        STORE_CD=data.STORE_CD,
+        POS_NO=data.POS_NO,
+        TOTAL_AMT=data.TOTAL_AMT,
+        TTL_AMT_EX_TAX=ttl_amt_ex_tax,
+        details=[schemas.TransactionDetail(DTL_ID=dtl_id, **row) for dtl_id, row in zip(dtl_ids, rows)],
+    )
+
+
+# 取引ヘッダーと全明細を1回のコミットで登録する（DB処理本体）
+def _checkout(db: Session, data: schemas.CheckoutRequest):
+    log_debug("checkout.received", EMP_CD=data.EMP_CD, STORE_CD=data.STORE_CD, POS_NO=data.POS_NO, items=len(data.items))
+
+    # 再送（同じ冪等キー）の場合は登録済みの取引をそのまま返す
+    if data.IDEMPOTENCY_KEY:
+        replay = idempotency.replay_transaction(db, data.IDEMPOTENCY_KEY, with_details=True)
+        if replay:
+            return replay
+
+    try:
+        result = _insert_checkout(db, data)
+    except IntegrityError:
+        # 同じキーの再送が同時に処理された場合は、先に登録された取引を返す
+        db.rollback()
+        replay = idempotency.replay_transaction(db, data.IDEMPOTENCY_KEY, with_details=True) if data.IDEMPOTENCY_KEY else None
+        if replay:
+            return replay
+        raise
+
+    # データベースへの変更を確定（1回のみ）
+    db.commit()
+    logging.info("チェックアウト成功: 取引ID %s, 明細%s件", result.TRD_ID, len(result.details))
+    return result
+
+
+# オフライン中に溜めた会計をまとめて登録する（DB処理本体）
+def _checkout_batch(db: Session, data: schemas.CheckoutBatchRequest):
+    # 登録済みのキーと全商品コードをそれぞれ1回のクエリで解決しておく
+    existing = idempotency.find_transaction_ids(db, [sale.IDEMPOTENCY_KEY for sale in data.sales])
+    product_cache.get_many_or_load(db, [item.PRD_CODE for sale in data.sales for item in sale.items])
+
+    results = []
+    for sale in data.sales:
+        key = sale.IDEMPOTENCY_KEY
+        if key and key in existing:
+            results.append(schemas.CheckoutBatchResult(IDEMPOTENCY_KEY=key, status="replayed", TRD_ID=existing[key]))
+            continue
+        try:
+            # 会計ごとにセーブポイントを切り、失敗した会計だけを取り消す
+            with db.begin_nested():
+                created = _insert_checkout(db, sale)
+        except HTTPException as e:
+            results.append(schemas.CheckoutBatchResult(IDEMPOTENCY_KEY=key, status="error", detail=str(e.detail)))
+            continue
+        except IntegrityError as e:
+            # 同じキーの会計が別のリクエストで同時に登録された場合は、先に登録された取引を返す
+            replayed = idempotency.find_transaction_ids(db, [key], latest=True).get(key) if key else None
+            if replayed is not None:
+                existing[key] = replayed
+                results.append(schemas.CheckoutBatchResult(IDEMPOTENCY_KEY=key, status="replayed", TRD_ID=replayed))
+                continue
+            logging.error(f"一括登録でエラー: IDEMPOTENCY_KEY={key}: {str(e)}")
+            results.append(schemas.CheckoutBatchResult(IDEMPOTENCY_KEY=key, status="error", detail=e.__class__.__name__))
+            continue
+        except DataError as e:
+            logging.error(f"一括登録でエラー: IDEMPOTENCY_KEY={key}: {str(e)}")
+            results.append(schemas.CheckoutBatchResult(IDEMPOTENCY_KEY=key, status="error", detail=e.__class__.__name__))
+            continue
+        if key:
+            existing[key] = created.TRD_ID  # 同じバッチ内で同じキーが重複していても1件だけ登録する
+        results.append(schemas.CheckoutBatchResult(IDEMPOTENCY_KEY=key, status="created", TRD_ID=created.TRD_ID))
+
+    db.commit()
+    created_count = sum(1 for result in results if result.status == "created")
+    logging.info("一括チェックアウト: %s件中 %s件登録", len(results), created_count)
+    return results
+
+
+# 取引ヘッダーと全明細を1回のコミットで登録する（/add_transaction + /add_transaction_detail の一括版）
+@app.post("/checkout", response_model=schemas.TransactionWithDetails)
+async def checkout(data: schemas.CheckoutRequest, db: Session = Depends(get_db)):
+
+    try:
+        return FastJSONResponse(await run_db(db, _checkout, data))
+
+    except HTTPException:
+        await rollback_db(db)
+        raise
+
+    except IntegrityError as e:
+        await rollback_db(db)
+        logging.error(f"IntegrityError (外部キー・ユニーク制約違反): {str(e)}", exc_info=True)
+        raise HTTPException(status_code=400, detail=f"データ整合性エラー: {str(e)}")
+
+    except OperationalError as e:
+        await rollback_db(db)
+        logging.error(f"OperationalError (データベース接続エラー): {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail="データベース接続エラーが発生しました。管理者に連絡してください。")
+
+    except DataError as e:
+        await rollback_db(db)
+        logging.error(f"DataError (データ型エラー): {str(e)}", exc_info=True)
+        raise HTTPException(status_code=400, detail=f"無効なデータが入力されました: {str(e)}")
+
+    except Exception as e:
+        await rollback_db(db)
+        logging.error(f"Unexpected Error: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail="予期しないエラーが発生しました。管理者に連絡してください。")
+
+
+# 一括送信で受け付ける会計の上限
+CHECKOUT_BATCH_MAX_SALES = int(os.getenv("CHECKOUT_BATCH_MAX_SALES", "500"))
+
+# オフラインだったレジが溜めた会計を1リクエストで送信する。会計ごとの結果を返す
+@app.post("/checkout/batch", response_model=List[schemas.CheckoutBatchResult])
+async def checkout_batch(data: schemas.CheckoutBatchRequest, db: Session = Depends(get_db)):
+    if len(data.sales) > CHECKOUT_BATCH_MAX_SALES:
+        raise HTTPException(status_code=400, detail=f"一度に送信できる会計は{CHECKOUT_BATCH_MAX_SALES}件までです")
+
+    try:
+        return FastJSONResponse(await run_db(db, _checkout_batch, data))
+
+    except HTTPException:
+        await rollback_db(db)
+        raise
+
+    except OperationalError as e:
+        await rollback_db(db)
+        logging.error(f"OperationalError (データベース接続エラー): {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail="データベース接続エラーが発生しました。管理者に連絡してください。")
+
+    except Exception as e:
+        await rollback_db(db)
+        logging.error(f"Unexpected Error: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail="予期しないエラーが発生しました。管理者に連絡してください。")
+
+
 if __name__ == "__main__":
+    import uvicorn
+
     port = int(os.environ.get("PORT", 8000))  # 環境変数からPORTを取得（デフォルト8000）
-    uvicorn.run("app:app", host="0.0.0.0", port=port, reload=True)
+    if os.getenv("APP_ENV", "development").lower() == "production":
+        # 本番: reload なし・CPUコア数のワーカーで起動（preload する場合は gunicorn -c gunicorn.conf.py app:app）
+        workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+        uvicorn.run("app:app", host="0.0.0.0", port=port, workers=workers)
+    else:
+        uvicorn.run("app:app", host="0.0.0.0", port=port, reload=True)
 
@@ -0,0 +1,61 @@
+"""DB_MODE=sync / async の同時実行性能を比較するベンチマーク
+
+使い方:
+    # 1. それぞれのモードでサーバーを起動する
+    DB_MODE=sync  uvicorn app:app --port 8000
+    DB_MODE=async uvicorn app:app --port 8001
+
+    # 2. 同じ条件で負荷をかけて比較する（PRODUCT_CACHE_MAX_SIZE=0 でキャッシュを無効にするとDBの差が見える）
+    python benchmarks/bench_db_mode.py --url http://localhost:8000 --code 4987035535409
+    python benchmarks/bench_db_mode.py --url http://localhost:8001 --code 4987035535409
+
+httpx が必要: pip install httpx
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+
+async def worker(client, path, count, latencies, errors):
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            response = await client.get(path)
+            if response.status_code >= 500:
+                errors.append(response.status_code)
+        except httpx.HTTPError as e:
+            errors.append(str(e))
+        latencies.append(time.perf_counter() - start)
+
+
+async def run(url, code, concurrency, requests_per_worker):
+    latencies = []
+    errors = []
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30.0) as client:
+        await client.get(f"/products/{code}")  # ウォームアップ
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            worker(client, f"/products/{code}", requests_per_worker, latencies, errors)
+            for _ in range(concurrency)
+        ])
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"url={url} concurrency={concurrency} requests={len(latencies)} errors={len(errors)}")
+    print(f"throughput: {len(latencies) / elapsed:.1f} req/s")
+    print(f"p50: {statistics.median(latencies) * 1000:.2f} ms")
+    print(f"p99: {latencies[int(len(latencies) * 0.99) - 1] * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GET /products/{code} の同時実行ベンチマーク")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--code", required=True, help="m_product_horie に存在する商品コード")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=50, help="1ワーカーあたりのリクエスト数")
+    args = parser.parse_args()
+    asyncio.run(run(args.url, args.code, args.concurrency, args.requests))
@@ -0,0 +1,92 @@
+"""レスポンス生成1回あたりのCPU時間を、FastAPI 標準の経路と高速経路で比較するマイクロベンチマーク
+
+- 標準: モデルを組み立て → response_model で再検証・jsonable_encoder → JSONResponse
+- 高速: モデルを組み立て → FastJSONResponse（orjson）で直接直列化
+
+対象は商品スキャン（GET /products/{code}）とチェックアウト（POST /checkout）のレスポンス。DBには接続しない。
+
+使い方:
+    python -m benchmarks.bench_serialization --items 10 --iterations 20000
+"""
+import argparse
+import asyncio
+import os
+import time
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")  # app のインポートに必要（接続はしない）
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+
+from app import app, FastJSONResponse
+from db_control import schemas
+
+
+def response_field(path):
+    return next(route.response_field for route in app.routes if getattr(route, "path", None) == path)
+
+
+def product_values():
+    return {"PRD_ID": 1, "CODE": "4900000000001", "NAME": "おにぎり1", "PRICE": 150}
+
+
+def checkout_values(items):
+    details = [
+        {"DTL_ID": 1000 + i, "TRD_ID": 1, "PRD_ID": i, "PRD_CODE": f"49{i:011d}", "PRD_NAME": f"商品{i}", "PRD_PRICE": 100 + i}
+        for i in range(items)
+    ]
+    header = {"TRD_ID": 1, "EMP_CD": "1", "STORE_CD": "30", "POS_NO": "001", "TOTAL_AMT": 5000, "TTL_AMT_EX_TAX": 4545.0}
+    return header, details
+
+
+async def standard_scan(field, iterations):
+    product = schemas.Product(**product_values())  # キャッシュ済みの商品
+    for _ in range(iterations):
+        content = await serialize_response(field=field, response_content=product)
+        JSONResponse(content)
+
+
+async def fast_scan(iterations):
+    product = schemas.Product(**product_values())
+    for _ in range(iterations):
+        FastJSONResponse(product)
+
+
+async def standard_checkout(field, items, iterations):
+    header, details = checkout_values(items)
+    for _ in range(iterations):
+        result = schemas.TransactionWithDetails(**header, details=[schemas.TransactionDetail(**d) for d in details])
+        content = await serialize_response(field=field, response_content=result)
+        JSONResponse(content)
+
+
+async def fast_checkout(items, iterations):
+    header, details = checkout_values(items)
+    for _ in range(iterations):
+        result = schemas.TransactionWithDetails(**header, details=[schemas.TransactionDetail(**d) for d in details])
+        FastJSONResponse(result)
+
+
+def cpu_us(coroutine, iterations):  # 1回あたりのCPU時間（マイクロ秒）
+    started = time.process_time()
+    asyncio.run(coroutine)
+    return (time.process_time() - started) / iterations * 1_000_000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="レスポンス直列化のCPU時間を比較する")
+    parser.add_argument("--items", type=int, default=10, help="チェックアウト1回あたりの明細数")
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    scan_field = response_field("/products/{code}")
+    checkout_field = response_field("/checkout")
+    results = {
+        "scan": (cpu_us(standard_scan(scan_field, args.iterations), args.iterations),
+                 cpu_us(fast_scan(args.iterations), args.iterations)),
+        f"checkout ({args.items} items)": (cpu_us(standard_checkout(checkout_field, args.items, args.iterations), args.iterations),
+                                           cpu_us(fast_checkout(args.items, args.iterations), args.iterations)),
+    }
+    print(f"{'endpoint':<22}{'standard(us)':>14}{'fast(us)':>12}{'saved(us)':>12}")
+    for name, (standard, fast) in results.items():
+        print(f"{name:<22}{standard:>14.1f}{fast:>12.1f}{standard - fast:>12.1f}")
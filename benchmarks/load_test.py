@@ -0,0 +1,176 @@
+"""レジ操作（商品スキャン → 取引登録 → 明細登録）を再現する負荷テスト
+
+各レジ（--tills）が並行して会計を繰り返し、エンドポイントごとの p50 / p99 / スループットを出力する。
+--url を省略するとアプリをプロセス内（ASGI）で起動するため、サーバーを立てずにローカルDBで計測できる。
+
+使い方:
+    export DATABASE_URL=sqlite:///./bench.db
+    python -m benchmarks.seed --products 50000
+    python -m benchmarks.load_test --baseline benchmarks/baselines/sqlite_legacy.json
+    python -m benchmarks.load_test --mode checkout --baseline benchmarks/baselines/sqlite_checkout.json
+
+    # ベースラインを更新する場合
+    python -m benchmarks.load_test --output benchmarks/baselines/sqlite_legacy.json
+
+ベースラインは計測したマシンに依存するため、同じマシンで seed からやり直して比較すること。
+
+httpx が必要: pip install httpx
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+import httpx
+
+from benchmarks.seed import product_code
+
+# エンドポイントのラベル（パスパラメータを含まない形で集計する）
+SCAN = "GET /products/{code}"
+ADD_TRANSACTION = "POST /add_transaction"
+ADD_DETAIL = "POST /add_transaction_detail"
+CHECKOUT = "POST /checkout"
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, label, started, response):
+        self.latencies.setdefault(label, []).append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            self.errors[label] = self.errors.get(label, 0) + 1
+
+    def summary(self, elapsed):
+        result = {}
+        for label, values in sorted(self.latencies.items()):
+            values.sort()
+            result[label] = {
+                "count": len(values),
+                "errors": self.errors.get(label, 0),
+                "p50_ms": round(statistics.median(values) * 1000, 3),
+                "p99_ms": round(values[max(0, int(len(values) * 0.99) - 1)] * 1000, 3),
+                "throughput_rps": round(len(values) / elapsed, 1),
+            }
+        return result
+
+
+async def till(client, recorder, rnd, products, baskets, items, mode):  # 1台のレジの操作を再現する
+    for _ in range(baskets):
+        # 売れ筋に偏るように商品を選ぶ（上位の商品ほど出やすい）
+        codes = [product_code(min(products, int(rnd.paretovariate(1.2)))) for _ in range(rnd.randint(1, items))]
+
+        scanned = []
+        for code in codes:
+            started = time.perf_counter()
+            response = await client.get(f"/products/{code}")
+            recorder.add(SCAN, started, response)
+            if response.status_code == 200:
+                scanned.append(response.json())
+        if not scanned:
+            continue
+
+        header = {"EMP_CD": "9999999999", "STORE_CD": "30", "POS_NO": f"{rnd.randint(1, 90):03d}", "TOTAL_AMT": sum(p["PRICE"] for p in scanned)}
+        lines = [{"PRD_CODE": p["CODE"], "PRD_NAME": p["NAME"], "PRD_PRICE": p["PRICE"]} for p in scanned]
+
+        if mode == "checkout":
+            started = time.perf_counter()
+            response = await client.post("/checkout", json={**header, "items": lines})
+            recorder.add(CHECKOUT, started, response)
+            continue
+
+        started = time.perf_counter()
+        response = await client.post("/add_transaction", json=header)
+        recorder.add(ADD_TRANSACTION, started, response)
+        if response.status_code != 200:
+            continue
+        trd_id = response.json()["TRD_ID"]
+        for line in lines:
+            started = time.perf_counter()
+            response = await client.post("/add_transaction_detail", json={"TRD_ID": trd_id, **line})
+            recorder.add(ADD_DETAIL, started, response)
+
+
+async def run(args):
+    recorder = Recorder()
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=30.0)
+        lifespan = None
+    else:
+        from app import app  # DATABASE_URL などの環境変数を読み込んだ後にインポートする
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=30.0)
+        lifespan = app.router.lifespan_context(app)
+
+    async with client:
+        if lifespan:
+            await lifespan.__aenter__()
+        try:
+            started = time.perf_counter()
+            await asyncio.gather(*[
+                till(client, recorder, random.Random(i), args.products, args.baskets, args.items, args.mode)
+                for i in range(args.tills)
+            ])
+            elapsed = time.perf_counter() - started
+        finally:
+            if lifespan:
+                await lifespan.__aexit__(None, None, None)
+
+    return {
+        "config": {key: getattr(args, key) for key in ("mode", "tills", "baskets", "items", "products")},
+        "elapsed_sec": round(elapsed, 3),
+        "endpoints": recorder.summary(elapsed),
+    }
+
+
+def compare(result, baseline, tolerance):  # ベースラインより p99 が悪化、またはスループットが低下したエンドポイントを返す
+    regressions = []
+    for label, base in baseline["endpoints"].items():
+        current = result["endpoints"].get(label)
+        if current is None:
+            continue
+        if current["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{label}: p99 {base['p99_ms']}ms -> {current['p99_ms']}ms")
+        if current["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{label}: throughput {base['throughput_rps']} -> {current['throughput_rps']} req/s")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="スキャン・会計の負荷テスト")
+    parser.add_argument("--url", help="計測対象のサーバー。省略時はプロセス内でアプリを起動")
+    parser.add_argument("--mode", choices=["legacy", "checkout"], default="legacy",
+                        help="legacy: /add_transaction + 明細ごとの /add_transaction_detail, checkout: /checkout 1回")
+    parser.add_argument("--tills", type=int, default=8, help="同時に操作するレジの台数")
+    parser.add_argument("--baskets", type=int, default=25, help="レジ1台あたりの会計回数")
+    parser.add_argument("--items", type=int, default=10, help="1会計あたりの最大商品数")
+    parser.add_argument("--products", type=int, default=50000, help="seed で投入した商品数")
+    parser.add_argument("--output", help="結果をJSONで保存するパス（ベースラインの更新に使う）")
+    parser.add_argument("--baseline", help="比較するベースラインのJSON")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="許容する悪化率")
+    args = parser.parse_args()
+
+    # ベンチマーク中は定期集計と取引ごとのINFOログを止める
+    os.environ.setdefault("REPORT_REFRESH_SECONDS", "0")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        if regressions:
+            print("ベースラインから悪化しました:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("ベースラインとの差は許容範囲内です。")
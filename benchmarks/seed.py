@@ -0,0 +1,81 @@
+"""ベンチマーク用にローカルDB（SQLite / ローカル MySQL）へテーブルと商品・税マスタを投入する
+
+使い方:
+    DATABASE_URL=sqlite:///./bench.db python -m benchmarks.seed --products 50000
+"""
+import argparse
+import random
+import time
+
+from sqlalchemy import create_engine, delete, insert
+
+from db_control import mymodels
+from db_control.connect import DATABASE_URL
+
+# 税マスタ（標準税率・軽減税率）
+TAXES = [
+    {"ID": 1, "CODE": "10", "NAME": "標準税率", "PERCENT": 0.10},
+    {"ID": 2, "CODE": "08", "NAME": "軽減税率", "PERCENT": 0.08},
+]
+
+# 販促マスタ（セット販売を先に適用し、残りをよりどりで組む）
+PROMOTIONS = [
+    {"PROMO_ID": 1, "NAME": "セット割", "PROMO_TYPE": "bundle", "REQ_QTY": None, "PROMO_PRICE": 300, "PRIORITY": 0},
+    {"PROMO_ID": 2, "NAME": "よりどり3点1000円", "PROMO_TYPE": "mix_match", "REQ_QTY": 3, "PROMO_PRICE": 1000, "PRIORITY": 1},
+]
+
+PRODUCT_NAMES = ["おにぎり", "お茶", "コーヒー", "パン", "弁当", "牛乳", "チョコレート", "ポテトチップス", "ヨーグルト", "サンドイッチ"]
+
+
+def product_code(i):  # JAN(13桁)風の商品コード。load_test.py も同じ規則でコードを作る
+    return f"49{i:011d}"
+
+
+def product_rows(count, seed=0):
+    rnd = random.Random(seed)
+    for i in range(1, count + 1):
+        yield {
+            "PRD_ID": i,
+            "CODE": product_code(i),
+            "NAME": f"{rnd.choice(PRODUCT_NAMES)}{i}",
+            "PRICE": rnd.randrange(80, 1500, 10),
+        }
+
+
+def promotion_item_rows(products):  # セット割は商品1・2、よりどりは先頭1000商品が対象
+    yield {"PROMO_ID": 1, "PRD_CODE": product_code(1), "QTY": 1}
+    yield {"PROMO_ID": 1, "PRD_CODE": product_code(2), "QTY": 1}
+    for i in range(1, min(products, 1000) + 1):
+        yield {"PROMO_ID": 2, "PRD_CODE": product_code(i), "QTY": 1}
+
+
+def seed(url, products, batch_size=5000):
+    engine = create_engine(url)
+    mymodels.Base.metadata.create_all(engine)
+    started = time.perf_counter()
+    with engine.begin() as conn:
+        # 既存データを消してから投入する（集計 → 明細・冪等キー → 取引 → マスタの順）
+        for model in (mymodels.SalesHourly, mymodels.SalesProductDaily, mymodels.ReportWatermark,
+                      mymodels.TransactionDetail, mymodels.TransactionIdempotency, mymodels.Transaction,
+                      mymodels.PromotionItem, mymodels.Promotion, mymodels.Product, mymodels.Tax):
+            conn.execute(delete(model))
+        conn.execute(insert(mymodels.Tax), TAXES)
+        conn.execute(insert(mymodels.Promotion), PROMOTIONS)
+        conn.execute(insert(mymodels.PromotionItem), list(promotion_item_rows(products)))
+        batch = []
+        for row in product_rows(products):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                conn.execute(insert(mymodels.Product), batch)
+                batch = []
+        if batch:
+            conn.execute(insert(mymodels.Product), batch)
+    engine.dispose()
+    print(f"商品 {products}件・税率 {len(TAXES)}件・販促 {len(PROMOTIONS)}件を投入しました ({time.perf_counter() - started:.1f}s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ベンチマーク用の商品マスタ・税マスタを投入する")
+    parser.add_argument("--products", type=int, default=50000)
+    args = parser.parse_args()
+    seed(DATABASE_URL, args.products)
@@ -0,0 +1,65 @@
+import os
+import threading
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+
+from db_control import mymodels
+
+# 版数を共有するキャッシュ（cache_version_horie の NAME）
+PRODUCT = "product"
+TAX = "tax"
+PROMOTION = "promotion"
+NAMES = (PRODUCT, TAX, PROMOTION)
+
+
+class CacheVersions:
+    """ワーカー（プロセス）間でキャッシュの無効化・再読み込みを伝える共有の版数。
+
+    商品・税・販促のキャッシュはワーカーごとのメモリにあるため、無効化・再読み込みを受け付けたワーカーが
+    cache_version_horie の版数を上げ、他のワーカーは interval 秒ごとに版数を確認して、上がっていれば読み直す。
+    """
+
+    def __init__(self, interval=2.0):
+        self.interval = interval  # 0 以下なら共有しない（ワーカーが1つの場合など）
+        self._seen = None  # NAME -> 最後に確認した版数（None は未確認）
+        self._lock = threading.Lock()  # 確認と版数の更新は別々のスレッドから呼ばれる
+
+    @classmethod
+    def from_env(cls):  # 環境変数から設定を読み込む
+        return cls(interval=float(os.getenv("CACHE_SYNC_SECONDS", "2")))
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def disable(self):
+        self.interval = 0
+
+    def bump(self, db, name):  # 版数を1つ上げ、新しい版数を返す（行がなければ作る）
+        table = mymodels.CacheVersion
+        for _ in range(2):
+            if db.execute(update(table).where(table.NAME == name).values(VERSION=table.VERSION + 1)).rowcount:
+                break
+            try:
+                db.add(table(NAME=name, VERSION=1))
+                db.flush()
+                break
+            except IntegrityError:
+                db.rollback()  # 他のワーカーが同時に行を作った（次は UPDATE できる）
+        version = db.query(table.VERSION).filter(table.NAME == name).scalar()
+        db.commit()
+        # 自分が上げた分は読み直さない（確認していない他のワーカーの変更が挟まっている場合は次の確認で読み直す）
+        with self._lock:
+            if self._seen is not None and self._seen.get(name, 0) == version - 1:
+                self._seen[name] = version
+        return version
+
+    def changed(self, db):  # 前回の確認以降に版数が上がった名前の一覧（初回は現在の版数を記録するだけ）
+        versions = dict(db.query(mymodels.CacheVersion.NAME, mymodels.CacheVersion.VERSION).all())
+        db.commit()  # 次の確認で最新の版数を読むよう、読み取り用のトランザクションを閉じる
+        with self._lock:
+            seen, self._seen = self._seen, versions
+        if seen is None:
+            return []
+        return [name for name in NAMES if versions.get(name, 0) != seen.get(name, 0)]
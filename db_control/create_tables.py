@@ -1,29 +1,19 @@
-from mymodels import Base
-from connect import AzureDBConnection
-from sqlalchemy import inspect
+import os
+
+from alembic import command
+from alembic.config import Config
+
+# テーブルの作成・変更は migrations/ のマイグレーションで管理する（alembic upgrade head と同じ処理）
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "alembic.ini")
 
 
 def init_db():
-    # データベース接続を確立
-    db_connection = AzureDBConnection()
-    engine = db_connection.connect()
-    
-    
+    # 未適用のマイグレーションを最新まで適用（既存のテーブルはそのまま）
     try:
-        inspector = inspect(engine)
-        existing_tables = inspector.get_table_names()
-
-        print("既存のテーブルを確認しています...")
-        if "transaction_horie" not in existing_tables or "transaction_detail_horie" not in existing_tables:
-            print("テーブルを作成しています...")
-            Base.metadata.create_all(bind=engine)
-            print("テーブルの作成が完了しました！")
-        else:
-            print("すべてのテーブルが既に存在しています。")
+        command.upgrade(Config(ALEMBIC_INI), "head")
+        print("マイグレーションの適用が完了しました！")
     except Exception as e:
         print(f"エラーが発生しました: {e}")
-    finally:
-        db_connection.close()
 
 
 if __name__ == "__main__":
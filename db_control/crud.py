@@ -1,27 +1,53 @@
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import insert
-from db_control.mymodels import TransactionDetail
+from sqlalchemy import insert, inspect
+from db_control.mymodels import Transaction, TransactionDetail
 from db_control.connect import AzureDBConnection
 
-# transaction_detail_horieテーブルに商品名と単価を挿入する関数
-def add_transaction_detail(data):
-    db_connection = AzureDBConnection()
-    engine = db_connection.create_engine()
-    Session = sessionmaker(bind=engine)
-    session = Session()
+# 書き込み系の関数は呼び出し側のセッションを使い、コミットも呼び出し側でまとめて行う（1つの作業単位）。
+# 採番されたキーは INSERT 自体の結果（cursor.lastrowid）から取得し、再SELECTは行わない。
 
-    try:
-        query = insert(TransactionDetail).values(data)
+# transaction_horieテーブルに取引を挿入し、採番された TRD_ID を返す関数
+def add_transaction(session, data):
+    result = session.execute(insert(Transaction).values(data))
+    return result.inserted_primary_key[0]
 
-        with session.begin():
-            session.execute(query)
-        print("データが正常に挿入されました。")
-    except Exception as e:
-        print(f"データ挿入中にエラーが発生しました: {e}")
-        session.rollback()
-    finally:
-        session.close()
-        db_connection.close()
+# transaction_detail_horieテーブルに商品名と単価を挿入し、採番された DTL_ID を返す関数
+def add_transaction_detail(session, data):
+    result = session.execute(insert(TransactionDetail).values(data))
+    return result.inserted_primary_key[0]
+
+# transaction_detail_horieテーブルに複数明細を一括挿入し、採番された DTL_ID のリストを返す関数
+def add_transaction_details(session, rows):
+    if not rows:
+        return []
+    stmt = insert(TransactionDetail)
+    if session.get_bind().dialect.insert_executemany_returning:
+        # RETURNING に対応したDB（MariaDB・SQLite など）は INSERT の結果から採番値を受け取る
+        return list(session.scalars(stmt.returning(TransactionDetail.DTL_ID, sort_by_parameter_order=True), rows))
+    # MySQL は executemany で RETURNING を使えないため、挿入後に取引単位で1回だけ取得する
+    session.execute(stmt, rows)
+    return list(session.scalars(
+        TransactionDetail.__table__.select()
+        .with_only_columns(TransactionDetail.DTL_ID)
+        .where(TransactionDetail.TRD_ID == rows[0]["TRD_ID"])
+        .order_by(TransactionDetail.DTL_ID)
+    ))
+
+# transaction_detail_horieテーブルに複数明細を executemany で挿入する（採番値は取得しない。write-behind の一括書き込み用）
+def insert_transaction_details(session, rows):
+    if rows:
+        session.execute(insert(TransactionDetail), rows)
+
+# 取引明細 → 取引の外部キー制約が有効かを返す関数（月別パーティション化した MySQL では外部キーがない）
+# 宣言されていても検査されない場合（SQLite の PRAGMA foreign_keys=OFF、MySQL の foreign_key_checks=0）は False
+def has_transaction_foreign_key(session):
+    connection = session.connection()
+    if connection.dialect.name == "sqlite" and not connection.exec_driver_sql("PRAGMA foreign_keys").scalar():
+        return False
+    if connection.dialect.name == "mysql" and not connection.exec_driver_sql("SELECT @@foreign_key_checks").scalar():
+        return False
+    foreign_keys = inspect(connection).get_foreign_keys(TransactionDetail.__tablename__)
+    return any(foreign_key["referred_table"] == Transaction.__tablename__ for foreign_key in foreign_keys)
 
 # テスト用に固定データで処理が正しく動作するかを確認する
 if __name__ == "__main__":
@@ -30,9 +56,17 @@ if __name__ == "__main__":
         "PRD_ID": 101,  # 商品ID
         "PRD_CODE": "4987035535409",  # 商品コード
         "PRD_NAME": "ポカリスエット",  # 商品名
-        "PRD_PRICE": 170  # 商品単価
+        "PRD_PRICE": 170,  # 商品単価
+        "TAX_CD": "10",  # 消費税区分
     }
-    add_transaction_detail(data)
-
-
-
+    db_connection = AzureDBConnection()
+    session = sessionmaker(bind=db_connection.connect())()
+    try:
+        with session.begin():
+            dtl_id = add_transaction_detail(session, data)
+        print(f"データが正常に挿入されました。DTL_ID={dtl_id}")
+    except Exception as e:
+        print(f"データ挿入中にエラーが発生しました: {e}")
+    finally:
+        session.close()
+        db_connection.close()
@@ -0,0 +1,268 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+
+from sqlalchemy.exc import DataError, IntegrityError
+
+try:
+    import fcntl  # ジャーナルの排他ロック（Linux のみ。Windows の開発環境ではロックしない）
+except ImportError:
+    fcntl = None
+
+
+class DetailQueueFullError(Exception):
+    """キューが満杯のまま enqueue_timeout を過ぎた（呼び出し側は 503 を返す）"""
+
+
+class DetailQueueClosedError(Exception):
+    """停止処理中のため受け付けられない"""
+
+
+class DetailJournal:
+    """受け付けた明細を追記していくジャーナルファイル。
+
+    - 明細は {"seq": 番号, "row": {...}}、書き込み済みの位置は {"done": 番号} の行で記録する
+    - ワーカーごとに detail-0.journal, detail-1.journal ... のうちロックできたファイルを使うので、
+      再起動したワーカーは前回の未書き込み分を引き継ぐ
+    """
+
+    def __init__(self, directory, fsync=False):
+        self.directory = directory
+        self.fsync = fsync
+        self.path = None
+        self._file = None
+
+    def open(self):  # ロックできたジャーナルを開き、未書き込みの明細 [(seq, row)] を返す
+        os.makedirs(self.directory, exist_ok=True)
+        slot = 0
+        while True:
+            path = os.path.join(self.directory, f"detail-{slot}.journal")
+            f = open(path, "a+", encoding="utf-8")
+            if fcntl is None:
+                break
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                f.close()
+                slot += 1
+        self.path = path
+        self._file = f
+
+        f.seek(0)
+        pending = {}
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # 書き込み途中で落ちた最終行は捨てる
+            if "done" in record:
+                for seq in [seq for seq in pending if seq <= record["done"]]:
+                    del pending[seq]
+            else:
+                pending[record["seq"]] = record["row"]
+        return sorted(pending.items())
+
+    def append(self, seq, row):
+        self._write({"seq": seq, "row": row})
+
+    def mark_done(self, seq):
+        self._write({"done": seq})
+
+    def truncate(self):  # 全件書き込み済みになったら中身を捨てる
+        self._file.truncate(0)
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+
+class DetailWriteQueue:
+    """取引明細の INSERT をまとめてコミットする write-behind キュー。
+
+    - enqueue() はジャーナルに追記してキューに積み、DBへの書き込みを待たずに返る
+    - キューが max_size 件に達したら enqueue_timeout 秒まで空きを待ち、それでも空かなければ DetailQueueFullError
+    - フラッシャーが batch_size 件または interval 秒ごとに write(rows)（executemany + コミット1回）を呼ぶ
+    - 接続エラーは書き込めていない行から再試行し（間隔は retry_max_seconds まで倍々に延ばす）、
+      データ不正のバッチは1件ずつ書き込んで不正な行だけ捨てる
+    - フラッシャーが想定外の例外で止まらないよう、バッチ単位で例外を記録して処理を続ける
+    """
+
+    def __init__(self, write, journal, max_size=10000, batch_size=200, interval=0.005,
+                 enqueue_timeout=0.5, retry_seconds=1.0, retry_max_seconds=30.0, shutdown_timeout=10.0):
+        self.write = write  # async def write(rows): 明細を挿入してコミットする
+        self.journal = journal
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self.enqueue_timeout = enqueue_timeout
+        self.retry_seconds = retry_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.shutdown_timeout = shutdown_timeout
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(max_size)  # 未書き込み（フラッシュ中を含む）の件数の上限
+        self._seq = 0
+        self._pending = collections.Counter()  # TRD_ID -> 未書き込み（フラッシュ中を含む）の明細数
+        self._task = None
+        self._closing = False
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.batches = 0
+        self.retries = 0
+        self.failures = 0
+        self.last_error = None
+
+    @classmethod
+    def from_env(cls, write):  # 環境変数から設定を読み込む
+        return cls(
+            write,
+            DetailJournal(
+                os.getenv("DETAIL_JOURNAL_DIR", "journal"),
+                fsync=os.getenv("DETAIL_JOURNAL_FSYNC", "false").lower() == "true",
+            ),
+            max_size=int(os.getenv("DETAIL_QUEUE_MAX_SIZE", "10000")),
+            batch_size=int(os.getenv("DETAIL_FLUSH_BATCH_SIZE", "200")),
+            interval=float(os.getenv("DETAIL_FLUSH_INTERVAL_MS", "5")) / 1000,
+            enqueue_timeout=float(os.getenv("DETAIL_ENQUEUE_TIMEOUT", "0.5")),
+            retry_seconds=float(os.getenv("DETAIL_RETRY_SECONDS", "1")),
+            retry_max_seconds=float(os.getenv("DETAIL_RETRY_MAX_SECONDS", "30")),
+            shutdown_timeout=float(os.getenv("DETAIL_SHUTDOWN_TIMEOUT", "10")),
+        )
+
+    async def start(self):  # ジャーナルに残った明細を書き込んでからフラッシャーを起動する
+        pending = self.journal.open()
+        if pending:
+            logging.warning(f"前回停止時に未書き込みだった明細をジャーナルから再投入します: {len(pending)}件")
+            self._seq = pending[-1][0]
+            for i in range(0, len(pending), self.batch_size):
+                await self._flush(pending[i:i + self.batch_size])
+        self.journal.truncate()
+        self._task = asyncio.create_task(self._run())
+        self._task.add_done_callback(self._on_stopped)
+
+    def _on_stopped(self, task):  # フラッシャーが停止処理以外で止まった場合は必ずログに残す
+        if not task.cancelled() and task.exception() is not None:
+            logging.critical("明細キューのフラッシャーが停止しました", exc_info=task.exception())
+
+    @property
+    def running(self):  # フラッシャーが動いているか（止まっていれば受け付けても書き込まれない）
+        return self._task is not None and not self._task.done()
+
+    async def enqueue(self, row):  # 明細を受け付け、ジャーナル上の番号を返す
+        if self._closing or not self.running:
+            raise DetailQueueClosedError()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise DetailQueueFullError()
+        self._seq += 1
+        self.journal.append(self._seq, row)
+        self._pending[row["TRD_ID"]] += 1
+        self._queue.put_nowait((self._seq, row))
+        self.enqueued += 1
+        return self._seq
+
+    async def stop(self):  # 残りを書き込んでから停止する（時間内に終わらなければジャーナルに残して次回起動時に再投入）
+        self._closing = True
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), self.shutdown_timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"明細キューを書き込み切れませんでした。残り{self._queue.qsize()}件は次回起動時に再投入します")
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self.journal.close()
+
+    def oldest_pending_trd_id(self):  # 未書き込みの明細がある最小の取引ID（売上集計はその手前で止める）
+        return min(self._pending) if self._pending else None
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "queued": self._queue.qsize(),
+            "max_size": self.max_size,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "batches": self.batches,
+            "retries": self.retries,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "journal": self.journal.path,
+        }
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            # 後続の明細を少しだけ待って1回のコミットにまとめる
+            if self.interval > 0 and self._queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.interval)
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                # 書き込めなかった明細はジャーナルに残っているので、次回起動時に再投入される
+                self.failures += 1
+                self.last_error = str(e)
+                logging.error(f"明細のフラッシュに失敗しました（{len(batch)}件はジャーナルに残します）: {str(e)}", exc_info=True)
+            finally:
+                for _, row in batch:
+                    self._pending[row["TRD_ID"]] -= 1
+                    if self._pending[row["TRD_ID"]] <= 0:
+                        del self._pending[row["TRD_ID"]]
+                    self._slots.release()
+                    self._queue.task_done()
+
+    async def _flush(self, batch):  # batch: [(seq, row)]
+        rows = [row for _, row in batch]
+        one_by_one = False
+        delay = self.retry_seconds
+        while rows:
+            try:
+                if one_by_one:
+                    await self.write(rows[:1])
+                    self.written += 1
+                    rows = rows[1:]
+                else:
+                    await self.write(rows)
+                    self.written += len(rows)
+                    rows = []
+                delay = self.retry_seconds
+            except (IntegrityError, DataError) as e:
+                if not one_by_one:
+                    # 不正な明細が混ざっている場合は1件ずつ書き込み、失敗した行だけ捨てる
+                    one_by_one = True
+                    continue
+                self.dropped += 1
+                logging.error(f"明細を書き込めないため破棄しました: {rows[0]} ({str(e)})")
+                rows = rows[1:]
+            except Exception as e:
+                # 接続エラーなどは書き込めていない行から再試行する（その間に受け付けた分はキューとジャーナルに溜まる）
+                self.retries += 1
+                self.last_error = str(e)
+                logging.error(f"明細の書き込みに失敗しました。{delay}秒後に再試行します: {str(e)}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.retry_max_seconds)
+        self.batches += 1
+        self.journal.mark_done(batch[-1][0])
+        if self._queue.empty() and self._seq == batch[-1][0]:
+            self.journal.truncate()
@@ -0,0 +1,84 @@
+import csv
+import io
+import json
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import select
+
+from db_control import mymodels
+
+# CSV は明細1行につき1行（取引ヘッダーの項目を各行に繰り返す）
+CSV_COLUMNS = [
+    "TRD_ID", "DATETIME", "EMP_CD", "STORE_CD", "POS_NO", "TOTAL_AMT", "TTL_AMT_EX_TAX",
+    "DTL_ID", "PRD_ID", "PRD_CODE", "PRD_NAME", "PRD_PRICE", "TAX_CD",
+]
+
+_TRANSACTION = mymodels.Transaction.__table__
+_DETAIL = mymodels.TransactionDetail.__table__
+
+
+def fetch_page(db, after_id, page_size, date_from=None, date_to=None, store_cd=None, pos_no=None, before_id=None):
+    """TRD_ID が after_id より大きい（before_id を指定した場合はそれ未満の）取引を page_size 件取得し、明細を付けて返す。
+
+    OFFSET ではなく TRD_ID のキーセットで進めるため、何ページ目でも主キーの範囲検索になる。
+    ORM オブジェクトではなく行データで扱い、セッションにオブジェクトを溜めない。
+    """
+    query = select(_TRANSACTION).where(_TRANSACTION.c.TRD_ID > after_id)
+    if before_id is not None:
+        query = query.where(_TRANSACTION.c.TRD_ID < before_id)
+    if date_from:
+        query = query.where(_TRANSACTION.c.DATETIME >= datetime.combine(date_from, time.min))
+    if date_to:
+        query = query.where(_TRANSACTION.c.DATETIME < datetime.combine(date_to + timedelta(days=1), time.min))
+    if store_cd:
+        query = query.where(_TRANSACTION.c.STORE_CD == store_cd)
+    if pos_no:
+        query = query.where(_TRANSACTION.c.POS_NO == pos_no)
+    transactions = [dict(row) for row in db.execute(query.order_by(_TRANSACTION.c.TRD_ID).limit(page_size)).mappings()]
+    if not transactions:
+        return []
+
+    # ページ内の全取引の明細を1回のクエリで取得
+    details = {}
+    detail_query = select(_DETAIL).where(
+        _DETAIL.c.TRD_ID.in_([transaction["TRD_ID"] for transaction in transactions])
+    ).order_by(_DETAIL.c.TRD_ID, _DETAIL.c.DTL_ID)
+    for row in db.execute(detail_query).mappings():
+        details.setdefault(row["TRD_ID"], []).append(dict(row))
+    for transaction in transactions:
+        transaction["details"] = details.get(transaction["TRD_ID"], [])
+    db.commit()  # ページごとに読み取りトランザクションを閉じる
+    return transactions
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return str(value)
+
+
+def to_ndjson(transactions):  # schemas.TransactionWithDetails と同じ形の NDJSON
+    return "".join(
+        json.dumps(transaction, ensure_ascii=False, default=_json_default) + "\n"
+        for transaction in transactions
+    )
+
+
+def csv_header():
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(CSV_COLUMNS)
+    return buffer.getvalue()
+
+
+def to_csv(transactions):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for transaction in transactions:
+        header = [transaction[column] for column in CSV_COLUMNS[:7]]
+        if isinstance(header[1], datetime):
+            header[1] = header[1].strftime("%Y-%m-%d %H:%M:%S")
+        if not transaction["details"]:
+            writer.writerow(header + [""] * (len(CSV_COLUMNS) - 7))
+        for detail in transaction["details"]:
+            writer.writerow(header + [detail[column] for column in CSV_COLUMNS[7:]])
+    return buffer.getvalue()
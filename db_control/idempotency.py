@@ -0,0 +1,35 @@
+from db_control import mymodels, schemas
+
+
+def find_transaction_ids(db, keys, latest=False):  # 登録済みの冪等キーを IN 句1回で検索し、キー -> TRD_ID を返す
+    keys = [key for key in dict.fromkeys(keys) if key]
+    if not keys:
+        return {}
+    query = db.query(mymodels.TransactionIdempotency).filter(
+        mymodels.TransactionIdempotency.IDEMPOTENCY_KEY.in_(keys)
+    )
+    if latest:
+        # 共有ロックで読み、トランザクションの開始後に他の接続がコミットしたキーも見る（MySQL の REPEATABLE READ 対策）
+        query = query.with_for_update(read=True)
+    rows = query.all()
+    return {row.IDEMPOTENCY_KEY: row.TRD_ID for row in rows}
+
+
+def record(db, key, trd_id):  # 冪等キーを取引と同じトランザクションで登録（重複時は flush で IntegrityError）
+    db.add(mymodels.TransactionIdempotency(IDEMPOTENCY_KEY=key, TRD_ID=trd_id))
+    db.flush()
+
+
+def replay_transaction(db, key, with_details=False):  # 登録済みのキーなら保存済みの取引を返す。未登録なら None
+    trd_id = find_transaction_ids(db, [key]).get(key)
+    if trd_id is None:
+        return None
+    transaction = db.get(mymodels.Transaction, trd_id)
+    if not with_details:
+        return schemas.Transaction.model_validate(transaction)
+    details = db.query(mymodels.TransactionDetail).filter(
+        mymodels.TransactionDetail.TRD_ID == trd_id
+    ).order_by(mymodels.TransactionDetail.DTL_ID).all()
+    result = schemas.TransactionWithDetails.model_validate(transaction)
+    result.details = [schemas.TransactionDetail.model_validate(detail) for detail in details]
+    return result
@@ -0,0 +1,155 @@
+import threading
+import time
+import weakref
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+# レイテンシ計測用のヒストグラムのバケット（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# リクエスト単位のDBクエリ数・DB時間（ミドルウェアで設定し、エンジンのイベントで加算する）
+_request_db_stats = ContextVar("request_db_stats", default=None)
+
+
+class _RequestDBStats:
+    __slots__ = ("queries", "seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.total += value
+        self.count += 1
+
+
+def _format_labels(labels):
+    return ",".join(f'{name}="{value}"' for name, value in labels)
+
+
+class Metrics:
+    """ルート別のレイテンシ・ステータス・実行中リクエスト数・DBクエリ数を集計し、Prometheus 形式で出力する"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.requests = {}  # (method, route, status) -> 件数
+        self.latency = {}  # (method, route) -> Histogram
+        self.db_time = {}  # (method, route) -> Histogram
+        self.db_queries = {}  # (method, route) -> クエリ数
+        self.pool_status = None  # プール統計を返す関数（AzureDBConnection.pool_status）
+        self._engines = weakref.WeakSet()  # 計測を設定済みのエンジン
+
+    def instrument_engine(self, engine):  # エンジンのイベントでクエリ数・DB時間を計測する
+        if engine in self._engines:
+            return
+        self._engines.add(engine)
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            started = conn.info["query_start"].pop()
+            stats = _request_db_stats.get()
+            if stats is not None:
+                stats.queries += 1
+                stats.seconds += time.perf_counter() - started
+
+    def record(self, method, route, status, elapsed, db_stats):
+        key = (method, route)
+        with self._lock:
+            self.requests[(method, route, status)] = self.requests.get((method, route, status), 0) + 1
+            self.latency.setdefault(key, Histogram()).observe(elapsed)
+            self.db_time.setdefault(key, Histogram()).observe(db_stats.seconds)
+            self.db_queries[key] = self.db_queries.get(key, 0) + db_stats.queries
+
+    def render(self):  # Prometheus テキスト形式で出力
+        lines = []
+        with self._lock:
+            lines.append("# TYPE pos_http_requests_in_flight gauge")
+            lines.append(f"pos_http_requests_in_flight {self.in_flight}")
+
+            lines.append("# TYPE pos_http_requests_total counter")
+            for (method, route, status), count in sorted(self.requests.items()):
+                labels = _format_labels((("method", method), ("route", route), ("status", status)))
+                lines.append(f"pos_http_requests_total{{{labels}}} {count}")
+
+            for name, histograms in (("pos_http_request_duration_seconds", self.latency),
+                                     ("pos_db_time_per_request_seconds", self.db_time)):
+                lines.append(f"# TYPE {name} histogram")
+                for (method, route), histogram in sorted(histograms.items()):
+                    labels = _format_labels((("method", method), ("route", route)))
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                    lines.append(f"{name}_sum{{{labels}}} {histogram.total}")
+                    lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+
+            lines.append("# TYPE pos_db_queries_total counter")
+            for (method, route), count in sorted(self.db_queries.items()):
+                labels = _format_labels((("method", method), ("route", route)))
+                lines.append(f"pos_db_queries_total{{{labels}}} {count}")
+
+        pool = self.pool_status() if self.pool_status else None
+        if pool:
+            lines.append("# TYPE pos_db_pool_checked_out gauge")
+            lines.append(f"pos_db_pool_checked_out {pool['checked_out']}")
+            lines.append("# TYPE pos_db_pool_overflow gauge")
+            lines.append(f"pos_db_pool_overflow {pool['overflow']}")
+            lines.append("# TYPE pos_db_pool_wait_seconds_total counter")
+            lines.append(f"pos_db_pool_wait_seconds_total {pool['wait_total_ms'] / 1000}")
+            lines.append("# TYPE pos_db_pool_wait_total counter")
+            lines.append(f"pos_db_pool_wait_total {pool['wait_count']}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """ASGI ミドルウェア。ルートのパステンプレート（/products/{code} など）単位で計測する"""
+
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        db_stats = _RequestDBStats()
+        token = _request_db_stats.set(db_stats)
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        self.metrics.in_flight += 1
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.metrics.in_flight -= 1
+            _request_db_stats.reset(token)
+            route = scope.get("route")
+            route_path = route.path if route is not None else "unmatched"  # 未定義パスでラベルが増え続けないように
+            self.metrics.record(scope["method"], route_path, status, elapsed, db_stats)
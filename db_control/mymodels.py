@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, ForeignKey, DateTime, TIMESTAMP, DECIMAL
+from sqlalchemy import Column, String, Integer, BigInteger, ForeignKey, Index, Date, DateTime, TIMESTAMP, DECIMAL
 from sqlalchemy.orm import DeclarativeBase, relationship
 from sqlalchemy.sql import func
 
@@ -17,8 +17,12 @@ class Product(Base):
     transaction_details = relationship("TransactionDetail", back_populates="product")
 
 # 取引
+# MySQL では TRD_ID の範囲で月別にパーティション化する（db_control/partitions.py、migrations/versions/0003）
 class Transaction(Base):
     __tablename__ = "transaction_horie"
+    __table_args__ = (
+        Index("ix_transaction_store_datetime", "STORE_CD", "DATETIME"),  # 店舗・期間の検索（TRD_ID まで索引だけで返す）
+    )
     TRD_ID = Column(Integer, primary_key=True, autoincrement=True, comment="Primary Key")
     DATETIME = Column(TIMESTAMP, server_default=func.current_timestamp(), comment="TRANSACTION_DATETIME")
     EMP_CD = Column(String(10), nullable=False, comment="レジ担当")
@@ -28,11 +32,15 @@ class Transaction(Base):
     TTL_AMT_EX_TAX = Column(Integer, nullable=False, comment="合計金額（税抜き）")
 
     # リレーションを定義する
-    transaction_details = relationship("TransactionDetail", back_populates="transaction")
+    transaction_details = relationship("TransactionDetail", back_populates="transaction", order_by="TransactionDetail.DTL_ID")
 
 # 取引明細
+# パーティション化した MySQL では外部キー制約を外し、主キーは (DTL_ID, TRD_ID) になる（ForeignKey はリレーション用に残す）
 class TransactionDetail(Base):
     __tablename__ = "transaction_detail_horie"
+    __table_args__ = (
+        Index("ix_transaction_detail_trd_dtl", "TRD_ID", "DTL_ID"),  # 取引ごとの明細を DTL_ID 順に索引だけで返す
+    )
     TRD_ID = Column(Integer, ForeignKey("transaction_horie.TRD_ID"), nullable=False, comment="取引キー")
     DTL_ID = Column(Integer, primary_key=True, autoincrement=True, comment="取引明細キー")
     PRD_ID = Column(Integer, ForeignKey("m_product_horie.PRD_ID"), nullable=False, comment="商品キー")
@@ -52,3 +60,62 @@ class Tax(Base):
     CODE = Column(String(2), unique=True, nullable=False, comment="税率コード")
     NAME = Column(String(20), nullable=False, comment="税率名称")
     PERCENT = Column(DECIMAL(5,2), nullable=False, comment="税率(%)")
+
+# 冪等キー（通信断でレジが再送しても取引を二重登録しないためのキー）
+class TransactionIdempotency(Base):
+    __tablename__ = "transaction_idempotency_horie"
+    IDEMPOTENCY_KEY = Column(String(64), primary_key=True, comment="冪等キー（UUID または 店舗-POS-連番）")
+    TRD_ID = Column(Integer, ForeignKey("transaction_horie.TRD_ID"), nullable=False, comment="取引キー")
+    CREATED_AT = Column(TIMESTAMP, server_default=func.current_timestamp(), comment="登録日時")
+
+# 時間帯別売上集計（店舗・POS・時間単位。日別/店舗別はここから合算する）
+class SalesHourly(Base):
+    __tablename__ = "sales_hourly_horie"
+    SALES_DATE = Column(Date, primary_key=True, comment="売上日")
+    SALES_HOUR = Column(Integer, primary_key=True, comment="時間帯(0-23)")
+    STORE_CD = Column(String(5), primary_key=True, comment="store code")
+    POS_NO = Column(String(3), primary_key=True, comment="POS機ID")
+    TRD_COUNT = Column(Integer, nullable=False, default=0, comment="取引件数")
+    TOTAL_AMT = Column(BigInteger, nullable=False, default=0, comment="売上合計")
+    TTL_AMT_EX_TAX = Column(BigInteger, nullable=False, default=0, comment="売上合計（税抜き）")
+
+# 商品別日次売上集計
+class SalesProductDaily(Base):
+    __tablename__ = "sales_product_daily_horie"
+    SALES_DATE = Column(Date, primary_key=True, comment="売上日")
+    STORE_CD = Column(String(5), primary_key=True, comment="store code")
+    PRD_CODE = Column(String(13), primary_key=True, comment="商品コード")
+    PRD_NAME = Column(String(50), nullable=False, comment="商品名")
+    QTY = Column(Integer, nullable=False, default=0, comment="販売点数")
+    AMOUNT = Column(BigInteger, nullable=False, default=0, comment="売上金額")
+
+# 集計済みの最終ID（集計テーブルごとのウォーターマーク）
+class ReportWatermark(Base):
+    __tablename__ = "report_watermark_horie"
+    NAME = Column(String(50), primary_key=True, comment="集計名")
+    LAST_ID = Column(BigInteger, nullable=False, default=0, comment="集計済みの最終ID")
+
+# 販促マスタ（まとめ売り・セット販売）
+class Promotion(Base):
+    __tablename__ = "m_promotion_horie"
+    PROMO_ID = Column(Integer, primary_key=True, comment="販促ID")
+    NAME = Column(String(50), nullable=False, comment="販促名（レシート表示用）")
+    PROMO_TYPE = Column(String(10), nullable=False, comment="mix_match: 対象商品から REQ_QTY 点で PROMO_PRICE / bundle: 対象商品を QTY 点ずつ揃えて PROMO_PRICE")
+    REQ_QTY = Column(Integer, nullable=True, comment="まとめ売りの点数（mix_match のみ）")
+    PROMO_PRICE = Column(Integer, nullable=False, comment="1組あたりの販売価格（税込）")
+    PRIORITY = Column(Integer, nullable=False, default=0, comment="適用順（小さいほど先に適用）")
+    START_AT = Column(DateTime, nullable=True, comment="開始日時（NULL は制限なし）")
+    END_AT = Column(DateTime, nullable=True, comment="終了日時（NULL は制限なし）")
+
+# 販促の対象商品
+class PromotionItem(Base):
+    __tablename__ = "m_promotion_item_horie"
+    PROMO_ID = Column(Integer, ForeignKey("m_promotion_horie.PROMO_ID"), primary_key=True, comment="販促ID")
+    PRD_CODE = Column(String(13), primary_key=True, comment="対象商品コード")
+    QTY = Column(Integer, nullable=False, default=1, comment="1組に必要な点数（bundle のみ）")
+
+# キャッシュの版数（ワーカー間でキャッシュの無効化・再読み込みを伝える。db_control/cache_sync.py）
+class CacheVersion(Base):
+    __tablename__ = "cache_version_horie"
+    NAME = Column(String(20), primary_key=True, comment="キャッシュ名（product / tax / promotion）")
+    VERSION = Column(BigInteger, nullable=False, default=0, comment="版数（無効化・再読み込みのたびに1つ上げる）")
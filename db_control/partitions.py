@@ -0,0 +1,280 @@
+"""取引テーブル（transaction_horie / transaction_detail_horie）の月別パーティション管理（MySQL のみ）
+
+- 両テーブルとも TRD_ID の範囲で月ごとに分割する（p202610 = 2026年10月に採番された取引）。
+  明細は取引と同じ境界を使うので、TRD_ID での検索・集計・エクスポートは1つのパーティションだけを読む
+- 月の境界は TRD_ID で決まるため、月初に AUTO_INCREMENT を今月のパーティションの先頭まで進める（TRD_ID は月境界で飛ぶ）
+- 先の月のパーティションは空の pmax を分割して作るので、データのコピーは発生しない
+- 保存期間を過ぎたパーティションは gzip 圧縮した NDJSON に書き出してから削除する
+
+定期実行（1日1回程度。何度実行しても同じ結果になる）:
+    python -m db_control.partitions maintain
+    python -m db_control.partitions archive --dir /mnt/archive
+    python -m db_control.partitions status
+"""
+import argparse
+import gzip
+import logging
+import os
+from datetime import date, datetime
+
+import pytz
+from sqlalchemy import inspect, text
+from sqlalchemy.orm import sessionmaker
+
+from db_control import export
+from db_control.reports import HOURLY_WATERMARK, PRODUCT_WATERMARK
+
+TRANSACTION_TABLE = "transaction_horie"
+DETAIL_TABLE = "transaction_detail_horie"
+PARTITIONED_TABLES = (TRANSACTION_TABLE, DETAIL_TABLE)
+MAXVALUE_PARTITION = "pmax"
+
+# 何か月先までパーティションを作っておくか
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "2"))
+# オンラインで保持する月数（これより古いパーティションは archive で書き出して削除する）
+PARTITION_RETENTION_MONTHS = int(os.getenv("PARTITION_RETENTION_MONTHS", "25"))
+# 1か月分の TRD_ID の幅の下限（直近の月間件数の2倍とこの値の大きい方を使う）
+PARTITION_MIN_HEADROOM = int(os.getenv("PARTITION_MIN_HEADROOM", "1000000"))
+TRANSACTION_ARCHIVE_DIR = os.getenv("TRANSACTION_ARCHIVE_DIR", "archive")
+ARCHIVE_PAGE_SIZE = 5000
+
+
+def partition_name(month):
+    return f"p{month:%Y%m}"
+
+
+def partition_month(name):
+    return date(int(name[1:5]), int(name[5:7]), 1)
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def current_month():  # 取引日時と同じく日本時間で判定する
+    return datetime.now(pytz.timezone("Asia/Tokyo")).date().replace(day=1)
+
+
+def list_partitions(db, table):  # [(パーティション名, 上限の TRD_ID（MAXVALUE は None）, 推定行数)]
+    rows = db.execute(text("""
+        SELECT PARTITION_NAME, PARTITION_DESCRIPTION, TABLE_ROWS
+        FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION
+    """), {"table": table})
+    return [(name, None if bound == "MAXVALUE" else int(bound), rows or 0) for name, bound, rows in rows]
+
+
+def partition_clause(bounds):  # bounds: [(月, 上限の TRD_ID)]（昇順）
+    partitions = [f"PARTITION {partition_name(month)} VALUES LESS THAN ({upper})" for month, upper in bounds]
+    partitions.append(f"PARTITION {MAXVALUE_PARTITION} VALUES LESS THAN MAXVALUE")
+    return "PARTITION BY RANGE (TRD_ID) (\n    " + ",\n    ".join(partitions) + "\n)"
+
+
+def headroom(monthly_counts):  # 1か月分の TRD_ID の幅（直近3か月の最大件数の2倍）
+    return max([PARTITION_MIN_HEADROOM] + [count * 2 for count in monthly_counts[-3:]])
+
+
+def initial_bounds(db, today=None):
+    """既存の取引から月ごとの境界を決める（パーティション化するときに1回だけ使う）。
+
+    過去の月は「翌月の最初の TRD_ID」を上限にし、今月以降は headroom() ずつ幅を取る。
+    """
+    today = today or current_month()
+    rows = db.execute(text(f"""
+        SELECT DATE_FORMAT(DATETIME, '%Y-%m-01') AS month, MIN(TRD_ID), MAX(TRD_ID), COUNT(*)
+        FROM {TRANSACTION_TABLE}
+        WHERE DATETIME IS NOT NULL
+        GROUP BY month
+        ORDER BY month
+    """)).all()
+    months = [(date.fromisoformat(month), low, high, count) for month, low, high, count in rows]
+    past = [row for row in months if row[0] < today]
+    max_id = db.execute(text(f"SELECT COALESCE(MAX(TRD_ID), 0) FROM {TRANSACTION_TABLE}")).scalar()
+    width = headroom([count for _, _, _, count in months])
+
+    bounds = []
+    for i, (month, _, high, _) in enumerate(past):
+        upper = past[i + 1][1] if i + 1 < len(past) else high + 1
+        if i + 1 == len(past) and len(months) > len(past):
+            upper = months[len(past)][1]  # 今月の最初の取引から今月のパーティションにする
+        bounds.append((month, max(upper, bounds[-1][1] + 1 if bounds else 1)))
+    upper = max(max_id + 1, bounds[-1][1] if bounds else 1) + width
+    bounds.append((today, upper))
+    for months_ahead in range(1, PARTITION_MONTHS_AHEAD + 1):
+        upper += width
+        bounds.append((add_months(today, months_ahead), upper))
+    return bounds
+
+
+def partition_tables(db, bounds):
+    """取引・取引明細テーブルを月別パーティションに変換する（全件コピーが走るのでメンテナンス時間に実行する）。
+
+    MySQL のパーティションテーブルは外部キーを持てず、一意キーには分割キー（TRD_ID）を含める必要があるため、
+    取引を参照する外部キーを外し、明細の主キーを (DTL_ID, TRD_ID) にする。取引の存在はアプリ側で確認する。
+    """
+    inspector = inspect(db.connection())
+    for table in inspector.get_table_names():
+        for foreign_key in inspector.get_foreign_keys(table):
+            if table == DETAIL_TABLE or foreign_key["referred_table"] == TRANSACTION_TABLE:
+                db.execute(text(f"ALTER TABLE {table} DROP FOREIGN KEY {foreign_key['name']}"))
+    db.execute(text(f"ALTER TABLE {DETAIL_TABLE} DROP PRIMARY KEY, ADD PRIMARY KEY (DTL_ID, TRD_ID)"))
+    for table in PARTITIONED_TABLES:
+        db.execute(text(f"ALTER TABLE {table} {partition_clause(bounds)}"))
+    logging.info(f"取引テーブルを月別パーティションに変換しました: {len(bounds)}か月")
+
+
+def _month_partitions(db):  # 取引テーブルの [(月, 下限, 上限)]（pmax は除く）
+    partitions = []
+    lower = 0
+    for name, upper, _ in list_partitions(db, TRANSACTION_TABLE):
+        if upper is None:
+            continue
+        partitions.append((partition_month(name), lower, upper))
+        lower = upper
+    return partitions
+
+
+def maintain(db, today=None):
+    """先の月のパーティションを作り、月が変わっていれば今月のパーティションから採番させる。"""
+    today = today or current_month()
+    partitions = _month_partitions(db)
+    if not partitions:
+        raise RuntimeError(f"{TRANSACTION_TABLE} はパーティション化されていません（alembic upgrade head を実行してください）")
+
+    counts = {name: rows for name, _, rows in list_partitions(db, TRANSACTION_TABLE)}
+    width = headroom([counts[partition_name(month)] for month, _, _ in partitions if month < today])
+    created = []
+    last_month, _, last_upper = partitions[-1]
+    while last_month < add_months(today, PARTITION_MONTHS_AHEAD):
+        last_month = add_months(last_month, 1)
+        lower, last_upper = last_upper, last_upper + width
+        for table in PARTITIONED_TABLES:
+            # pmax は空なのでデータのコピーなしで分割される
+            db.execute(text(
+                f"ALTER TABLE {table} REORGANIZE PARTITION {MAXVALUE_PARTITION} INTO ("
+                f"PARTITION {partition_name(last_month)} VALUES LESS THAN ({last_upper}), "
+                f"PARTITION {MAXVALUE_PARTITION} VALUES LESS THAN MAXVALUE)"
+            ))
+        partitions.append((last_month, lower, last_upper))
+        created.append(partition_name(last_month))
+
+    # 月が変わったら今月のパーティションの先頭から採番する（AUTO_INCREMENT は進めるだけで戻さない）
+    max_id = db.execute(text(f"SELECT COALESCE(MAX(TRD_ID), 0) FROM {TRANSACTION_TABLE}")).scalar()
+    current = next(((lower, upper) for month, lower, upper in partitions if month == today), None)
+    advanced = None
+    if current and max_id + 1 < current[0]:
+        db.execute(text(f"ALTER TABLE {TRANSACTION_TABLE} AUTO_INCREMENT = {current[0]}"))
+        advanced = current[0]
+    elif current and max_id >= current[1]:
+        logging.warning(f"今月の取引が {partition_name(today)} の幅を超え、翌月以降のパーティションに入っています"
+                        f"（PARTITION_MIN_HEADROOM を見直してください）")
+    if counts.get(MAXVALUE_PARTITION):
+        logging.warning(f"{MAXVALUE_PARTITION} に取引が入っています: {counts[MAXVALUE_PARTITION]}件（推定）")
+    return {"created": created, "auto_increment": advanced}
+
+
+def _reported_through(db, upper):  # 売上集計がパーティションの全取引・全明細を集計済みか（どちらも TRD_ID で区切る）
+    watermarks = dict(db.execute(text("SELECT NAME, LAST_ID FROM report_watermark_horie")).all())
+    pending = db.execute(
+        text(f"SELECT COUNT(*) FROM {TRANSACTION_TABLE} WHERE TRD_ID > :watermark AND TRD_ID < :upper"),
+        {"watermark": min(watermarks.get(HOURLY_WATERMARK, 0), watermarks.get(PRODUCT_WATERMARK, 0)), "upper": upper},
+    ).scalar()
+    return pending == 0
+
+
+def archive_partition(db, month, lower, upper, directory):
+    """1か月分の取引を明細付きの NDJSON（/transactions/export と同じ形）で gzip に書き出し、件数を照合してから削除する。"""
+    name = partition_name(month)
+    expected_transactions = db.execute(text(f"SELECT COUNT(*) FROM {TRANSACTION_TABLE} PARTITION ({name})")).scalar()
+    expected_details = db.execute(text(f"SELECT COUNT(*) FROM {DETAIL_TABLE} PARTITION ({name})")).scalar()
+    db.commit()
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"transactions-{name}.ndjson.gz")
+    transactions = details = 0
+    with open(path + ".tmp", "wb") as raw:
+        with gzip.open(raw, "wt", encoding="utf-8") as f:
+            after_id = lower - 1
+            while True:
+                page = export.fetch_page(db, after_id, ARCHIVE_PAGE_SIZE, before_id=upper)
+                if not page:
+                    break
+                f.write(export.to_ndjson(page))
+                transactions += len(page)
+                details += sum(len(transaction["details"]) for transaction in page)
+                after_id = page[-1]["TRD_ID"]
+        raw.flush()
+        os.fsync(raw.fileno())  # 削除する前にディスクへ書き切る
+    if (transactions, details) != (expected_transactions, expected_details):
+        # 取引のない明細などが残っている。削除せずに調査できるよう書き出したファイルも残さない
+        os.remove(path + ".tmp")
+        raise RuntimeError(f"{name}: 書き出した件数が一致しません（取引 {transactions}/{expected_transactions}件,"
+                           f" 明細 {details}/{expected_details}件）")
+    os.replace(path + ".tmp", path)
+
+    # 冪等キーは再送の判定にしか使わないため、取引と一緒に削除する
+    db.execute(
+        text("DELETE FROM transaction_idempotency_horie WHERE TRD_ID >= :lower AND TRD_ID < :upper"),
+        {"lower": lower, "upper": upper},
+    )
+    db.commit()
+    for table in (DETAIL_TABLE, TRANSACTION_TABLE):
+        db.execute(text(f"ALTER TABLE {table} DROP PARTITION {name}"))
+    logging.info(f"{name} をアーカイブしました: {path}（取引 {transactions}件, 明細 {details}件）")
+    return {"partition": name, "path": path, "transactions": transactions, "details": details}
+
+
+def archive(db, directory=TRANSACTION_ARCHIVE_DIR, today=None, require_reports=True):
+    """保存期間（PARTITION_RETENTION_MONTHS）を過ぎたパーティションを古い順に書き出して削除する。"""
+    cutoff = add_months(today or current_month(), -PARTITION_RETENTION_MONTHS)
+    archived = []
+    for month, lower, upper in _month_partitions(db):
+        if month >= cutoff:
+            break
+        if require_reports and not _reported_through(db, upper):
+            logging.warning(f"{partition_name(month)} は売上集計が終わっていないためアーカイブしません")
+            break
+        archived.append(archive_partition(db, month, lower, upper, directory))
+    return archived
+
+
+def status(db):  # パーティションごとの範囲と推定行数
+    details = {name: rows for name, _, rows in list_partitions(db, DETAIL_TABLE)}
+    lower = 0
+    result = []
+    for name, upper, rows in list_partitions(db, TRANSACTION_TABLE):
+        result.append({"partition": name, "from_trd_id": lower, "to_trd_id": upper,
+                       "transactions": rows, "details": details.get(name)})
+        lower = upper
+    return result
+
+
+if __name__ == "__main__":
+    from db_control.connect import AzureDBConnection
+
+    parser = argparse.ArgumentParser(description="取引テーブルの月別パーティションを管理する（MySQL のみ）")
+    parser.add_argument("command", choices=["maintain", "archive", "status"])
+    parser.add_argument("--dir", default=TRANSACTION_ARCHIVE_DIR, help="アーカイブの出力先")
+    parser.add_argument("--ignore-reports", action="store_true", help="売上集計が終わっていなくてもアーカイブする")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    db_connection = AzureDBConnection()
+    engine = db_connection.connect()
+    if engine.dialect.name != "mysql":
+        raise SystemExit("パーティション管理は MySQL のみ対応しています")
+    session = sessionmaker(bind=engine)()
+    try:
+        if args.command == "maintain":
+            print(maintain(session))
+        elif args.command == "archive":
+            print(archive(session, args.dir, require_reports=not args.ignore_reports))
+        else:
+            for row in status(session):
+                print(row)
+        session.commit()
+    finally:
+        session.close()
+        db_connection.close()
@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+from decimal import ROUND_DOWN, ROUND_HALF_UP, ROUND_UP
+
+from db_control import mymodels, schemas
+from db_control.tax_cache import tax_subtotals
+
+MIX_MATCH = "mix_match"  # 対象商品の中から REQ_QTY 点を選ぶと PROMO_PRICE（よりどり）
+BUNDLE = "bundle"  # 対象商品を QTY 点ずつ揃えると PROMO_PRICE（セット販売）
+
+# 税率ごとの内税額の端数処理（レシート1枚・税率ごとに1回だけ丸める）
+TAX_ROUNDING = {"down": ROUND_DOWN, "half_up": ROUND_HALF_UP, "up": ROUND_UP}
+
+
+class CompiledPromotion:
+    __slots__ = ("id", "name", "type", "req_qty", "price", "priority", "start_at", "end_at", "items")
+
+    def __init__(self, promotion, items):
+        self.id = promotion.PROMO_ID
+        self.name = promotion.NAME
+        self.type = promotion.PROMO_TYPE
+        self.req_qty = promotion.REQ_QTY
+        self.price = promotion.PROMO_PRICE
+        self.priority = promotion.PRIORITY or 0
+        self.start_at = promotion.START_AT
+        self.end_at = promotion.END_AT
+        self.items = items  # PRD_CODE -> 1組に必要な点数
+
+    def active(self, now):
+        return (self.start_at is None or self.start_at <= now) and (self.end_at is None or now < self.end_at)
+
+
+class PromotionCache:
+    """販促マスタを読み込み、商品コード -> 販促のリストに変換して保持するキャッシュ。
+
+    refresh_interval 秒を過ぎると次のアクセス時に読み直す。reload() で即時に読み直すこともできる。
+    """
+
+    def __init__(self, refresh_interval=300.0):
+        self.refresh_interval = refresh_interval
+        self._by_code = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):  # 環境変数からキャッシュ設定を読み込む
+        return cls(refresh_interval=float(os.getenv("PROMOTION_CACHE_REFRESH_SECONDS", "300")))
+
+    def reload(self, db):  # 販促マスタを全件読み込み直す
+        items = {}
+        for item in db.query(mymodels.PromotionItem).all():
+            items.setdefault(item.PROMO_ID, {})[item.PRD_CODE] = item.QTY or 1
+        by_code = {}
+        count = 0
+        for promotion in db.query(mymodels.Promotion).all():
+            if promotion.PROMO_TYPE not in (MIX_MATCH, BUNDLE) or promotion.PROMO_ID not in items:
+                continue
+            if promotion.PROMO_TYPE == MIX_MATCH and not (promotion.REQ_QTY or 0) > 0:
+                continue
+            compiled = CompiledPromotion(promotion, items[promotion.PROMO_ID])
+            for code in compiled.items:
+                by_code.setdefault(code, []).append(compiled)
+            count += 1
+        with self._lock:
+            self._by_code = by_code
+            self._loaded_at = time.monotonic()
+        return count
+
+    def for_codes(self, db, codes, now):  # バスケット内の商品が対象の有効な販促を適用順に返す
+        loaded_at = self._loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at > self.refresh_interval:
+            self.reload(db)
+        by_code = self._by_code
+        found = {}
+        for code in codes:
+            for promotion in by_code.get(code, ()):
+                found[promotion.id] = promotion
+        return sorted((p for p in found.values() if p.active(now)), key=lambda p: (p.priority, p.id))
+
+
+def _allocate(discounts, units, prices, discount):  # 値引き額を単価の比率で明細に按分する（端数は先頭の明細へ）
+    regular = sum(prices[line] for line in units)
+    allocated = 0
+    for line in units:
+        share = discount * prices[line] // regular
+        discounts[line] += share
+        allocated += share
+    discounts[units[0]] += discount - allocated
+
+
+def _apply_mix_match(promotion, codes, prices, remaining, discounts):
+    # 単価の高い商品から REQ_QTY 点ずつ組にする（値引きにならない組が出たら打ち切る）
+    lines = sorted((i for i, code in enumerate(codes) if code in promotion.items and remaining[i]), key=lambda i: -prices[i])
+    units = [i for i in lines for _ in range(remaining[i])]
+    times = 0
+    total = 0
+    for start in range(0, len(units) - promotion.req_qty + 1, promotion.req_qty):
+        group = units[start:start + promotion.req_qty]
+        discount = sum(prices[i] for i in group) - promotion.price
+        if discount <= 0:
+            break
+        _allocate(discounts, group, prices, discount)
+        for i in group:
+            remaining[i] -= 1
+        times += 1
+        total += discount
+    return times, total
+
+
+def _apply_bundle(promotion, codes, prices, remaining, discounts):
+    lines_by_code = {}
+    for i, code in enumerate(codes):
+        if code in promotion.items and remaining[i]:
+            lines_by_code.setdefault(code, []).append(i)
+    if len(lines_by_code) < len(promotion.items):
+        return 0, 0
+    sets = min(sum(remaining[i] for i in lines_by_code[code]) // qty for code, qty in promotion.items.items())
+    times = 0
+    total = 0
+    for _ in range(sets):
+        group = []
+        for code, qty in promotion.items.items():
+            for i in lines_by_code[code]:
+                take = min(qty, remaining[i])
+                group.extend([i] * take)
+                qty -= take
+        discount = sum(prices[i] for i in group) - promotion.price
+        if discount <= 0:
+            break
+        _allocate(discounts, group, prices, discount)
+        for i in group:
+            remaining[i] -= 1
+        times += 1
+        total += discount
+    return times, total
+
+
+def price_basket(lines, promotions, rounding=ROUND_DOWN):
+    """バスケットを価格計算する。
+
+    lines: [(商品, 数量, 税率)]（商品は schemas.Product、税率は schemas.Tax）
+    promotions: PromotionCache.for_codes() が返す適用順の販促
+    """
+    codes = [product.CODE for product, _, _ in lines]
+    prices = [product.PRICE for product, _, _ in lines]
+    remaining = [qty for _, qty, _ in lines]
+    discounts = [0] * len(lines)
+
+    applied = []
+    for promotion in promotions:
+        apply = _apply_mix_match if promotion.type == MIX_MATCH else _apply_bundle
+        times, discount = apply(promotion, codes, prices, remaining, discounts)
+        if times:
+            applied.append(schemas.AppliedPromotion(PROMO_ID=promotion.id, NAME=promotion.name, TIMES=times, DISCOUNT=discount))
+
+    priced_lines = []
+    subtotals = {}
+    for i, (product, qty, tax) in enumerate(lines):
+        amount = product.PRICE * qty
+        net = amount - discounts[i]
+        priced_lines.append(schemas.PricedLine(
+            PRD_ID=product.PRD_ID, PRD_CODE=product.CODE, PRD_NAME=product.NAME, TAX_CD=tax.CODE,
+            UNIT_PRICE=product.PRICE, QTY=qty, AMOUNT=amount, DISCOUNT=discounts[i], NET_AMOUNT=net,
+        ))
+        subtotal = subtotals.setdefault(tax.CODE, [tax, 0])
+        subtotal[1] += net
+
+    taxes = tax_subtotals(subtotals, rounding)
+    total = sum(t.SUBTOTAL for t in taxes)
+    tax_total = sum(t.TAX_AMT for t in taxes)
+    return schemas.PricedBasket(
+        lines=priced_lines,
+        promotions=applied,
+        taxes=taxes,
+        TOTAL_AMT=total,
+        TAX_AMT=tax_total,
+        TTL_AMT_EX_TAX=total - tax_total,
+    )
@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from db_control import mymodels, schemas
+
+# キャッシュに存在しないことを表すマーカー（None は「未登録コード」のネガティブキャッシュとして使う）
+MISS = object()
+
+
+class ProductCache:
+    """商品マスタ(m_product_horie)を CODE をキーに保持する LRU + TTL キャッシュ。
+
+    - 見つからなかったコードも短い TTL でネガティブキャッシュする
+    - invalidate() でバージョンを進めると、それ以前に読み込みを始めた結果は保存されない
+    """
+
+    def __init__(self, max_size=10000, ttl=300.0, negative_ttl=30.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.version = 0
+        self._entries = OrderedDict()  # code -> (商品 or None, 有効期限)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_env(cls):  # 環境変数からキャッシュ設定を読み込む
+        return cls(
+            max_size=int(os.getenv("PRODUCT_CACHE_MAX_SIZE", "10000")),
+            ttl=float(os.getenv("PRODUCT_CACHE_TTL", "300")),
+            negative_ttl=float(os.getenv("PRODUCT_CACHE_NEGATIVE_TTL", "30")),
+        )
+
+    def get(self, code):  # 商品 / None(未登録) / MISS(キャッシュなし) のいずれかを返す
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(code)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._entries[code]
+                self.misses += 1
+                return MISS
+            self._entries.move_to_end(code)
+            if entry[0] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return entry[0]
+
+    def put(self, code, product, version=None):  # product が None の場合はネガティブキャッシュ
+        if self.max_size <= 0:
+            return
+        ttl = self.ttl if product is not None else self.negative_ttl
+        with self._lock:
+            # 読み込み中に無効化された場合は古い値を保存しない
+            if version is not None and version != self.version:
+                return
+            self._entries[code] = (product, time.monotonic() + ttl)
+            self._entries.move_to_end(code)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, db, code):  # キャッシュになければDBから取得して保存する
+        cached = self.get(code)
+        if cached is not MISS:
+            return cached
+        version = self.version
+        row = db.query(mymodels.Product).filter(mymodels.Product.CODE == code).first()
+        product = schemas.Product.model_validate(row) if row else None
+        self.put(code, product, version)
+        return product
+
+    def get_many_or_load(self, db, codes):  # 複数コードをまとめて解決（キャッシュにない分は IN 句1回で取得）
+        result = {}
+        missing = []
+        for code in dict.fromkeys(codes):
+            cached = self.get(code)
+            if cached is MISS:
+                missing.append(code)
+            else:
+                result[code] = cached
+        if missing:
+            version = self.version
+            rows = db.query(mymodels.Product).filter(mymodels.Product.CODE.in_(missing)).all()
+            found = {row.CODE: schemas.Product.model_validate(row) for row in rows}
+            for code in missing:
+                product = found.get(code)
+                self.put(code, product, version)
+                result[code] = product
+        return result
+
+    def invalidate(self, codes=None):  # codes 未指定なら全件を無効化してバージョンを進める
+        with self._lock:
+            self.version += 1
+            if codes is None:
+                self._entries.clear()
+            else:
+                for code in codes:
+                    self._entries.pop(code, None)
+            return self.version
+
+    def warm(self, db, batch_size=1000):  # 起動時に商品マスタを max_size 件まで一括読み込み
+        version = self.version
+        count = 0
+        query = db.query(mymodels.Product).order_by(mymodels.Product.PRD_ID).yield_per(batch_size)
+        for row in query:
+            if count >= self.max_size:
+                break
+            self.put(row.CODE, schemas.Product.model_validate(row), version)
+            count += 1
+        return count
+
+    def stats(self):  # キャッシュサイズ調整用の統計情報
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "version": self.version,
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,222 @@
+import argparse
+import csv
+import json
+import logging
+import time
+import urllib.request
+
+from pydantic import ValidationError
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+from db_control import mymodels, schemas
+
+# 1回の INSERT ... ON DUPLICATE KEY UPDATE で送る行数
+DEFAULT_BATCH_SIZE = 1000
+# 結果に含めるエラー行の最大数（エラーが多くてもメモリを使い続けないように）
+MAX_REPORTED_ERRORS = 20
+
+
+class ProductImporter:
+    """CSV / JSONL の行を読み、検証済みの行をバッチ単位で返す。
+
+    ファイル全体を保持しないため、ファイルサイズに関係なく使用メモリは一定。
+    """
+
+    def __init__(self, fmt, batch_size=DEFAULT_BATCH_SIZE):
+        if fmt not in ("csv", "jsonl"):
+            raise ValueError(f"format は csv または jsonl を指定してください: {fmt}")
+        self.fmt = fmt
+        self.batch_size = batch_size
+        self._header = None
+        self._batch = []
+        self.line_no = 0
+        self.rows = 0
+        self.upserted = 0
+        self.invalid = 0
+        self.errors = []
+        self._started = time.perf_counter()
+
+    def _records(self, lines):  # 行のイテレータから (行番号, 1件分の dict) を返す。読めない行はエラーとして記録する
+        if self.fmt == "jsonl":
+            for line in lines:
+                self.line_no += 1
+                if not line.strip():
+                    continue
+                try:
+                    yield self.line_no, json.loads(line)
+                except ValueError as e:  # json.JSONDecodeError は ValueError のサブクラス
+                    self._invalid(self.line_no, e)
+            return
+        # 1つの csv.reader で読み、引用符の中の改行を含むレコードも1件として扱う（行は改行付きで渡すこと）
+        reader = csv.reader(lines)
+        while True:
+            try:
+                values = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as e:
+                self.line_no = reader.line_num
+                self._invalid(self.line_no, e)
+                continue
+            self.line_no = reader.line_num
+            if not any(value.strip() for value in values):
+                continue
+            if self._header is None:
+                self._header = [name.lstrip("\ufeff").strip() for name in values]
+                continue
+            yield self.line_no, dict(zip(self._header, values))
+
+    def _invalid(self, line_no, error):
+        self.invalid += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line_no, "error": str(error)})
+
+    def batches(self, lines):  # 行のイテレータを読み、検証済みの行を batch_size 件ずつ返す
+        for line_no, raw in self._records(lines):
+            self.rows += 1
+            try:
+                product = schemas.ProductCreate.model_validate(raw)
+            except ValidationError as e:
+                self._invalid(line_no, e)
+                continue
+            self._batch.append(product.model_dump())
+            if len(self._batch) >= self.batch_size:
+                yield self.flush()
+        if self._batch:
+            yield self.flush()
+
+    def flush(self):  # 溜まっている行を取り出す
+        batch, self._batch = self._batch, []
+        return batch
+
+    def reject(self, row, error):  # DBに書き込めなかった行（他の商品と重複したコードなど）を記録する
+        self.invalid += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"PRD_ID": row["PRD_ID"], "CODE": row["CODE"], "error": str(getattr(error, "orig", error))})
+
+    def stats(self):
+        elapsed = time.perf_counter() - self._started
+        return {
+            "rows": self.rows,
+            "upserted": self.upserted,
+            "invalid": self.invalid,
+            "errors": self.errors,
+            "elapsed_sec": round(elapsed, 3),
+            "rows_per_sec": round(self.rows / elapsed, 1) if elapsed else 0.0,
+        }
+
+
+def _upsert_statement(dialect_name):  # 商品マスタの upsert 文（MySQL は CODE / PRD_ID、SQLite・PostgreSQL は PRD_ID の重複で更新）
+    table = mymodels.Product.__table__
+    if dialect_name == "mysql":
+        stmt = mysql_insert(table)
+        return stmt.on_duplicate_key_update(CODE=stmt.inserted.CODE, NAME=stmt.inserted.NAME, PRICE=stmt.inserted.PRICE)
+    if dialect_name in ("sqlite", "postgresql"):
+        stmt = (sqlite_insert if dialect_name == "sqlite" else postgresql_insert)(table)
+        return stmt.on_conflict_do_update(
+            index_elements=[table.c.PRD_ID],
+            set_={"CODE": stmt.excluded.CODE, "NAME": stmt.excluded.NAME, "PRICE": stmt.excluded.PRICE},
+        )
+    raise NotImplementedError(f"商品マスタの取込は {dialect_name} に対応していません")
+
+
+def _without_code_conflicts(db, rows, on_error):
+    """他の PRD_ID で登録済み（またはバッチ内で先に出てきた）商品コードの行を除く。
+
+    MySQL の ON DUPLICATE KEY UPDATE は CODE の一意キーでも発火し、別の商品を上書きしてしまうため、
+    どのDBでも upsert の前に同じ規則で重複として扱う。on_error がなければ ValueError を送出する。
+    """
+    product = mymodels.Product
+    owners = dict(db.query(product.CODE, product.PRD_ID).filter(product.CODE.in_({row["CODE"] for row in rows})).all())
+    db.commit()  # 読み取り用のトランザクションを閉じる
+    accepted = []
+    for row in rows:
+        owner = owners.setdefault(row["CODE"], row["PRD_ID"])
+        if owner == row["PRD_ID"]:
+            accepted.append(row)
+            continue
+        error = ValueError(f"商品コード {row['CODE']} は PRD_ID={owner} で登録済みです")
+        if on_error is None:
+            raise error
+        on_error(row, error)
+    return accepted
+
+
+def upsert_products(db, rows, on_error=None):
+    """商品マスタへ一括 upsert してコミットし、書き込んだ件数を返す。
+
+    on_error(row, error) を指定すると、重複・桁あふれなどで失敗したバッチを1行ずつ書き込み直し、
+    失敗した行だけを on_error に渡す（指定しなければ例外をそのまま送出する）。
+    """
+    if not rows:
+        return 0
+    stmt = _upsert_statement(db.get_bind().dialect.name)
+    rows = _without_code_conflicts(db, rows, on_error)
+    if not rows:
+        return 0
+    try:
+        db.execute(stmt, rows)
+        db.commit()
+        return len(rows)
+    except (IntegrityError, DataError):
+        db.rollback()
+        if on_error is None:
+            raise
+    upserted = 0
+    for row in rows:
+        try:
+            db.execute(stmt, [row])
+            db.commit()
+            upserted += 1
+        except (IntegrityError, DataError) as e:
+            db.rollback()
+            on_error(row, e)
+    return upserted
+
+
+def import_file(db, path, fmt, batch_size=DEFAULT_BATCH_SIZE):  # ファイルをストリーミングで読み込んで upsert する
+    importer = ProductImporter(fmt, batch_size)
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        for batch in importer.batches(f):
+            importer.upserted += upsert_products(db, batch, importer.reject)
+            logging.info(f"商品マスタ取込中: {importer.upserted}件")
+    return importer.stats()
+
+
+def _invalidate_remote_cache(base_url):  # 稼働中のAPIサーバーの商品キャッシュを無効化する
+    request = urllib.request.Request(
+        f"{base_url.rstrip('/')}/products/cache/invalidate",
+        data=b"{}",
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read())
+
+
+if __name__ == "__main__":
+    from db_control.connect import AzureDBConnection
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="商品マスタ(m_product_horie)を CSV / JSONL から一括取込する")
+    parser.add_argument("path", help="取込ファイル（CSV はヘッダー行に PRD_ID,CODE,NAME,PRICE）")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="省略時は拡張子から判定")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--invalidate-url", help="取込後に商品キャッシュを無効化するAPIサーバーのURL")
+    args = parser.parse_args()
+
+    fmt = args.format or ("jsonl" if args.path.endswith((".jsonl", ".ndjson")) else "csv")
+    db_connection = AzureDBConnection()
+    db = sessionmaker(autoflush=False, bind=db_connection.connect())()
+    try:
+        result = import_file(db, args.path, fmt, args.batch_size)
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+        if args.invalidate_url:
+            print(f"商品キャッシュを無効化しました: {_invalidate_remote_cache(args.invalidate_url)}")
+    finally:
+        db.close()
+        db_connection.close()
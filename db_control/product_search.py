@@ -0,0 +1,249 @@
+import heapq
+import os
+import threading
+import unicodedata
+from array import array
+from bisect import bisect_left, insort
+
+from db_control import mymodels, schemas
+
+# 正規化で取り除く文字（スペース・中黒・長音記号）。「コーヒー」「ｺｰﾋｰ」「kohi」をすべて「こひ」として扱う
+_IGNORED_CHARS = str.maketrans("", "", " 　・･ーｰ-‐－")
+
+# ローマ字 → ひらがな（長い綴りから順に照合する）
+_ROMAJI = {
+    "a": "あ", "i": "い", "u": "う", "e": "え", "o": "お",
+    "ka": "か", "ki": "き", "ku": "く", "ke": "け", "ko": "こ",
+    "sa": "さ", "si": "し", "shi": "し", "su": "す", "se": "せ", "so": "そ",
+    "ta": "た", "ti": "ち", "chi": "ち", "tu": "つ", "tsu": "つ", "te": "て", "to": "と",
+    "na": "な", "ni": "に", "nu": "ぬ", "ne": "ね", "no": "の",
+    "ha": "は", "hi": "ひ", "hu": "ふ", "fu": "ふ", "he": "へ", "ho": "ほ",
+    "ma": "ま", "mi": "み", "mu": "む", "me": "め", "mo": "も",
+    "ya": "や", "yu": "ゆ", "yo": "よ",
+    "ra": "ら", "ri": "り", "ru": "る", "re": "れ", "ro": "ろ",
+    "la": "ら", "li": "り", "lu": "る", "le": "れ", "lo": "ろ",
+    "wa": "わ", "wo": "を",
+    "ga": "が", "gi": "ぎ", "gu": "ぐ", "ge": "げ", "go": "ご",
+    "za": "ざ", "zi": "じ", "ji": "じ", "zu": "ず", "ze": "ぜ", "zo": "ぞ",
+    "da": "だ", "di": "ぢ", "du": "づ", "de": "で", "do": "ど",
+    "ba": "ば", "bi": "び", "bu": "ぶ", "be": "べ", "bo": "ぼ",
+    "pa": "ぱ", "pi": "ぴ", "pu": "ぷ", "pe": "ぺ", "po": "ぽ",
+    "va": "ゔぁ", "vi": "ゔぃ", "vu": "ゔ", "ve": "ゔぇ", "vo": "ゔぉ",
+    "fa": "ふぁ", "fi": "ふぃ", "fe": "ふぇ", "fo": "ふぉ",
+    "thi": "てぃ", "dhi": "でぃ",
+    "je": "じぇ", "she": "しぇ", "che": "ちぇ",
+    "xtu": "っ", "ltu": "っ", "xya": "ゃ", "xyu": "ゅ", "xyo": "ょ",
+}
+for _consonant, _kana in (("ky", "き"), ("sh", "し"), ("sy", "し"), ("ch", "ち"), ("ty", "ち"), ("cy", "ち"),
+                          ("ny", "に"), ("hy", "ひ"), ("my", "み"), ("ry", "り"), ("gy", "ぎ"),
+                          ("j", "じ"), ("jy", "じ"), ("zy", "じ"), ("by", "び"), ("py", "ぴ")):
+    for _vowel, _small in (("a", "ゃ"), ("u", "ゅ"), ("o", "ょ")):
+        _ROMAJI[_consonant + _vowel] = _kana + _small
+
+
+def normalize(text):  # 全角/半角・大文字/小文字・カタカナ/ひらがなの違いをなくす
+    text = unicodedata.normalize("NFKC", text).lower().translate(_IGNORED_CHARS)
+    return "".join(chr(ord(c) - 0x60) if "ァ" <= c <= "ヶ" else c for c in text)
+
+
+def romaji_to_hiragana(text):  # 変換できない綴りが含まれる場合は None
+    result = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == "n" and (i + 1 == len(text) or text[i + 1] not in "aiueoyn"):
+            result.append("ん")
+            i += 1
+            continue
+        if c == "n" and text[i + 1] == "n":
+            result.append("ん")
+            i += 2
+            continue
+        if i + 1 < len(text) and c == text[i + 1] and c not in "aiueon":
+            result.append("っ")  # 子音の重なりは促音
+            i += 1
+            continue
+        for length in (3, 2, 1):
+            kana = _ROMAJI.get(text[i:i + length])
+            if kana:
+                result.append(kana)
+                i += length
+                break
+        else:
+            return None
+    return "".join(result)
+
+
+def _bigrams(text):
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+class ProductSearchIndex:
+    """商品マスタ(m_product_horie)のインメモリ検索インデックス。
+
+    - JANコードの前方一致: ソート済みのコード一覧を二分探索
+    - 商品名の検索: 正規化した名前の完全一致 > 前方一致 > 部分一致（2-gram の転置インデックス）の順に並べる
+    - 追加・更新された商品は refresh_new() / refresh_codes() で差分反映し、rebuild() で全件を作り直す
+    """
+
+    def __init__(self, max_scan=500):
+        self.max_scan = max_scan  # 部分一致で順位付けする件数の上限（これを超える分は PRD_ID 順で打ち切る）
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._products = []  # slot -> (PRD_ID, CODE, NAME, PRICE)。削除された slot は None
+        self._names = []  # slot -> 正規化した商品名
+        self._slot_by_code = {}
+        self._codes = []  # ソート済みの商品コード
+        self._sorted_names = []  # (正規化した商品名, slot) のソート済みリスト
+        self._postings = {}  # 2-gram -> slot の昇順 array
+        self.max_prd_id = 0
+        self.removed = 0
+
+    @classmethod
+    def from_env(cls):  # 環境変数から設定を読み込む
+        return cls(max_scan=int(os.getenv("PRODUCT_SEARCH_MAX_SCAN", "500")))
+
+    def rebuild(self, db, batch_size=5000):  # 商品マスタ全件からインデックスを作り直し、件数を返す
+        fresh = ProductSearchIndex(self.max_scan)
+        query = db.query(mymodels.Product.PRD_ID, mymodels.Product.CODE, mymodels.Product.NAME, mymodels.Product.PRICE)
+        for row in query.order_by(mymodels.Product.PRD_ID).yield_per(batch_size):
+            fresh._append(tuple(row))
+        fresh._codes.sort()
+        fresh._sorted_names.sort()
+        with self._lock:
+            self.__dict__.update({key: value for key, value in fresh.__dict__.items() if key != "_lock"})
+        return len(self._slot_by_code)
+
+    def refresh_new(self, db):  # 前回以降に追加された商品（PRD_ID が最大値より大きいもの）を反映する
+        rows = (
+            db.query(mymodels.Product.PRD_ID, mymodels.Product.CODE, mymodels.Product.NAME, mymodels.Product.PRICE)
+            .filter(mymodels.Product.PRD_ID > self.max_prd_id)
+            .order_by(mymodels.Product.PRD_ID)
+            .all()
+        )
+        with self._lock:
+            for row in rows:
+                self._upsert(tuple(row))
+        return len(rows)
+
+    def refresh_codes(self, db, codes):  # 指定コードの商品を読み直す（削除された商品はインデックスから外す）
+        rows = (
+            db.query(mymodels.Product.PRD_ID, mymodels.Product.CODE, mymodels.Product.NAME, mymodels.Product.PRICE)
+            .filter(mymodels.Product.CODE.in_(codes))
+            .all()
+        )
+        found = {row.CODE for row in rows}
+        with self._lock:
+            for row in rows:
+                self._upsert(tuple(row))
+            for code in codes:
+                if code not in found:
+                    self._remove(code)
+        return len(rows)
+
+    def search(self, query, limit=20):  # 順位付けした商品を最大 limit 件返す
+        text = unicodedata.normalize("NFKC", query).strip()
+        if not text:
+            return []
+        with self._lock:
+            if text.isdigit():
+                slots = self._search_code(text, limit)
+            else:
+                slots = self._search_name(text, limit)
+            products = [self._products[slot] for slot in slots]
+        return [schemas.Product(PRD_ID=p[0], CODE=p[1], NAME=p[2], PRICE=p[3]) for p in products]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "products": len(self._slot_by_code),
+                "slots": len(self._products),
+                "removed": self.removed,
+                "ngrams": len(self._postings),
+                "max_prd_id": self.max_prd_id,
+            }
+
+    def _search_code(self, prefix, limit):
+        slots = []
+        for i in range(bisect_left(self._codes, prefix), len(self._codes)):
+            code = self._codes[i]
+            if not code.startswith(prefix) or len(slots) >= limit:
+                break
+            slots.append(self._slot_by_code[code])
+        return slots
+
+    def _search_name(self, text, limit):
+        variants = [normalize(text)]
+        if text.isascii():
+            kana = romaji_to_hiragana(variants[0])
+            if kana:
+                variants.append(kana)
+
+        # 完全一致・前方一致（ソート済みの名前を二分探索）
+        ranked = {}
+        for variant in filter(None, variants):
+            i = bisect_left(self._sorted_names, (variant,))
+            while i < len(self._sorted_names) and len(ranked) < limit:
+                name, slot = self._sorted_names[i]
+                if not name.startswith(variant):
+                    break
+                ranked.setdefault(slot, (0 if name == variant else 1, 0, len(name), slot))
+                i += 1
+        if len(ranked) >= limit:
+            return [slot for _, slot in sorted((key, slot) for slot, key in ranked.items())[:limit]]
+
+        # 部分一致（最も件数の少ない 2-gram の商品だけを照合し、max_scan 件見つかった時点で打ち切る）
+        products, names = self._products, self._names
+        for variant in variants:
+            grams = _bigrams(variant)
+            if not grams:
+                continue
+            found = 0
+            for slot in min((self._postings.get(gram, ()) for gram in grams), key=len):
+                if slot in ranked or products[slot] is None:
+                    continue
+                position = names[slot].find(variant)
+                if position >= 0:
+                    ranked[slot] = (2, position, len(names[slot]), slot)
+                    found += 1
+                    if found >= self.max_scan:
+                        break
+        return [slot for _, slot in heapq.nsmallest(limit, ((key, slot) for slot, key in ranked.items()))]
+
+    def _append(self, product):  # 新しい slot に商品を追加する（ソート済みリストは呼び出し側で整える）
+        slot = len(self._products)
+        name = normalize(product[2])
+        self._products.append(product)
+        self._names.append(name)
+        self._slot_by_code[product[1]] = slot
+        self._codes.append(product[1])
+        self._sorted_names.append((name, slot))
+        for gram in _bigrams(name):
+            self._postings.setdefault(gram, array("I")).append(slot)
+        self.max_prd_id = max(self.max_prd_id, product[0])
+        return slot
+
+    def _upsert(self, product):
+        old = self._slot_by_code.get(product[1])
+        if old is not None:
+            if self._products[old] == product:
+                return
+            self._remove(product[1])
+        slot = self._append(product)
+        # _append が末尾に足した分をソート位置へ移す
+        self._codes.pop()
+        insort(self._codes, product[1])
+        self._sorted_names.pop()
+        insort(self._sorted_names, (self._names[slot], slot))
+
+    def _remove(self, code):  # slot は再利用せず、転置インデックスからは照合時に読み飛ばす
+        slot = self._slot_by_code.pop(code, None)
+        if slot is None:
+            return
+        del self._codes[bisect_left(self._codes, code)]
+        del self._sorted_names[bisect_left(self._sorted_names, (self._names[slot], slot))]
+        self._products[slot] = None
+        self.removed += 1
+
@@ -0,0 +1,31 @@
+## レシートの既定テンプレート（1行 = 印字1行。幅は RECEIPT_WIDTH 桁、全角は2桁で数える）
+## 店舗ごとに変える場合は receipt-{STORE_CD}.txt.mako を置き、<%inherit file="receipt.txt.mako"/> で header / footer だけを上書きする
+##   title(文字列): 倍角で中央寄せ / double(文字列): 倍角（width // 2 桁） / center・columns・yen・percent・rule: 配置と書式
+<%block name="header">\
+% if shop_name:
+${title(shop_name)}
+% endif
+${center("店舗 " + r.STORE_CD)}
+</%block>\
+${columns(r.DATETIME.strftime("%Y/%m/%d %H:%M") if r.DATETIME else "", "POS " + r.POS_NO)}
+${columns("No." + str(r.TRD_ID), "担当 " + r.EMP_CD)}
+${rule}
+% for line in r.lines:
+${columns(("※" if line.REDUCED else "") + line.PRD_NAME, yen(line.AMOUNT))}
+% if line.QTY > 1:
+${"  " + yen(line.UNIT_PRICE) + " x " + str(line.QTY) + "点"}
+% endif
+% endfor
+${rule}
+${double(columns("合計", yen(r.TOTAL_AMT), width // 2))}
+% for tax in r.taxes:
+${columns(" (" + percent(tax.PERCENT) + "%対象", yen(tax.SUBTOTAL) + ")")}
+${columns(" (内消費税等", yen(tax.TAX_AMT) + ")")}
+% endfor
+% if any(line.REDUCED for line in r.lines):
+※は軽減税率対象商品です
+% endif
+<%block name="footer">\
+${rule}
+${center("ご来店ありがとうございました")}
+</%block>\
@@ -0,0 +1,257 @@
+"""レシートの生成（テキスト / ESC/POS / PDF）
+
+テンプレート（Mako）は起動時に1回だけコンパイルしてキャッシュする。店舗ごとのテンプレート
+receipt-{STORE_CD}.txt.mako があればそれを、なければ receipt.txt.mako を使う。
+テンプレートの出力（1行 = 印字1行）を形式ごとに変換するので、どの形式でもレイアウトは同じになる。
+"""
+import os
+import unicodedata
+import zlib
+from decimal import Decimal, ROUND_DOWN
+
+from mako.lookup import TemplateLookup
+from mako.exceptions import TopLevelLookupException
+
+from db_control import schemas
+from db_control.tax_cache import tax_rate, tax_subtotals
+
+DEFAULT_TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), "receipt_templates")
+DEFAULT_TEMPLATE = "receipt.txt.mako"
+
+# テンプレートが倍角にしたい行の前後に付ける印（出力前に形式ごとの指定に置き換える）
+DOUBLE_ON = "\x02"
+DOUBLE_OFF = "\x03"
+
+FORMATS = ("text", "escpos", "pdf")
+MEDIA_TYPES = {"text": "text/plain; charset=utf-8", "escpos": "application/octet-stream", "pdf": "application/pdf"}
+EXTENSIONS = {"text": "txt", "escpos": "bin", "pdf": "pdf"}
+
+# ESC/POS（日本語モデル）: 初期化・国際文字セット日本（0x5C を ¥ で印字）・漢字モード（Shift_JIS）
+ESCPOS_INIT = b"\x1b@\x1bR\x08\x1c&\x1cC\x01"
+ESCPOS_DOUBLE = b"\x1d!\x11"  # 縦横倍角
+ESCPOS_NORMAL = b"\x1d!\x00"
+ESCPOS_CUT = b"\x1bd\x04\x1dVB\x00"  # 4行送ってパーシャルカット
+
+# PDF: 80mm のロール紙に合わせた1ページ。フォントは埋め込まず、ビューア標準の日本語フォント（平成角ゴシック）を使う
+PDF_PAGE_WIDTH = 226.77
+PDF_MARGIN = 10.0
+PDF_LEADING = 1.25
+_PDF_FONT_OBJECTS = [
+    b"<< /Type /Font /Subtype /Type0 /BaseFont /HeiseiKakuGo-W5 /Encoding /UniJIS-UCS2-HW-H /DescendantFonts [5 0 R] >>",
+    b"<< /Type /Font /Subtype /CIDFontType0 /BaseFont /HeiseiKakuGo-W5"
+    b" /CIDSystemInfo << /Registry (Adobe) /Ordering (Japan1) /Supplement 2 >>"
+    b" /FontDescriptor 6 0 R /DW 1000 /W [231 389 500 631 631 500] >>",
+    b"<< /Type /FontDescriptor /FontName /HeiseiKakuGo-W5 /Flags 4 /FontBBox [-92 -250 1010 922]"
+    b" /ItalicAngle 0 /Ascent 752 /Descent -221 /CapHeight 737 /StemV 114 >>",
+]
+
+
+def text_width(text):  # 印字幅（全角・曖昧幅の文字は2桁）
+    return sum(2 if unicodedata.east_asian_width(c) in "FWA" else 1 for c in text)
+
+
+def truncate(text, width):  # 印字幅が width 桁を超える分を切り捨てる
+    used = 0
+    for i, c in enumerate(text):
+        used += text_width(c)
+        if used > width:
+            return text[:i]
+    return text
+
+
+def center(text, width):
+    text = truncate(text, width)
+    return " " * ((width - text_width(text)) // 2) + text
+
+
+def columns(left, right, width):  # 左寄せと右寄せを1行に並べる（左側が長ければ切り詰める）
+    left = truncate(left, max(width - text_width(right) - 1, 0))
+    return left + " " * max(width - text_width(left) - text_width(right), 1) + right
+
+
+def yen(amount):
+    return f"¥{amount or 0:,}"
+
+
+def percent(value):  # 税率（10.00 形式でも 0.10 形式でも）を "10" / "8" のように表示する
+    value = Decimal(value)
+    return f"{(value if value >= 1 else value * 100).normalize():f}"
+
+
+def build_receipt(transaction, taxes, default_tax, rounding=ROUND_DOWN):
+    """取引（明細を読み込み済みの mymodels.Transaction）からレシートの内容を組み立てる。
+
+    taxes: {税区分: schemas.Tax}（明細の税区分がない場合は default_tax）
+    同じ商品・単価・税区分が続く明細は1行にまとめ、標準税率より低い税区分の行は軽減税率とする。
+    """
+    lines = []
+    subtotals = {}
+    for detail in transaction.transaction_details:
+        tax = taxes.get(detail.TAX_CD) or default_tax
+        last = lines[-1] if lines else None
+        if last and (last.PRD_CODE, last.UNIT_PRICE, last.TAX_CD) == (detail.PRD_CODE, detail.PRD_PRICE, tax.CODE):
+            last.QTY += 1
+            last.AMOUNT += detail.PRD_PRICE
+        else:
+            lines.append(schemas.ReceiptLine(
+                PRD_CODE=detail.PRD_CODE, PRD_NAME=detail.PRD_NAME, TAX_CD=tax.CODE, UNIT_PRICE=detail.PRD_PRICE,
+                QTY=1, AMOUNT=detail.PRD_PRICE, REDUCED=tax_rate(tax) < tax_rate(default_tax),
+            ))
+        subtotals.setdefault(tax.CODE, [tax, 0])[1] += detail.PRD_PRICE
+    return schemas.Receipt(
+        TRD_ID=transaction.TRD_ID,
+        DATETIME=transaction.DATETIME,
+        EMP_CD=transaction.EMP_CD,
+        STORE_CD=transaction.STORE_CD,
+        POS_NO=transaction.POS_NO,
+        TOTAL_AMT=transaction.TOTAL_AMT,
+        TTL_AMT_EX_TAX=transaction.TTL_AMT_EX_TAX,
+        lines=lines,
+        taxes=tax_subtotals(subtotals, rounding),
+    )
+
+
+class ReceiptRenderer:
+    """コンパイル済みのテンプレートを保持してレシートを出力する。
+
+    template_dirs は先頭ほど優先（RECEIPT_TEMPLATE_DIR で既定のテンプレートを上書きできる）。
+    module_directory を指定するとコンパイル結果をファイルにも保存し、プロセスを再起動しても再コンパイルしない。
+    """
+
+    def __init__(self, template_dirs, width=42, module_directory=None, shop_name=""):
+        self.template_dirs = list(template_dirs)
+        self.width = width
+        self.module_directory = module_directory
+        self.shop_name = shop_name
+        # テンプレートは起動後に変更しない前提なので、更新日時の確認をしない
+        self._lookup = TemplateLookup(
+            directories=self.template_dirs, module_directory=module_directory, filesystem_checks=False,
+            input_encoding="utf-8", strict_undefined=True,
+        )
+        self._templates = {}  # STORE_CD -> コンパイル済みテンプレート
+        self._helpers = {
+            "width": width,
+            "shop_name": shop_name,
+            "rule": "-" * width,
+            "center": lambda text, w=width: center(text, w),
+            "columns": lambda left, right, w=width: columns(left, right, w),
+            "double": lambda text: DOUBLE_ON + text + DOUBLE_OFF,
+            "title": lambda text: DOUBLE_ON + center(text, width // 2) + DOUBLE_OFF,
+            "yen": yen,
+            "percent": percent,
+        }
+
+    @classmethod
+    def from_env(cls):  # 環境変数からテンプレートの場所と桁数を読み込む
+        template_dirs = [DEFAULT_TEMPLATE_DIR]
+        if os.getenv("RECEIPT_TEMPLATE_DIR"):
+            template_dirs.insert(0, os.environ["RECEIPT_TEMPLATE_DIR"])
+        return cls(
+            template_dirs,
+            width=int(os.getenv("RECEIPT_WIDTH", "42")),
+            module_directory=os.getenv("RECEIPT_TEMPLATE_CACHE_DIR") or None,
+            shop_name=os.getenv("RECEIPT_SHOP_NAME", ""),
+        )
+
+    def config(self):  # ワーカープロセスで同じ設定のレンダラーを作るための引数
+        return (self.template_dirs, self.width, self.module_directory, self.shop_name)
+
+    def template(self, store_cd):
+        template = self._templates.get(store_cd)
+        if template is None:
+            try:
+                template = self._lookup.get_template(f"receipt-{store_cd}.txt.mako")
+            except TopLevelLookupException:
+                template = self._lookup.get_template(DEFAULT_TEMPLATE)
+            self._templates[store_cd] = template
+        return template
+
+    def warm(self):  # 既定のテンプレートを事前にコンパイルする（テンプレートの誤りを起動時に検出する）
+        return self._lookup.get_template(DEFAULT_TEMPLATE)
+
+    def lines(self, receipt):  # テンプレートを適用し、(行, 倍角か) のリストにする
+        output = self.template(receipt.STORE_CD).render(r=receipt, **self._helpers)
+        result = []
+        for line in output.rstrip("\n").split("\n"):
+            if line.startswith(DOUBLE_ON):
+                result.append((line.replace(DOUBLE_ON, "").replace(DOUBLE_OFF, "").rstrip(), True))
+            else:
+                result.append((line.rstrip(), False))
+        return result
+
+    def render_text(self, receipt):  # 倍角の行は通常の文字で中央に寄せる
+        return "\n".join(center(line.strip(), self.width) if double else line for line, double in self.lines(receipt)) + "\n"
+
+    def render_escpos(self, receipt):
+        out = [ESCPOS_INIT]
+        for line, double in self.lines(receipt):
+            data = line.replace("¥", "\\").encode("cp932", errors="replace") + b"\n"
+            out.append(ESCPOS_DOUBLE + data + ESCPOS_NORMAL if double else data)
+        out.append(ESCPOS_CUT)
+        return b"".join(out)
+
+    def render_pdf(self, receipt):
+        lines = self.lines(receipt)
+        size = min(9.0, (PDF_PAGE_WIDTH - 2 * PDF_MARGIN) / (self.width / 2))
+        height = 2 * PDF_MARGIN + sum(size * PDF_LEADING * (2 if double else 1) for _, double in lines)
+        ops = ["BT"]
+        y = height - PDF_MARGIN
+        for line, double in lines:
+            font_size = size * 2 if double else size
+            y -= font_size * PDF_LEADING
+            ops.append(f"/F1 {font_size:.2f} Tf 1 0 0 1 {PDF_MARGIN:.2f} {y + font_size * 0.25:.2f} Tm <{_pdf_hex(line)}> Tj")
+        ops.append("ET")
+        content = zlib.compress("\n".join(ops).encode("ascii"))
+        return _pdf_document(PDF_PAGE_WIDTH, height, content)
+
+    def render(self, receipt, format):  # 形式を指定して bytes で返す
+        if format == "text":
+            return self.render_text(receipt).encode("utf-8")
+        if format == "escpos":
+            return self.render_escpos(receipt)
+        if format == "pdf":
+            return self.render_pdf(receipt)
+        raise ValueError(f"unknown receipt format: {format}")
+
+    def render_many(self, receipts, format):  # [(TRD_ID, bytes)]
+        return [(receipt.TRD_ID, self.render(receipt, format)) for receipt in receipts]
+
+
+def _pdf_hex(text):  # UniJIS-UCS2 は BMP の文字だけを扱えるので、それ以外は ? にする
+    return "".join(c if ord(c) < 0x10000 else "?" for c in text).encode("utf-16-be").hex().upper()
+
+
+def _pdf_document(width, height, content):  # 1ページだけの PDF を組み立てる
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width:.2f} {height:.2f}]"
+        f" /Resources << /Font << /F1 4 0 R >> >> /Contents 7 0 R >>".encode("ascii"),
+        *_PDF_FONT_OBJECTS,
+        f"<< /Length {len(content)} /Filter /FlateDecode >>\nstream\n".encode("ascii") + content + b"\nendstream",
+    ]
+    out = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode("ascii") + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("ascii")
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode("ascii")
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("ascii")
+    return bytes(out)
+
+
+# プロセスプールのワーカー側（テンプレートはワーカーごとに1回だけコンパイルする）
+_worker_renderer = None
+
+
+def init_worker(config):
+    global _worker_renderer
+    _worker_renderer = ReceiptRenderer(*config)
+    _worker_renderer.warm()
+
+
+def render_many(receipts, format):
+    return _worker_renderer.render_many(receipts, format)
@@ -0,0 +1,195 @@
+import logging
+import os
+from datetime import datetime, timedelta
+
+import pytz
+from sqlalchemy import text, func
+
+from db_control import mymodels
+
+# 1回の集計で処理するIDの幅（大量の未集計データでもトランザクションを小さく保つ）
+REPORT_BATCH_SIZE = int(os.getenv("REPORT_BATCH_SIZE", "50000"))
+# 採番順とコミット順が前後した取引を取りこぼさないよう、直近この秒数の取引は次回に回す
+REPORT_SAFETY_LAG_SECONDS = int(os.getenv("REPORT_SAFETY_LAG_SECONDS", "5"))
+
+HOURLY_WATERMARK = "sales_hourly"
+# 商品別の集計も取引ID（TRD_ID）で区切る。明細IDで区切ると、採番順とコミット順が前後した明細
+# （同時のチェックアウト・write-behind キュー・複数ワーカー）がウォーターマークより下に入って集計されない
+PRODUCT_WATERMARK = "sales_product_daily_by_trd"
+LEGACY_PRODUCT_WATERMARK = "sales_product_daily"  # 明細ID（DTL_ID）で区切っていた頃のウォーターマーク
+
+# 集計テーブルへの加算（INSERT ... SELECT の upsert）は MySQL と SQLite（開発・ベンチマーク用）に対応する
+_SALES_DATE = {"mysql": "DATE({column})", "sqlite": "DATE({column})"}
+_SALES_HOUR = {"mysql": "HOUR({column})", "sqlite": "CAST(strftime('%H', {column}) AS INTEGER)"}
+_ADD = {"mysql": "{column} = {column} + VALUES({column})", "sqlite": "{column} = {column} + excluded.{column}"}
+_REPLACE = {"mysql": "{column} = VALUES({column})", "sqlite": "{column} = excluded.{column}"}
+_ON_CONFLICT = {"mysql": "ON DUPLICATE KEY UPDATE", "sqlite": "ON CONFLICT ({keys}) DO UPDATE SET"}
+
+
+def supports(dialect_name):  # 集計テーブルの更新に対応しているデータベースか
+    return dialect_name in _ON_CONFLICT
+
+
+def _upsert(dialect_name, table, keys, columns, select, add, replace=()):
+    updates = [_ADD[dialect_name].format(column=column) for column in add]
+    updates += [_REPLACE[dialect_name].format(column=column) for column in replace]
+    on_conflict = _ON_CONFLICT[dialect_name].format(keys=", ".join(keys))
+    # SQLite は INSERT ... SELECT に ON CONFLICT を付けるとき WHERE 句が必要（select には必ず WHERE を含める）
+    return text(f"INSERT INTO {table} ({', '.join(keys + columns)}) {select} {on_conflict} {', '.join(updates)}")
+
+
+def _hourly_upsert(dialect_name):
+    sales_date = _SALES_DATE[dialect_name].format(column="DATETIME")
+    sales_hour = _SALES_HOUR[dialect_name].format(column="DATETIME")
+    return _upsert(
+        dialect_name, "sales_hourly_horie",
+        ["SALES_DATE", "SALES_HOUR", "STORE_CD", "POS_NO"], ["TRD_COUNT", "TOTAL_AMT", "TTL_AMT_EX_TAX"],
+        f"""SELECT {sales_date}, {sales_hour}, STORE_CD, POS_NO, COUNT(*), COALESCE(SUM(TOTAL_AMT), 0), SUM(TTL_AMT_EX_TAX)
+            FROM transaction_horie
+            WHERE TRD_ID > :from_id AND TRD_ID <= :to_id
+            GROUP BY {sales_date}, {sales_hour}, STORE_CD, POS_NO""",
+        add=["TRD_COUNT", "TOTAL_AMT", "TTL_AMT_EX_TAX"],
+    )
+
+
+def _product_upsert(dialect_name, by_dtl_id=False):
+    sales_date = _SALES_DATE[dialect_name].format(column="t.DATETIME")
+    # by_dtl_id: 移行用（TRD_ID の範囲のうち、DTL_ID が :after_dtl_id より大きい明細だけを集計する）
+    condition = "d.TRD_ID > :from_id AND d.TRD_ID <= :to_id" + (" AND d.DTL_ID > :after_dtl_id" if by_dtl_id else "")
+    return _upsert(
+        dialect_name, "sales_product_daily_horie",
+        ["SALES_DATE", "STORE_CD", "PRD_CODE"], ["PRD_NAME", "QTY", "AMOUNT"],
+        f"""SELECT {sales_date}, t.STORE_CD, d.PRD_CODE, MAX(d.PRD_NAME), COUNT(*), SUM(d.PRD_PRICE)
+            FROM transaction_detail_horie d
+            JOIN transaction_horie t ON t.TRD_ID = d.TRD_ID
+            WHERE {condition}
+            GROUP BY {sales_date}, t.STORE_CD, d.PRD_CODE""",
+        add=["QTY", "AMOUNT"], replace=["PRD_NAME"],
+    )
+
+
+def _lock_watermark(db, name):  # ウォーターマーク行をロックして取得（同時実行された集計の二重計上を防ぐ）
+    watermark = db.query(mymodels.ReportWatermark).filter_by(NAME=name).with_for_update().first()
+    if watermark is None:
+        watermark = mymodels.ReportWatermark(NAME=name, LAST_ID=0)
+        db.add(watermark)
+        db.flush()
+    return watermark
+
+
+def _refresh(db, name, upsert, high_id):  # ウォーターマークから high_id まで REPORT_BATCH_SIZE ずつ集計する
+    processed = 0
+    while True:
+        watermark = _lock_watermark(db, name)
+        from_id = watermark.LAST_ID
+        if high_id is None or from_id >= high_id:
+            db.commit()
+            return processed
+        to_id = min(high_id, from_id + REPORT_BATCH_SIZE)
+        db.execute(upsert, {"from_id": from_id, "to_id": to_id})
+        watermark.LAST_ID = to_id
+        db.commit()
+        processed += to_id - from_id
+
+
+def refresh_sales_summary(db, pending_trd_id=None):
+    """未集計の取引・明細を集計テーブルに反映する（何度実行しても二重計上しない）。
+
+    取引・明細とも、登録から REPORT_SAFETY_LAG_SECONDS 秒を過ぎた取引までを集計する。
+    pending_trd_id: まだ書き込まれていない明細（write-behind キュー）の最小の TRD_ID。その取引の手前で止める
+    """
+    dialect_name = db.get_bind().dialect.name
+    if not supports(dialect_name):
+        raise NotImplementedError(f"売上集計は {dialect_name} に対応していません（MySQL / SQLite のみ）")
+    cutoff = (datetime.now(pytz.timezone("Asia/Tokyo")) - timedelta(seconds=REPORT_SAFETY_LAG_SECONDS)).strftime("%Y-%m-%d %H:%M:%S")
+    high_trd_id = db.query(func.max(mymodels.Transaction.TRD_ID)).filter(mymodels.Transaction.DATETIME <= cutoff).scalar()
+    if high_trd_id is not None:
+        # 後から送られたオフラインの会計は日時が古くても採番は新しいため、それより前に採番された直近の取引の手前で止める
+        reported = db.query(func.min(mymodels.ReportWatermark.LAST_ID)).filter(
+            mymodels.ReportWatermark.NAME.in_([HOURLY_WATERMARK, PRODUCT_WATERMARK])
+        ).scalar() or 0
+        recent_trd_id = db.query(func.min(mymodels.Transaction.TRD_ID)).filter(
+            mymodels.Transaction.TRD_ID > reported, mymodels.Transaction.DATETIME > cutoff
+        ).scalar()
+        if recent_trd_id is not None:
+            high_trd_id = min(high_trd_id, recent_trd_id - 1)
+    if high_trd_id is not None and pending_trd_id is not None:
+        high_trd_id = min(high_trd_id, pending_trd_id - 1)
+    db.commit()  # 読み取り用のトランザクションを閉じる
+
+    result = {
+        HOURLY_WATERMARK: _refresh(db, HOURLY_WATERMARK, _hourly_upsert(dialect_name), high_trd_id),
+        PRODUCT_WATERMARK: _refresh(db, PRODUCT_WATERMARK, _product_upsert(dialect_name), high_trd_id),
+    }
+    if any(result.values()):
+        logging.info(f"売上集計を更新しました: {result}")
+    return result
+
+
+def migrate_product_watermark(db):
+    """明細ID（DTL_ID）のウォーターマークを取引ID（TRD_ID）のウォーターマークに置き換える。
+
+    集計済みの明細（DTL_ID <= 旧ウォーターマーク）が属する最大の取引IDを新しいウォーターマークとし、
+    その取引までで未集計だった明細（DTL_ID が旧ウォーターマークより大きい）をここで集計する。
+    """
+    legacy = db.query(mymodels.ReportWatermark).filter_by(NAME=LEGACY_PRODUCT_WATERMARK).first()
+    if legacy is None or db.query(mymodels.ReportWatermark).filter_by(NAME=PRODUCT_WATERMARK).first():
+        return None
+    # 取引のない明細（外部キーのない環境で登録されたもの）は集計されていないため対象外
+    last_trd_id = db.query(func.max(mymodels.Transaction.TRD_ID)).join(
+        mymodels.TransactionDetail, mymodels.TransactionDetail.TRD_ID == mymodels.Transaction.TRD_ID
+    ).filter(mymodels.TransactionDetail.DTL_ID <= legacy.LAST_ID).scalar() or 0
+    if last_trd_id:
+        db.execute(_product_upsert(db.get_bind().dialect.name, by_dtl_id=True),
+                   {"from_id": 0, "to_id": last_trd_id, "after_dtl_id": legacy.LAST_ID})
+    db.add(mymodels.ReportWatermark(NAME=PRODUCT_WATERMARK, LAST_ID=last_trd_id))
+    db.delete(legacy)
+    db.commit()
+    return last_trd_id
+
+
+def _hourly_query(db, date_from, date_to, store_cd, pos_no, *columns):
+    query = db.query(*columns).filter(mymodels.SalesHourly.SALES_DATE.between(date_from, date_to))
+    if store_cd:
+        query = query.filter(mymodels.SalesHourly.STORE_CD == store_cd)
+    if pos_no:
+        query = query.filter(mymodels.SalesHourly.POS_NO == pos_no)
+    return query
+
+
+def _sum_columns():
+    return (
+        func.sum(mymodels.SalesHourly.TRD_COUNT).label("TRD_COUNT"),
+        func.sum(mymodels.SalesHourly.TOTAL_AMT).label("TOTAL_AMT"),
+        func.sum(mymodels.SalesHourly.TTL_AMT_EX_TAX).label("TTL_AMT_EX_TAX"),
+    )
+
+
+def daily_sales(db, date_from, date_to, store_cd=None, pos_no=None, by_pos=False):  # 日別売上（店舗別、by_pos=True ならPOS別）
+    keys = [mymodels.SalesHourly.SALES_DATE, mymodels.SalesHourly.STORE_CD]
+    if by_pos:
+        keys.append(mymodels.SalesHourly.POS_NO)
+    query = _hourly_query(db, date_from, date_to, store_cd, pos_no, *keys, *_sum_columns())
+    return [row._asdict() for row in query.group_by(*keys).order_by(*keys).all()]
+
+
+def hourly_sales(db, date_from, date_to, store_cd=None, pos_no=None, by_pos=False):  # 時間帯別売上
+    keys = [mymodels.SalesHourly.SALES_DATE, mymodels.SalesHourly.SALES_HOUR, mymodels.SalesHourly.STORE_CD]
+    if by_pos:
+        keys.append(mymodels.SalesHourly.POS_NO)
+    query = _hourly_query(db, date_from, date_to, store_cd, pos_no, *keys, *_sum_columns())
+    return [row._asdict() for row in query.group_by(*keys).order_by(*keys).all()]
+
+
+def top_products(db, date_from, date_to, store_cd=None, limit=10):  # 売上金額上位の商品
+    summary = mymodels.SalesProductDaily
+    query = db.query(
+        summary.PRD_CODE,
+        func.max(summary.PRD_NAME).label("PRD_NAME"),
+        func.sum(summary.QTY).label("QTY"),
+        func.sum(summary.AMOUNT).label("AMOUNT"),
+    ).filter(summary.SALES_DATE.between(date_from, date_to))
+    if store_cd:
+        query = query.filter(summary.STORE_CD == store_cd)
+    query = query.group_by(summary.PRD_CODE).order_by(func.sum(summary.AMOUNT).desc()).limit(limit)
+    return [row._asdict() for row in query.all()]
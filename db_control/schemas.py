@@ -1,6 +1,7 @@
-from pydantic import BaseModel
-from typing import Optional, List
-from datetime import datetime
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Optional, List, Dict
+from datetime import datetime, date
+from decimal import Decimal
 
 ## ============== 商品マスタ ==============
 class ProductBase(BaseModel):
@@ -9,11 +10,34 @@ class ProductBase(BaseModel):
     PRICE: int
 
 class ProductCreate(ProductBase):
+    CODE: str = Field(min_length=1, max_length=13)  # m_product_horie.CODE の桁数
+    NAME: str = Field(min_length=1, max_length=50)  # m_product_horie.NAME の桁数
     PRD_ID: int  # 主キー指定
 
 class Product(ProductCreate):
-    class Config:
-        orm_mode = True  # SQLAlchemyモデルを返すときに必要
+    model_config = ConfigDict(from_attributes=True)  # SQLAlchemyモデルから model_validate するために必要
+
+# 複数商品コードの一括検索
+class ProductLookupRequest(BaseModel):
+    codes: List[str]
+
+# 見つからなかったコードは products で null になり、not_found にも含まれる
+class ProductLookupResponse(BaseModel):
+    products: Dict[str, Optional[Product]]
+    not_found: List[str]
+
+# 商品キャッシュ無効化リクエスト（codes 未指定なら全件無効化）
+class ProductCacheInvalidateRequest(BaseModel):
+    codes: Optional[List[str]] = None
+
+## ============== 税マスタ ==============
+class Tax(BaseModel):
+    ID: int
+    CODE: str
+    NAME: str
+    PERCENT: Decimal
+
+    model_config = ConfigDict(from_attributes=True)
 
 ## ============== 取引テーブル ==============
 class TransactionBase(BaseModel):
@@ -28,6 +52,8 @@ class AddTransactionRequest(BaseModel):
     STORE_CD: str
     POS_NO: str
     TOTAL_AMT: int
+    # 再送時の二重登録防止用キー（レジが生成した UUID、または "店舗コード-POS番号-連番"）
+    IDEMPOTENCY_KEY: Optional[str] = Field(default=None, max_length=64)
 class TransactionCreate(TransactionBase):
     pass
 
@@ -36,8 +62,7 @@ class Transaction(TransactionBase):
     TRD_ID: int
     TTL_AMT_EX_TAX: Optional[float]  # 税抜合計金額 (NULLを許容)
 
-    class Config:
-        orm_mode = True # SQLAlchemy の ORM モデルからデータを取得する際に Pydantic スキーマに適用可能
+    model_config = ConfigDict(from_attributes=True)  # SQLAlchemy の ORM モデルからデータを取得する際に Pydantic スキーマに適用可能
 
 ## ============== 取引明細テーブル ==============
 class TransactionDetailBase(BaseModel):
@@ -54,14 +79,134 @@ class TransactionDetailData(BaseModel):
     PRD_CODE: str
     PRD_NAME: str
     PRD_PRICE: int
+    TAX_CD: Optional[str] = None  # 未指定なら標準税率（税マスタID=1）
 
 class TransactionDetailCreate(TransactionDetailBase):
     TRD_ID: int
 
 class TransactionDetail(TransactionDetailCreate):
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
+
+# write-behind モードで受け付けた明細（DTL_ID は書き込み時に採番されるため返さず、受付番号を返す）
+class QueuedTransactionDetail(BaseModel):
+    TRD_ID: int
+    PRD_ID: int
+    PRD_CODE: str
+    PRD_NAME: str
+    PRD_PRICE: int
+    TAX_CD: str
+    QUEUE_SEQ: int
 
 ## ============== 取引と明細をまとめて表示 ==============
 class TransactionWithDetails(Transaction):
-    details: List[TransactionDetail] = []
\ No newline at end of file
+    details: List[TransactionDetail] = []
+
+## ============== 一括チェックアウト ==============
+# チェックアウトの明細1行分
+class CheckoutItem(BaseModel):
+    PRD_CODE: str
+    PRD_NAME: str
+    PRD_PRICE: int
+    TAX_CD: Optional[str] = None  # 軽減税率（'08'）などを指定する場合のみ
+
+# 取引ヘッダーと明細をまとめて登録するリクエスト
+class CheckoutRequest(AddTransactionRequest):
+    items: List[CheckoutItem] = Field(min_length=1)  # 明細のない取引は登録しない
+    # レジで会計した日時（オフライン中の会計を後から送る場合に指定。未指定なら登録時刻。タイムゾーンなしは日本時間）
+    DATETIME: Optional[datetime] = None
+
+# オフライン中に溜めた会計の一括送信
+class CheckoutBatchRequest(BaseModel):
+    sales: List[CheckoutRequest]
+
+# 一括送信の会計ごとの結果（status: created / replayed / error）
+class CheckoutBatchResult(BaseModel):
+    IDEMPOTENCY_KEY: Optional[str] = None
+    status: str
+    TRD_ID: Optional[int] = None
+    detail: Optional[str] = None
+
+## ============== 価格計算 ==============
+# 価格計算するバスケットの1行（単価は商品マスタから取得する）
+class PricingItem(BaseModel):
+    PRD_CODE: str
+    QTY: int = Field(default=1, ge=1)
+    TAX_CD: Optional[str] = None  # 未指定なら標準税率（税マスタID=1）
+
+class PricingRequest(BaseModel):
+    items: List[PricingItem]
+
+# 価格計算結果の1行（DISCOUNT は販促の値引きを按分した額）
+class PricedLine(BaseModel):
+    PRD_ID: int
+    PRD_CODE: str
+    PRD_NAME: str
+    TAX_CD: str
+    UNIT_PRICE: int
+    QTY: int
+    AMOUNT: int
+    DISCOUNT: int
+    NET_AMOUNT: int
+
+# 適用された販促
+class AppliedPromotion(BaseModel):
+    PROMO_ID: int
+    NAME: str
+    TIMES: int
+    DISCOUNT: int
+
+# 税率ごとの合計（SUBTOTAL は税込、TAX_AMT はそのうちの内税額）
+class TaxSubtotal(BaseModel):
+    TAX_CD: str
+    PERCENT: Decimal
+    SUBTOTAL: int
+    TAX_AMT: int
+    AMT_EX_TAX: int
+
+class PricedBasket(BaseModel):
+    lines: List[PricedLine]
+    promotions: List[AppliedPromotion]
+    taxes: List[TaxSubtotal]
+    TOTAL_AMT: int
+    TAX_AMT: int
+    TTL_AMT_EX_TAX: int
+
+## ============== 売上レポート ==============
+# 日別・時間帯別売上（集計単位に含まれない項目は null）
+class SalesSummary(BaseModel):
+    SALES_DATE: date
+    SALES_HOUR: Optional[int] = None
+    STORE_CD: str
+    POS_NO: Optional[str] = None
+    TRD_COUNT: int
+    TOTAL_AMT: int
+    TTL_AMT_EX_TAX: int
+
+# 売上上位商品
+class TopProduct(BaseModel):
+    PRD_CODE: str
+    PRD_NAME: str
+    QTY: int
+    AMOUNT: int
+
+## ============== レシート ==============
+# レシートの1行（同じ商品・単価・税区分が続く明細は数量にまとめる）
+class ReceiptLine(BaseModel):
+    PRD_CODE: str
+    PRD_NAME: str
+    TAX_CD: str
+    UNIT_PRICE: int
+    QTY: int
+    AMOUNT: int
+    REDUCED: bool  # 軽減税率の対象（レシートに ※ を付ける）
+
+class Receipt(BaseModel):
+    TRD_ID: int
+    DATETIME: Optional[datetime]
+    EMP_CD: str
+    STORE_CD: str
+    POS_NO: str
+    TOTAL_AMT: Optional[int]
+    TTL_AMT_EX_TAX: Optional[int]
+    lines: List[ReceiptLine]
+    taxes: List[TaxSubtotal]
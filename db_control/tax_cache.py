@@ -0,0 +1,84 @@
+import os
+import threading
+import time
+from decimal import Decimal, ROUND_DOWN
+
+from db_control import mymodels, schemas
+
+# 税区分を指定しない明細に適用する税マスタのID（標準税率）
+DEFAULT_TAX_ID = 1
+
+
+def tax_rate(tax):  # PERCENT が 10.00 形式でも 0.10 形式でも小数の税率に揃える
+    percent = Decimal(tax.PERCENT)
+    return percent / 100 if percent >= 1 else percent
+
+
+def tax_subtotals(subtotals, rounding=ROUND_DOWN):
+    """税率ごとの合計（税込）から内税額を1回だけ計算する。
+
+    subtotals: {税区分: [税率, 税込の小計]}（税率は schemas.Tax）
+    """
+    taxes = []
+    for code in sorted(subtotals):
+        tax, subtotal = subtotals[code]
+        rate = tax_rate(tax)
+        tax_amt = int((Decimal(subtotal) * rate / (1 + rate)).quantize(Decimal("1"), rounding=rounding))
+        taxes.append(schemas.TaxSubtotal(
+            TAX_CD=code, PERCENT=tax.PERCENT, SUBTOTAL=subtotal, TAX_AMT=tax_amt, AMT_EX_TAX=subtotal - tax_amt,
+        ))
+    return taxes
+
+
+def line_subtotals(lines):  # [(税率, 税込金額)] を {税区分: [税率, 税込の小計]} にまとめる
+    subtotals = {}
+    for tax, amount in lines:
+        subtotals.setdefault(tax.CODE, [tax, 0])[1] += amount
+    return subtotals
+
+
+def calc_ttl_amt_ex_tax(subtotals, rounding=ROUND_DOWN):  # 税率ごとの合計（税込）から税抜き合計を計算する
+    return sum(tax.AMT_EX_TAX for tax in tax_subtotals(subtotals, rounding))
+
+
+class TaxCache:
+    """税マスタ(tax_horie)の全行を保持するキャッシュ。
+
+    refresh_interval 秒を過ぎると次のアクセス時に読み直す。reload() で即時に読み直すこともできる。
+    """
+
+    def __init__(self, refresh_interval=600.0):
+        self.refresh_interval = refresh_interval
+        self._by_id = {}
+        self._by_code = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):  # 環境変数からキャッシュ設定を読み込む
+        return cls(refresh_interval=float(os.getenv("TAX_CACHE_REFRESH_SECONDS", "600")))
+
+    def reload(self, db):  # 税マスタを全件読み込み直す
+        taxes = [schemas.Tax.model_validate(row) for row in db.query(mymodels.Tax).all()]
+        with self._lock:
+            self._by_id = {tax.ID: tax for tax in taxes}
+            self._by_code = {tax.CODE: tax for tax in taxes}
+            self._loaded_at = time.monotonic()
+        return len(taxes)
+
+    def _ensure_loaded(self, db):
+        loaded_at = self._loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at > self.refresh_interval:
+            self.reload(db)
+
+    def default(self, db):  # 標準税率（ID=1）を返す。未登録なら None
+        self._ensure_loaded(db)
+        return self._by_id.get(DEFAULT_TAX_ID)
+
+    def by_code(self, db, code):  # 税率コード（例: '08', '10'）で税率を返す。未登録なら None
+        self._ensure_loaded(db)
+        return self._by_code.get(code)
+
+    def all(self, db):
+        self._ensure_loaded(db)
+        return list(self._by_id.values())
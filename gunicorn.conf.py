@@ -0,0 +1,19 @@
+# 本番用 gunicorn 設定（gunicorn -c gunicorn.conf.py app:app）
+# preload_app でアプリのインポートを親プロセスで1回だけ行い、ワーカーは fork で共有する。
+# DBエンジンは各ワーカーの起動処理（lifespan）で作成されるため、接続は fork 後に張られる。
+# 商品・税・販促のキャッシュとプライマリ固定（pin_primary）はワーカーごとに持つ。/products/cache/invalidate などを
+# 受け付けたワーカーが cache_version_horie の版数を上げ、他のワーカーは CACHE_SYNC_SECONDS（既定2秒）以内に読み直す。
+# それまでの間は他のワーカーが古い価格・税率で応答することがある（CACHE_SYNC_SECONDS=0 にすると共有しない）。
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn_worker.UvicornWorker"  # uvicorn-worker パッケージ（uvicorn.workers は非推奨）
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+
+# ワーカーは商品キャッシュを温めてからリクエストを受け付ける
+os.environ.setdefault("PRODUCT_CACHE_WARM", "true")
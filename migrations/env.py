@@ -0,0 +1,36 @@
+from logging.config import fileConfig
+
+from alembic import context
+
+from db_control.connect import AzureDBConnection, DATABASE_URL
+from db_control.mymodels import Base
+
+config = context.config
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name, disable_existing_loggers=False)
+
+target_metadata = Base.metadata
+
+
+def run_migrations_offline():  # SQL を出力するだけ（alembic upgrade head --sql）
+    context.configure(url=DATABASE_URL, target_metadata=target_metadata, literal_binds=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():  # アプリと同じ接続設定（SSL を含む）で適用する
+    db_connection = AzureDBConnection()
+    engine = db_connection.connect()
+    try:
+        with engine.connect() as connection:
+            context.configure(connection=connection, target_metadata=target_metadata)
+            with context.begin_transaction():
+                context.run_migrations()
+    finally:
+        db_connection.close()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
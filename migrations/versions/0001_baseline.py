@@ -0,0 +1,140 @@
+"""create_tables.py で作成していたテーブル（既存のテーブルはそのまま）
+
+create_tables.py で作成済みのデータベースにもそのまま適用できるよう、存在しないテーブルだけを作成する。
+
+Revision ID: 0001_baseline
+Revises:
+Create Date: 2026-10-17 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import func
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0001_baseline"
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+TABLES = (
+    "m_product_horie", "transaction_horie", "transaction_detail_horie", "tax_horie", "transaction_idempotency_horie",
+    "sales_hourly_horie", "sales_product_daily_horie", "report_watermark_horie", "m_promotion_horie",
+    "m_promotion_item_horie",
+)
+
+
+def upgrade() -> None:
+    existing = set(sa.inspect(op.get_bind()).get_table_names())
+
+    if "m_product_horie" not in existing:
+        op.create_table(
+            "m_product_horie",
+            sa.Column("PRD_ID", sa.Integer, primary_key=True),
+            sa.Column("CODE", sa.String(13), nullable=False),
+            sa.Column("NAME", sa.String(50), nullable=False),
+            sa.Column("PRICE", sa.Integer, nullable=False),
+        )
+        op.create_index("ix_m_product_horie_CODE", "m_product_horie", ["CODE"], unique=True)
+
+    if "transaction_horie" not in existing:
+        op.create_table(
+            "transaction_horie",
+            sa.Column("TRD_ID", sa.Integer, primary_key=True, autoincrement=True, comment="Primary Key"),
+            sa.Column("DATETIME", sa.TIMESTAMP, server_default=func.current_timestamp(), comment="TRANSACTION_DATETIME"),
+            sa.Column("EMP_CD", sa.String(10), nullable=False, comment="レジ担当"),
+            sa.Column("STORE_CD", sa.String(5), nullable=False, comment="store code"),
+            sa.Column("POS_NO", sa.String(3), nullable=False, comment="POS機ID"),
+            sa.Column("TOTAL_AMT", sa.Integer, comment="total price"),
+            sa.Column("TTL_AMT_EX_TAX", sa.Integer, nullable=False, comment="合計金額（税抜き）"),
+        )
+
+    if "transaction_detail_horie" not in existing:
+        op.create_table(
+            "transaction_detail_horie",
+            sa.Column("TRD_ID", sa.Integer, sa.ForeignKey("transaction_horie.TRD_ID"), nullable=False, comment="取引キー"),
+            sa.Column("DTL_ID", sa.Integer, primary_key=True, autoincrement=True, comment="取引明細キー"),
+            sa.Column("PRD_ID", sa.Integer, sa.ForeignKey("m_product_horie.PRD_ID"), nullable=False, comment="商品キー"),
+            sa.Column("PRD_CODE", sa.String(13), nullable=False, comment="商品コード"),
+            sa.Column("PRD_NAME", sa.String(50), nullable=False, comment="商品名"),
+            sa.Column("PRD_PRICE", sa.Integer, nullable=False, comment="商品単価"),
+            sa.Column("TAX_CD", sa.String(2), nullable=False, comment="消費税区分"),
+        )
+
+    if "tax_horie" not in existing:
+        op.create_table(
+            "tax_horie",
+            sa.Column("ID", sa.Integer, primary_key=True, nullable=False, comment="Primary Key"),
+            sa.Column("CODE", sa.String(2), unique=True, nullable=False, comment="税率コード"),
+            sa.Column("NAME", sa.String(20), nullable=False, comment="税率名称"),
+            sa.Column("PERCENT", sa.DECIMAL(5, 2), nullable=False, comment="税率(%)"),
+        )
+
+    if "transaction_idempotency_horie" not in existing:
+        op.create_table(
+            "transaction_idempotency_horie",
+            sa.Column("IDEMPOTENCY_KEY", sa.String(64), primary_key=True, comment="冪等キー（UUID または 店舗-POS-連番）"),
+            sa.Column("TRD_ID", sa.Integer, sa.ForeignKey("transaction_horie.TRD_ID"), nullable=False, comment="取引キー"),
+            sa.Column("CREATED_AT", sa.TIMESTAMP, server_default=func.current_timestamp(), comment="登録日時"),
+        )
+
+    if "sales_hourly_horie" not in existing:
+        op.create_table(
+            "sales_hourly_horie",
+            sa.Column("SALES_DATE", sa.Date, primary_key=True, comment="売上日"),
+            sa.Column("SALES_HOUR", sa.Integer, primary_key=True, comment="時間帯(0-23)"),
+            sa.Column("STORE_CD", sa.String(5), primary_key=True, comment="store code"),
+            sa.Column("POS_NO", sa.String(3), primary_key=True, comment="POS機ID"),
+            sa.Column("TRD_COUNT", sa.Integer, nullable=False, comment="取引件数"),
+            sa.Column("TOTAL_AMT", sa.BigInteger, nullable=False, comment="売上合計"),
+            sa.Column("TTL_AMT_EX_TAX", sa.BigInteger, nullable=False, comment="売上合計（税抜き）"),
+        )
+
+    if "sales_product_daily_horie" not in existing:
+        op.create_table(
+            "sales_product_daily_horie",
+            sa.Column("SALES_DATE", sa.Date, primary_key=True, comment="売上日"),
+            sa.Column("STORE_CD", sa.String(5), primary_key=True, comment="store code"),
+            sa.Column("PRD_CODE", sa.String(13), primary_key=True, comment="商品コード"),
+            sa.Column("PRD_NAME", sa.String(50), nullable=False, comment="商品名"),
+            sa.Column("QTY", sa.Integer, nullable=False, comment="販売点数"),
+            sa.Column("AMOUNT", sa.BigInteger, nullable=False, comment="売上金額"),
+        )
+
+    if "report_watermark_horie" not in existing:
+        op.create_table(
+            "report_watermark_horie",
+            sa.Column("NAME", sa.String(50), primary_key=True, comment="集計名"),
+            sa.Column("LAST_ID", sa.BigInteger, nullable=False, comment="集計済みの最終ID"),
+        )
+
+    if "m_promotion_horie" not in existing:
+        op.create_table(
+            "m_promotion_horie",
+            sa.Column("PROMO_ID", sa.Integer, primary_key=True, comment="販促ID"),
+            sa.Column("NAME", sa.String(50), nullable=False, comment="販促名（レシート表示用）"),
+            sa.Column("PROMO_TYPE", sa.String(10), nullable=False,
+                      comment="mix_match: 対象商品から REQ_QTY 点で PROMO_PRICE / bundle: 対象商品を QTY 点ずつ揃えて PROMO_PRICE"),
+            sa.Column("REQ_QTY", sa.Integer, nullable=True, comment="まとめ売りの点数（mix_match のみ）"),
+            sa.Column("PROMO_PRICE", sa.Integer, nullable=False, comment="1組あたりの販売価格（税込）"),
+            sa.Column("PRIORITY", sa.Integer, nullable=False, comment="適用順（小さいほど先に適用）"),
+            sa.Column("START_AT", sa.DateTime, nullable=True, comment="開始日時（NULL は制限なし）"),
+            sa.Column("END_AT", sa.DateTime, nullable=True, comment="終了日時（NULL は制限なし）"),
+        )
+
+    if "m_promotion_item_horie" not in existing:
+        op.create_table(
+            "m_promotion_item_horie",
+            sa.Column("PROMO_ID", sa.Integer, sa.ForeignKey("m_promotion_horie.PROMO_ID"), primary_key=True, comment="販促ID"),
+            sa.Column("PRD_CODE", sa.String(13), primary_key=True, comment="対象商品コード"),
+            sa.Column("QTY", sa.Integer, nullable=False, comment="1組に必要な点数（bundle のみ）"),
+        )
+
+
+def downgrade() -> None:
+    # 参照している側から削除する
+    for table in reversed(TABLES):
+        op.drop_table(table)
@@ -0,0 +1,39 @@
+"""取引・取引明細の複合インデックス
+
+- transaction_horie (STORE_CD, DATETIME): 店舗・期間の検索。InnoDB の二次インデックスは主キー（TRD_ID）を含むため、
+  取引IDの抽出や件数はテーブルを読まずにインデックスだけで返せる
+- transaction_detail_horie (TRD_ID, DTL_ID): 取引ごとの明細を DTL_ID 順に取得（外部キー用の TRD_ID 単独のインデックスを置き換える）
+
+MySQL ではオンラインDDL（ALGORITHM=INPLACE, LOCK=NONE）で作成されるため、作成中も取引の登録は止まらない。
+
+Revision ID: 0002_transaction_indexes
+Revises: 0001_baseline
+Create Date: 2026-10-17 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0002_transaction_indexes"
+down_revision: Union[str, None] = "0001_baseline"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index("ix_transaction_store_datetime", "transaction_horie", ["STORE_CD", "DATETIME"])
+    op.create_index("ix_transaction_detail_trd_dtl", "transaction_detail_horie", ["TRD_ID", "DTL_ID"])
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    indexed = [index["column_names"] for index in sa.inspect(bind).get_indexes("transaction_detail_horie")]
+    if bind.dialect.name == "mysql" and ["TRD_ID"] not in indexed:
+        # 外部キー（TRD_ID）を支えるインデックスがなくなるため、先に単独のインデックスを戻す
+        op.create_index("TRD_ID", "transaction_detail_horie", ["TRD_ID"])
+    op.drop_index("ix_transaction_detail_trd_dtl", table_name="transaction_detail_horie")
+    op.drop_index("ix_transaction_store_datetime", table_name="transaction_horie")
@@ -0,0 +1,47 @@
+"""取引・取引明細を TRD_ID の範囲で月別にパーティション化する（MySQL のみ。他のDBでは何もしない）
+
+境界は既存の取引の月ごとの TRD_ID から決め、今月以降は PARTITION_MONTHS_AHEAD か月分を先に作る。
+以後のパーティション作成・古い月のアーカイブは python -m db_control.partitions maintain / archive で行う。
+
+両テーブルを作り直す（全件コピー）ため、取引の少ない時間帯に実行すること。
+パーティションテーブルは外部キーを持てないため、取引・明細に関する外部キー制約は外れる（存在確認はアプリで行う）。
+
+Revision ID: 0003_partition_transactions
+Revises: 0002_transaction_indexes
+Create Date: 2026-10-17 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from db_control import partitions
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0003_partition_transactions"
+down_revision: Union[str, None] = "0002_transaction_indexes"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    if bind.dialect.name != "mysql":
+        return
+    session = Session(bind=bind)
+    partitions.partition_tables(session, partitions.initial_bounds(session))
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != "mysql":
+        return
+    for table in partitions.PARTITIONED_TABLES:
+        op.execute(f"ALTER TABLE {table} REMOVE PARTITIONING")
+    op.execute("ALTER TABLE transaction_detail_horie DROP PRIMARY KEY, ADD PRIMARY KEY (DTL_ID)")
+    # 外部キーは MySQL が自動で付ける名前で戻す
+    op.create_foreign_key("transaction_detail_horie_ibfk_1", "transaction_detail_horie", "transaction_horie", ["TRD_ID"], ["TRD_ID"])
+    op.create_foreign_key("transaction_detail_horie_ibfk_2", "transaction_detail_horie", "m_product_horie", ["PRD_ID"], ["PRD_ID"])
+    op.create_foreign_key("transaction_idempotency_horie_ibfk_1", "transaction_idempotency_horie", "transaction_horie", ["TRD_ID"], ["TRD_ID"])
@@ -0,0 +1,46 @@
+"""商品別売上集計のウォーターマークを明細ID（DTL_ID）から取引ID（TRD_ID）に切り替える
+
+明細IDで区切ると、採番順とコミット順が前後した明細がウォーターマークより下に入って集計されないため、
+取引別の集計と同じく TRD_ID で区切る。集計済みの範囲は変えずに置き換える（reports.migrate_product_watermark）。
+
+Revision ID: 0004_product_watermark_by_trd
+Revises: 0003_partition_transactions
+Create Date: 2026-10-17 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from db_control import reports
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0004_product_watermark_by_trd"
+down_revision: Union[str, None] = "0003_partition_transactions"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    reports.migrate_product_watermark(Session(bind=op.get_bind()))
+
+
+def downgrade() -> None:
+    # 集計済みの取引に属する最大の明細IDに戻す（境界付近で採番順が前後した明細は集計されないことがある）
+    bind = op.get_bind()
+    last_trd_id = bind.execute(
+        sa.text("SELECT LAST_ID FROM report_watermark_horie WHERE NAME = :name"), {"name": reports.PRODUCT_WATERMARK}
+    ).scalar()
+    if last_trd_id is None:
+        return
+    last_dtl_id = bind.execute(
+        sa.text("SELECT MAX(DTL_ID) FROM transaction_detail_horie WHERE TRD_ID <= :trd_id"), {"trd_id": last_trd_id}
+    ).scalar()
+    bind.execute(sa.text("DELETE FROM report_watermark_horie WHERE NAME = :name"), {"name": reports.PRODUCT_WATERMARK})
+    bind.execute(
+        sa.text("INSERT INTO report_watermark_horie (NAME, LAST_ID) VALUES (:name, :last_id)"),
+        {"name": reports.LEGACY_PRODUCT_WATERMARK, "last_id": last_dtl_id or 0},
+    )
@@ -0,0 +1,37 @@
+"""キャッシュの版数テーブル（cache_version_horie）
+
+商品・税・販促のキャッシュはワーカーごとのメモリにあるため、無効化・再読み込みを受け付けたワーカーが版数を上げ、
+他のワーカーは CACHE_SYNC_SECONDS ごとに版数を確認して読み直す（db_control/cache_sync.py）。
+
+Revision ID: 0005_cache_version
+Revises: 0004_product_watermark_by_trd
+Create Date: 2026-10-17 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from db_control import cache_sync
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0005_cache_version"
+down_revision: Union[str, None] = "0004_product_watermark_by_trd"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    table = op.create_table(
+        "cache_version_horie",
+        sa.Column("NAME", sa.String(20), primary_key=True, comment="キャッシュ名（product / tax / promotion）"),
+        sa.Column("VERSION", sa.BigInteger(), nullable=False, comment="版数（無効化・再読み込みのたびに1つ上げる）"),
+    )
+    # 行を先に作っておき、版数の更新は常に UPDATE で行う
+    op.bulk_insert(table, [{"NAME": name, "VERSION": 0} for name in cache_sync.NAMES])
+
+
+def downgrade() -> None:
+    op.drop_table("cache_version_horie")